@@ -0,0 +1,464 @@
+"""
+Asyncio serving mode for kvs.py(set the environment variable SERVER=async, needs aiohttp).
+The data path(/kvs, /kvs/get_key and /kvs/add_key) is served on the event loop: local reads are done inline,
+local writes on a thread pool that takes DB_LOCK for them, and requests forwarded to the owner partition wait on non-blocking peer calls, so a node
+can keep thousands of forwarded requests in flight without a thread for each of them. Every other route,
+including /kvs/sync whose merge is CPU bound, runs the Flask app on a thread pool through a small WSGI bridge.
+So do quorum reads and writes(R or W above 1), which wait on several replicas.
+"""
+import io
+import os
+import sys
+import json
+import asyncio
+from time import time
+from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
+import transport
+import metrics
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:
+    aiohttp = None
+
+
+"""
+Thread pool for the Flask routes and for writes that wait on the write-ahead log
+"""
+EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv('ASYNC_WORKERS', 64)))
+
+
+"""
+Tasks still running after the response was sent(read repairs). The event loop only keeps weak references to them
+"""
+BACKGROUND = set()
+
+
+def json_response(fields, status):
+    return web.Response(body=json.dumps(fields).encode('utf-8'), status=status, content_type='application/json')
+
+
+"""
+Run the Flask app on the thread pool for a request the event loop does not handle itself
+"""
+async def wsgi_fallback(kvs, request):
+    body = await request.read()
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': request.path,
+        'QUERY_STRING': request.query_string,
+        'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+        'CONTENT_LENGTH': str(len(body)),
+        'SERVER_NAME': request.host.split(':')[0],
+        'SERVER_PORT': str(request.url.port or 80),
+        'SERVER_PROTOCOL': 'HTTP/%d.%d' % request.version,
+        'REMOTE_ADDR': request.remote or '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in request.headers.items():
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+            environ[key] = value
+
+    def call():
+        started = {}
+        def start_response(status, headers, exc_info=None):
+            started['status'] = status
+            started['headers'] = headers
+        result = kvs.app.wsgi_app(environ, start_response)
+        try:
+            data = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return started['status'], started['headers'], data
+
+    status, headers, data = await asyncio.get_event_loop().run_in_executor(EXECUTOR, call)
+    headers = [(name, value) for name, value in headers if name.lower() not in ('content-length', 'connection', 'transfer-encoding')]
+    return web.Response(body=data, status=int(status.split()[0]), headers=headers)
+
+
+"""
+Send a request to a peer and return (status, body, node), like transport.request does on a thread
+"""
+async def call_peer(kvs, session, node, method, path, params, deadline):
+    peer = transport.get_peer(node)
+    if not peer.allow_request():
+        raise transport.CircuitOpenError('circuit open for ' + node)
+    span = kvs.TRACER.start_call(node, method, path)
+    headers = transport.HEADERS if span is None else dict(transport.HEADERS, **span.headers)
+    start = time()
+    try:
+        timeout = aiohttp.ClientTimeout(total=peer.timeout(deadline))
+        async with session.request(method, 'http://' + node + path, params=params, headers=headers, timeout=timeout) as res:
+            body = await res.read()
+    except (asyncio.TimeoutError, aiohttp.ClientError):
+        peer.record_failure()
+        transport.record_call(node, time() - start, True)
+        if span is not None:
+            kvs.TRACER.finish_call(span, 'error')
+        raise
+    peer.record_success(time() - start)
+    transport.record_call(node, time() - start, False)
+    if span is not None:
+        kvs.TRACER.finish_call(span, res.status)
+    transport.notify(node, res)
+    return res.status, body, node
+
+
+def live_nodes(kvs, nodes):
+    return [node for node in nodes if transport.is_available(node) and not kvs.DETECTOR.is_dead(node)]
+
+
+"""
+Send the same request to the nodes at the same time and return (status, body, node) of the first answer that
+is not a 404, or (None, reachable, None) if there is none before the deadline. The other requests are cancelled,
+so only reads are sent this way
+"""
+async def scatter_gather(kvs, session, nodes, method, path, params, deadline=0.5):
+    tasks = [asyncio.ensure_future(call_peer(kvs, session, node, method, path, params, deadline)) for node in live_nodes(kvs, nodes)]
+    metrics.add_peer_calls(len(tasks))
+    reachable = False
+    try:
+        for next_done in asyncio.as_completed(tasks, timeout=deadline):
+            try:
+                status, body, node = await next_done
+            except asyncio.TimeoutError:
+                break
+            except Exception:
+                continue
+            reachable = True
+            if status != 404:
+                return status, body, node
+    finally:
+        for task in tasks:
+            task.cancel()
+    return None, reachable, None
+
+
+"""
+Read a key from the other members of its partition(see kvs.read_members) and return (status, body, node) like
+scatter_gather. The newest of the answers that arrived with the first one is returned, and once every member
+answered the stale ones are repaired in the background
+"""
+async def read_members(kvs, session, key, partition_id, nodes, values, deadline=0.5):
+    tasks = {asyncio.ensure_future(call_peer(kvs, session, node, 'GET', '/kvs/get_key', values, deadline)): node for node in live_nodes(kvs, nodes)}
+    metrics.add_peer_calls(len(tasks))
+    reachable = False
+    first = None
+    for next_done in asyncio.as_completed(tasks, timeout=deadline):
+        try:
+            status, body, node = await next_done
+        except asyncio.TimeoutError:
+            break
+        except Exception:
+            continue
+        reachable = True
+        if status != 404:
+            first = status, body, node
+            break
+    if first is None or first[0] != 200:
+        for task in tasks:
+            task.cancel()
+        return first or (None, reachable, None)
+    arrived = [(answer, kvs.result_entry(json.loads(answer[1].decode('utf-8')))) for answer in answers_of(tasks) if answer[0] == 200]
+    newest = reduce(kvs.choose_value, [entry for answer, entry in arrived])
+    repair = asyncio.ensure_future(repair_members(kvs, key, tasks, partition_id == kvs.view.get(kvs.IP_PORT), deadline))
+    BACKGROUND.add(repair)
+    repair.add_done_callback(BACKGROUND.discard)
+    return next(answer for answer, entry in arrived if entry is newest)
+
+
+"""
+Return (status, body, node) of the peer calls that finished without an error
+"""
+def answers_of(tasks):
+    return [task.result() for task in tasks if task.done() and not task.cancelled() and task.exception() is None]
+
+
+async def repair_members(kvs, key, tasks, local, deadline):
+    await asyncio.wait(list(tasks), timeout=deadline)
+    entries = {}
+    for status, body, node in answers_of(tasks):
+        if status == 200:
+            entries[node] = kvs.result_entry(json.loads(body.decode('utf-8')))
+        elif status == 404:
+            entries[node] = None
+    kvs.repair_members(key, entries, local)
+
+
+"""
+Send a request to one of the nodes and return (status, body, node), or (None, None, None) if none of them
+answered. The nodes are tried one after the other from the one start picks(see kvs.send_to_one)
+"""
+async def send_to_one(kvs, session, nodes, method, path, start, params, deadline=0.5):
+    live = live_nodes(kvs, nodes)
+    if live:
+        start %= len(live)
+    for node in live[start:] + live[:start]:
+        metrics.add_peer_calls(1)
+        try:
+            return await call_peer(kvs, session, node, method, path, params, deadline)
+        except (asyncio.TimeoutError, aiohttp.ClientError, transport.CircuitOpenError):
+            continue
+    return None, None, None
+
+
+"""
+Write a key locally and replicate it(see kvs.replicate) on the thread pool, so the event loop does not wait on
+DB_LOCK, nor on a full replication queue. With persistence on, the write also waits for its log record there
+"""
+async def write_local(kvs, key, val, causal_payload):
+    def write():
+        status = kvs.write_local(key, val, causal_payload)
+        kvs.replicate(key, 0, block=False)
+        kvs.STORAGE.wait(getattr(kvs.DURABILITY, 'ticket', 0))
+        kvs.DURABILITY.ticket = 0
+        return status
+    return await asyncio.get_event_loop().run_in_executor(EXECUTOR, write)
+
+
+def write_result(kvs, key):
+    entry = kvs.DB[key]
+    return {'msg': 'success', 'partition_id': kvs.view[kvs.IP_PORT], 'causal_payload': kvs.encode_clock(entry[1]), 'timestamp': str(entry[2])}
+
+
+"""
+Response to a read of a key in our DB. A value from the blob store is written to the socket straight from
+the mapping, after the other fields
+"""
+def read_response(kvs, key):
+    entry = kvs.DB[key]
+    fields = {'msg': 'success', 'partition_id': kvs.view[kvs.IP_PORT], 'causal_payload': kvs.encode_clock(entry[1]), 'timestamp': str(entry[2])}
+    if not isinstance(entry[0], kvs.BlobRef):
+        fields['value'] = str(entry[0])
+        return json_response(fields, 200)
+    head = json.dumps(fields)[:-1].encode('utf-8') + b', "value": '
+    return web.Response(body=body_parts(head, entry[0].read(), b'}'), status=200, content_type='application/json')
+
+
+async def body_parts(*parts):
+    for part in parts:
+        yield part
+
+
+"""
+Merge a batch of lines of a key transfer into DB and return the keys, on the thread pool so the event loop
+does not wait on DB_LOCK. The body is read as it arrives, so a transfer is not held by client_max_size
+"""
+def merge_entries(kvs, lines):
+    received = []
+    for replica in kvs.entry_batches(lines):
+        kvs.sync_database(replica)
+        received.extend(replica)
+    kvs.STORAGE.wait(getattr(kvs.DURABILITY, 'ticket', 0))
+    kvs.DURABILITY.ticket = 0
+    return received
+
+
+"""
+Catch up with the view of a node that sent us a request with a newer epoch(see kvs.check_view_epoch)
+"""
+async def check_view_epoch(kvs, request):
+    kvs.observe_epoch(request.headers.get('X-View-Epoch'), request.headers.get('X-Node'))
+    return await refresh_view(kvs)
+
+
+async def refresh_view(kvs):
+    if kvs.NEWEST_EPOCH[0] <= kvs.EPOCH:
+        return False
+    return await asyncio.get_event_loop().run_in_executor(EXECUTOR, kvs.refresh_view)
+
+
+"""
+True if a read or write asks more than one replica(see kvs.READ_QUORUM and kvs.WRITE_QUORUM)
+"""
+def wants_quorum(kvs, request, values, partition_id):
+    if request.method == 'GET':
+        return kvs.quorum_size(values, 'r', kvs.READ_QUORUM, partition_id) > 1
+    return kvs.quorum_size(values, 'w', kvs.WRITE_QUORUM, partition_id) > 1
+
+
+async def request_values(request):
+    values = dict(request.query)
+    if request.method in ('POST', 'PUT'):
+        values.update(await request.post())
+    return values
+
+
+"""
+Build the aiohttp application for the kvs module(the module object running as __main__)
+"""
+def make_app(kvs):
+    async def start_session(app):
+        app['session'] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0, limit_per_host=transport.POOL_SIZE))
+        kvs.activate_job()
+
+    async def close_session(app):
+        await app['session'].close()
+
+    async def add_view_epoch(request, response):
+        response.headers['X-View-Epoch'] = str(kvs.EPOCH)
+        response.headers['X-Node'] = str(kvs.IP_PORT)
+
+    async def forward(request):
+        return await wsgi_fallback(kvs, request)
+
+    #the routes handled by the Flask app are timed and traced there(see kvs.record_metrics)
+    @web.middleware
+    async def record_metrics(request, handler):
+        if request.match_info.handler is forward:
+            return await handler(request)
+        route = request.match_info.route.resource.canonical
+        start = time()
+        metrics.start_request()
+        span = kvs.TRACER.start_request(request.headers, request.method + ' ' + route)
+        response = await handler(request)
+        response.headers['Server-Timing'] = kvs.TRACER.finish_request(span, response.status)
+        response.headers['X-Trace-Id'] = span.trace_id
+        kvs.REQUEST_SECONDS.observe(time() - start, route, request.method, str(response.status))
+        kvs.PEER_CALLS_PER_REQUEST.observe(metrics.peer_calls(), route)
+        return response
+
+    async def get(request, values):
+        key = values.get('key', '')
+        if not kvs.is_key_valid(key):
+            return json_response({'msg': 'error', 'error': 'Key not valid'}, 404)
+        partition_id = kvs.get_owner_partition(key)
+        #a key of another partition in our DB may not have been moved yet(see kvs.get)
+        if key in kvs.DB and partition_id == kvs.view[kvs.IP_PORT]:
+            return read_response(kvs, key)
+        cached = kvs.cached_read(key, kvs.handle_empty_causal_payload(values.get('causal_payload', '')))
+        if cached is not None:
+            return web.Response(body=cached, status=200, content_type='application/json')
+        node = kvs.cached_location(key)
+        if node is not None:
+            status, body, node = await scatter_gather(kvs, request.app['session'], [node], 'GET', '/kvs/get_key', values)
+            if status == 200:
+                kvs.cache_read(key, body)
+                return web.Response(body=body, status=status, content_type='application/json')
+            kvs.forget_location(key)
+        nodes = [node for node in kvs.get_members(partition_id) if node != kvs.IP_PORT]
+        status, body, node = await read_members(kvs, request.app['session'], key, partition_id, nodes, values)
+        if status is not None:
+            kvs.remember_location(key, node)
+            if status == 200:
+                kvs.cache_read(key, body)
+            return web.Response(body=body, status=status, content_type='application/json')
+        if not body and partition_id != kvs.view[kvs.IP_PORT]:
+            return json_response({'msg': 'error', 'error': 'key value store is not available'}, 404)
+        #The key may not have been moved to its new owner yet, or it was moved while we were asking
+        if key in kvs.DB:
+            return read_response(kvs, key)
+        old_partition_ids = kvs.previous_owners(key)
+        for old_partition_id in old_partition_ids:
+            old_nodes = [node for node in kvs.get_members(old_partition_id) if node != kvs.IP_PORT]
+            status, body, node = await scatter_gather(kvs, request.app['session'], old_nodes, 'GET', '/kvs/get_key', values)
+            if status is not None:
+                kvs.remember_location(key, node)
+                return web.Response(body=body, status=status, content_type='application/json')
+        if old_partition_ids:
+            status, body, node = await scatter_gather(kvs, request.app['session'], nodes, 'GET', '/kvs/get_key', values)
+            if status is not None:
+                return web.Response(body=body, status=status, content_type='application/json')
+        #the owner may have changed in a view we have not seen yet
+        if await refresh_view(kvs):
+            return await get(request, values)
+        return json_response({'msg': 'error', 'error': 'key does not exist'}, 404)
+
+    async def put(request, values):
+        key = values.get('key', '')
+        if 'value' not in values:
+            return json_response({'msg': 'error', 'error': 'No value provided'}, 404)
+        if not kvs.is_key_valid(key):
+            return json_response({'msg': 'error', 'error': 'Key not valid'}, 404)
+        partition_id = kvs.get_owner_partition(key)
+        kvs.READ_CACHE.invalidate([key])
+        if partition_id == kvs.view[kvs.IP_PORT]:
+            causal_payload = kvs.handle_empty_causal_payload(values.get('causal_payload', ''))
+            status = await write_local(kvs, key, values['value'], causal_payload)
+            return json_response(write_result(kvs, key), status)
+        status, body, node = await send_to_one(kvs, request.app['session'], kvs.get_members(partition_id), 'PUT', '/kvs/add_key',
+                                               kvs.ring_position(key), values)
+        if status is None:
+            return json_response({'msg': 'error', 'error': 'key value store is not available'}, 404)
+        #the owner has a newer view than ours, route the write again with it
+        if status == 409 and await refresh_view(kvs):
+            return await put(request, values)
+        if status in (200, 201):
+            kvs.remember_location(key, node)
+        return web.Response(body=body, status=status, content_type='application/json')
+
+    async def kvs_route(request):
+        if request.method not in ('GET', 'POST', 'PUT'):
+            return await forward(request)
+        values = await request_values(request)
+        await check_view_epoch(kvs, request)
+        if kvs.is_key_valid(values.get('key', '')) and wants_quorum(kvs, request, values, kvs.get_owner_partition(values['key'])):
+            return await forward(request)
+        if request.method == 'GET':
+            return await get(request, values)
+        return await put(request, values)
+
+    async def get_key(request):
+        values = await request_values(request)
+        await check_view_epoch(kvs, request)
+        key = values.get('key', '')
+        if key not in kvs.DB:
+            return json_response({'msg': 'error', 'error': 'key does not exist'}, 404)
+        kvs.add_reader(key, request.headers)
+        return read_response(kvs, key)
+
+    async def add_key(request):
+        values = await request_values(request)
+        await check_view_epoch(kvs, request)
+        key = values['key']
+        if kvs.get_owner_partition(key) != kvs.view.get(kvs.IP_PORT):
+            return json_response({'msg': 'error', 'error': 'stale view', 'epoch': kvs.EPOCH}, 409)
+        if wants_quorum(kvs, request, values, kvs.view[kvs.IP_PORT]):
+            return await forward(request)
+        causal_payload = kvs.handle_empty_causal_payload(values.get('causal_payload', ''))
+        status = await write_local(kvs, key, values['value'], causal_payload)
+        return json_response(write_result(kvs, key), status)
+
+    async def receive_keys(request):
+        await check_view_epoch(kvs, request)
+        loop = asyncio.get_event_loop()
+        received = []
+        lines = []
+        try:
+            async for line in request.content:
+                lines.append(line)
+                if len(lines) >= kvs.TRANSFER_BATCH:
+                    received.extend(await loop.run_in_executor(EXECUTOR, merge_entries, kvs, lines))
+                    lines = []
+            received.extend(await loop.run_in_executor(EXECUTOR, merge_entries, kvs, lines))
+        except (ValueError, KeyError):
+            return json_response({'msg': 'error', 'error': 'malformed entry', 'received': received}, 400)
+        return json_response({'msg': 'success', 'received': received}, 200)
+
+    app = web.Application(client_max_size=kvs.app.config['MAX_CONTENT_LENGTH'], middlewares=[record_metrics])
+    app.on_startup.append(start_session)
+    app.on_cleanup.append(close_session)
+    app.on_response_prepare.append(add_view_epoch)
+    app.router.add_route('*', '/kvs', kvs_route)
+    app.router.add_route('*', '/kvs/get_key', get_key)
+    app.router.add_route('*', '/kvs/add_key', add_key)
+    app.router.add_route('PUT', '/kvs/receive_keys', receive_keys)
+    app.router.add_route('POST', '/kvs/receive_keys', receive_keys)
+    app.router.add_route('*', '/{tail:.*}', forward)
+    return app
+
+
+def run(kvs, host='0.0.0.0', port=8080):
+    if aiohttp is None:
+        sys.exit('SERVER=async needs aiohttp(pip install aiohttp)')
+    web.run_app(make_app(kvs), host=host, port=port, print=None)
@@ -0,0 +1,188 @@
+"""
+Micro-benchmarks of the hot helpers of kvs.py and of the end-to-end request paths on a local cluster
+(see cluster.py), compared with a stored baseline so a slower change is caught before it is rolled out.
+Helpers are timed in this process(kvs.py imported as a module, its background jobs are not started) with
+timeit: the best of several runs of a large batch of calls, less the same batch of calls of an empty function,
+in microseconds per call. Request paths are timed one request after the other from one client on a 4 node
+cluster with K=2, the median in milliseconds.
+
+python benchmarks.py                     run and compare with benchmarks_baseline.json
+python benchmarks.py --save              run and record the results as the baseline
+python benchmarks.py --micro             only the helpers(no cluster)
+
+A benchmark regresses when it is slower than the baseline by more than its threshold(0.5 is 50%), the script
+then exits with 1. The end-to-end times vary by about 30% between runs on the same machine, so --threshold
+is above that. The helpers vary by about 15% once the call overhead is taken out and have their own,
+lower --micro-threshold. Baselines are only comparable on the machine they were recorded on, so
+benchmarks_baseline.json is not in the repository: record one with --save on the machine that runs the comparison
+"""
+import os
+import sys
+import json
+import argparse
+import platform
+import timeit
+from itertools import repeat as repeated
+from statistics import median
+from time import perf_counter
+import requests
+import kvs
+from cluster import LocalCluster
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks_baseline.json')
+
+
+"""
+Number of calls of a helper in a timed run. A sub-microsecond call is lost in the timer resolution and in
+the noise of a short run, a large batch is not
+"""
+BATCH = 100000
+
+
+"""
+Time of one run of number calls of fn in seconds. setup(number) runs before it, untimed, and returns the
+arguments of the calls
+"""
+def run_once(fn, number, setup=None):
+    calls = iter(setup(number)) if setup else repeated((), number)
+    return timeit.timeit(lambda: fn(*next(calls)), number=number)
+
+
+"""
+Best time of repeat runs of number calls of fn, in microseconds per call, less the time of the same runs of
+an empty function: the loop, the call and getting the arguments are not part of what is measured
+"""
+def best_of(fn, number=BATCH, repeat=10, setup=None):
+    best = min(run_once(fn, number, setup) for _ in range(repeat))
+    empty = min(run_once(lambda *args: None, number, setup) for _ in range(repeat))
+    return max(best - empty, 0) / number * 1e6
+
+
+def micro_benchmarks():
+    kvs.NUMBER_OF_REPLICAS = 3
+    kvs.view.clear()
+    kvs.view.update({'10.0.0.%d:8080' % (20 + i): i // 3 for i in range(12)})
+    kvs.IP_PORT = '10.0.0.20:8080'
+    results = {}
+    ordered = ((3, 1, 4, 1), (3, 2, 4, 1))
+    concurrent = ((3, 1, 4, 1), (2, 7, 4, 1))
+    results['compare_casual_payloads ordered'] = best_of(lambda: kvs.compare_casual_payloads(*ordered))
+    results['compare_casual_payloads concurrent'] = best_of(lambda: kvs.compare_casual_payloads(*concurrent))
+    older = ['value', (1, 0, 2), 100.0]
+    newer = ['value', (1, 1, 2), 101.0]
+    tied = ['other', (0, 1, 2), 102.0]
+    results['choose_value ordered'] = best_of(lambda: kvs.choose_value(older, newer))
+    results['choose_value concurrent'] = best_of(lambda: kvs.choose_value(older, tied))
+    results['get_members'] = best_of(lambda: kvs.get_members(2))
+    results['is_key_valid'] = best_of(lambda: kvs.is_key_valid('user_1234567890_profile'))
+    results['is_key_valid invalid'] = best_of(lambda: kvs.is_key_valid('user-1234567890-profile'))
+    #every run merges 1000 entries newer than the ones in DB
+    rounds = [0]
+    def replicas(number):
+        start = rounds[0]
+        rounds[0] += number
+        return [({'key%d' % i: ['v' * 100, [round_ + 1, 0, 0], float(round_)] for i in range(1000)},)
+                for round_ in range(start, start + number)]
+    results['sync_database 1000 entries'] = best_of(kvs.sync_database, 5, repeat=20, setup=replicas)
+    return {name: round(value, 3) for name, value in results.items()}
+
+
+"""
+Median time of a request over count requests, in milliseconds. Raise if one answers another status than expected
+"""
+def time_requests(send, count, expected=(200, 201)):
+    times = []
+    for i in range(count):
+        start = perf_counter()
+        res = send(i)
+        times.append(perf_counter() - start)
+        if res.status_code not in expected:
+            raise RuntimeError('%s answered %d: %s' % (res.url, res.status_code, res.text[:200]))
+    return median(times) * 1000
+
+
+def end_to_end_benchmarks(count):
+    results = {}
+    with LocalCluster(4, 2, base_port=int(os.getenv('BENCHMARK_PORT', 9100))) as cluster:
+        session = requests.Session()
+        node = 'http://' + cluster.nodes[0]
+        keys = ['bench%d' % i for i in range(count)]
+        put = lambda i: session.put(node + '/kvs', data={'key': keys[i], 'value': 'v' * 100, 'causal_payload': ''})
+        get = lambda i: session.get(node + '/kvs', params={'key': keys[i], 'causal_payload': ''})
+        #keys of both partitions: about half of the requests are forwarded to the other one
+        results['put'] = time_requests(put, count)
+        results['get'] = time_requests(get, count)
+        results['get missing'] = time_requests(lambda i: session.get(node + '/kvs', params={'key': 'missing%d' % i, 'causal_payload': ''}),
+                                               count, expected=(404,))
+        entries = [[{'key': 'batch%d_%d' % (i, j), 'value': 'v' * 100, 'causal_payload': ''} for j in range(100)] for i in range(count // 10)]
+        results['mput 100 keys'] = time_requests(lambda i: session.put(node + '/kvs/mput', json={'entries': entries[i]}), count // 10)
+        results['mget 100 keys'] = time_requests(
+            lambda i: session.post(node + '/kvs/mget', json={'keys': [entry['key'] for entry in entries[i]]}), count // 10)
+        results['get_number_of_keys'] = time_requests(lambda i: session.get(node + '/kvs/get_number_of_keys'), count // 10)
+    return {name: round(value, 3) for name, value in results.items()}
+
+
+"""
+Compare results with a baseline: [(name, baseline, current, ratio, regressed)] of the benchmarks in both
+"""
+def compare(baseline, results, threshold):
+    rows = []
+    for name, current in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        ratio = current / base
+        rows.append((name, base, current, ratio, ratio > 1 + threshold))
+    return rows
+
+
+def print_report(rows, units):
+    print('%-40s %12s %12s %8s' % ('benchmark', 'baseline', 'current', 'ratio'))
+    for name, base, current, ratio, regressed in rows:
+        print('%-40s %9.3f %-2s %9.3f %-2s %7.2fx%s' % (name, base, units[name], current, units[name], ratio,
+                                                       '  REGRESSION' if regressed else ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of kvs.py compared with a baseline')
+    parser.add_argument('--save', action='store_true', help='record the results as the baseline')
+    parser.add_argument('--micro', action='store_true', help='only the micro-benchmarks')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--threshold', type=float, default=0.5, help='slowdown of an end-to-end benchmark that is a regression')
+    parser.add_argument('--micro-threshold', type=float, default=0.25, help='slowdown of a micro-benchmark that is a regression')
+    parser.add_argument('--requests', type=int, default=200, help='requests of every end-to-end benchmark')
+    parser.add_argument('--output', help='also write the results and the comparison as json to this file')
+    args = parser.parse_args(argv)
+    results = {'micro': micro_benchmarks()}
+    if not args.micro:
+        results['end_to_end'] = end_to_end_benchmarks(args.requests)
+    units = dict({name: 'us' for name in results['micro']}, **{name: 'ms' for name in results.get('end_to_end', {})})
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': platform.platform(), 'python': platform.python_version(), 'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return 0
+    if not os.path.exists(args.baseline):
+        print('no baseline at %s, record one with --save' % args.baseline)
+        return 1
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows = (compare(baseline['results'].get('micro', {}), results['micro'], args.micro_threshold) +
+            compare(baseline['results'].get('end_to_end', {}), results.get('end_to_end', {}), args.threshold))
+    print_report(rows, units)
+    regressions = [row[0] for row in rows if row[4]]
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'results': results, 'baseline': baseline, 'regressions': regressions,
+                       'ratios': {row[0]: round(row[3], 3) for row in rows}}, f, indent=2, sort_keys=True)
+    if regressions:
+        print('%d regression(s) over %d%%(micro) or %d%%(end-to-end): %s' % (len(regressions), args.micro_threshold * 100,
+                                                                           args.threshold * 100, ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,105 @@
+"""
+Append-only, memory-mapped store for large values. DB only keeps a small BlobRef(offset and length in
+the file) for a large value, and a read slices the json encoded value straight out of the mapping, so a
+GET does not decode and re-encode it. The file is unlinked as soon as it is created: it only lives as
+long as the node and the BlobRefs pointing into it, durability is the job of storage.py.
+"""
+import json
+import mmap
+import hashlib
+import tempfile
+import threading
+
+
+"""
+Where a value lives in a BlobStore. digest is the md5 of the json encoded value, so the value can be
+compared and hashed without reading it
+"""
+class BlobRef:
+
+    __slots__ = ('store', 'offset', 'length', 'digest')
+
+    def __init__(self, store, offset, length, digest):
+        self.store = store
+        self.offset = offset
+        self.length = length
+        self.digest = digest
+
+    """
+    Return the json encoded value(including the quotes) as a memoryview of the mapping, it is not copied
+    """
+    def read(self):
+        return self.store.read(self.offset, self.length)
+
+    def value(self):
+        return json.loads(str(self.read(), 'utf-8'))
+
+
+class BlobStore:
+
+    def __init__(self, directory=None, capacity=16*1024*1024):
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.file.truncate(capacity)
+        self.mm = mmap.mmap(self.file.fileno(), capacity)
+        self.end = 0
+        self.live = 0
+        self.lock = threading.Lock()
+
+    """
+    Append a value and return its BlobRef
+    """
+    def put(self, value):
+        data = json.dumps(value).encode('utf-8')
+        return self.append(data, hashlib.md5(data).hexdigest())
+
+    def append(self, data, digest):
+        with self.lock:
+            if self.end + len(data) > len(self.mm):
+                self.grow(self.end + len(data))
+            offset = self.end
+            self.mm[offset:offset+len(data)] = data
+            self.end += len(data)
+            self.live += len(data)
+        return BlobRef(self, offset, len(data), digest)
+
+    """
+    Double the file until needed bytes fit. The old mapping is left to readers that still use it
+    """
+    def grow(self, needed):
+        size = len(self.mm)
+        while size < needed:
+            size *= 2
+        self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), size)
+
+    """
+    Return a memoryview of length bytes at offset. It keeps the mapping it was taken from alive after grow
+    """
+    def read(self, offset, length):
+        return memoryview(self.mm)[offset:offset+length]
+
+    """
+    Mark the space of a value that is no longer referenced as garbage
+    """
+    def free(self, ref):
+        with self.lock:
+            self.live -= ref.length
+
+    def garbage(self):
+        return self.end - self.live
+
+    """
+    Copy the values of refs into a new store and return it with {old ref: new ref}
+    """
+    def compact(self, refs, directory=None):
+        store = BlobStore(directory, capacity=max(self.live, 1024*1024))
+        return store, {ref: store.append(ref.read(), ref.digest) for ref in refs}
+
+
+"""
+Return the digest of a value, whether it is stored in DB or in a BlobStore
+"""
+def value_digest(value):
+    if isinstance(value, BlobRef):
+        return value.digest
+    return hashlib.md5(json.dumps(value).encode('utf-8')).hexdigest()
@@ -0,0 +1,131 @@
+"""
+Run a cluster of kvs.py processes on localhost, without docker. Node i listens on 127.0.0.1:base_port+i,
+every node gets the whole view in VIEW, K and its own ip_port, like the containers test_HW4.py starts.
+Every node runs in a process group of its own so stopping the cluster also stops the child the Flask
+reloader starts in debug mode, and its output goes to a log file in log_dir(created if it does not exist).
+
+e.g. python cluster.py --nodes 4 --k 2            runs the cluster until ctrl-c
+     with LocalCluster(4, 2) as cluster: ...     from python(see benchmarks.py)
+"""
+import os
+import sys
+import signal
+import argparse
+import subprocess
+import tempfile
+from time import time, sleep
+import requests
+
+
+KVS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kvs.py')
+
+
+class LocalCluster:
+
+    """
+    env is added to the environment of every node(e.g. {'SERVER': 'async'}). With data_dir set, node i
+    persists its database in data_dir/node<i>
+    """
+    def __init__(self, nodes, k, base_port=9000, env=None, data_dir=None, log_dir=None, python=sys.executable):
+        self.nodes = ['127.0.0.1:%d' % (base_port + i) for i in range(1, nodes + 1)]
+        self.k = k
+        self.env = dict(env or {})
+        self.data_dir = data_dir
+        self.log_dir = log_dir or tempfile.mkdtemp(prefix='kvs_cluster_')
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.python = python
+        self.processes = []
+
+    def start(self, timeout=30):
+        for i, node in enumerate(self.nodes, 1):
+            env = dict(os.environ, ip_port=node, VIEW=','.join(self.nodes), K=str(self.k), **self.env)
+            if self.data_dir:
+                env['DATA_DIR'] = os.path.join(self.data_dir, 'node%d' % i)
+            with open(os.path.join(self.log_dir, 'node%d.log' % i), 'w') as log:
+                self.processes.append(subprocess.Popen([self.python, KVS], env=env, cwd=os.path.dirname(KVS), stdout=log,
+                                                       stderr=subprocess.STDOUT, start_new_session=True))
+        try:
+            self.wait_ready(timeout)
+        except Exception:
+            self.stop()
+            raise
+        return self
+
+    """
+    Wait until every node answers, raise RuntimeError if one exited or the timeout passed
+    """
+    def wait_ready(self, timeout):
+        deadline = time() + timeout
+        waiting = list(self.nodes)
+        while waiting:
+            for i, process in enumerate(self.processes, 1):
+                if process.poll() is not None:
+                    raise RuntimeError('node %d exited with %d, see %s' % (i, process.returncode, self.log_dir))
+            node = waiting[0]
+            try:
+                requests.get('http://' + node + '/kvs/get_all_partition_ids', timeout=1)
+                waiting.pop(0)
+                continue
+            except requests.exceptions.RequestException:
+                pass
+            if time() > deadline:
+                raise RuntimeError('node %s did not start in %s seconds, see %s' % (node, timeout, self.log_dir))
+            sleep(0.1)
+
+    """
+    Stop a node(e.g. to test a failure), its port stays in the view of the others. A node that is still running
+    timeout seconds after sig gets SIGKILL
+    """
+    def kill(self, node, sig=signal.SIGTERM, timeout=5):
+        process = self.processes[self.nodes.index(node)]
+        if process.poll() is None:
+            os.killpg(process.pid, sig)
+            try:
+                process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+
+    def stop(self, timeout=5):
+        for process in self.processes:
+            if process.poll() is None:
+                os.killpg(process.pid, signal.SIGTERM)
+        deadline = time() + timeout
+        for process in self.processes:
+            try:
+                process.wait(max(0, deadline - time()))
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+        self.processes = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a local cluster of kvs.py processes')
+    parser.add_argument('--nodes', type=int, default=4)
+    parser.add_argument('--k', type=int, default=2, help='replicas per partition')
+    parser.add_argument('--base-port', type=int, default=9000)
+    parser.add_argument('--data-dir', help='persist the database of every node under this directory')
+    parser.add_argument('--env', action='append', default=[], help='NAME=VALUE added to the environment of every node')
+    args = parser.parse_args(argv)
+    env = dict(pair.split('=', 1) for pair in args.env)
+    cluster = LocalCluster(args.nodes, args.k, args.base_port, env, args.data_dir)
+    #stop the nodes on kill too
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    with cluster:
+        print('nodes: ' + ','.join(cluster.nodes))
+        print('logs: ' + cluster.log_dir)
+        try:
+            signal.pause()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
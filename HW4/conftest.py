@@ -0,0 +1,30 @@
+"""
+Fixtures of the unit tests of the HW4 modules(python -m pytest in this directory). test_HW4.py is the
+end-to-end test of the assignment, it runs against docker containers with python 2 and is not collected
+"""
+from collections import deque
+import pytest
+import kvs
+from merkle import MerkleTree
+
+
+collect_ignore = ['test_HW4.py']
+
+
+"""
+kvs.py with an empty database and change log and a view of 2 partitions of 2 nodes, current node is the
+first node of partition 0
+"""
+@pytest.fixture
+def node(monkeypatch):
+    monkeypatch.setattr(kvs, 'DB', {})
+    monkeypatch.setattr(kvs, 'DB_BYTES', 0)
+    monkeypatch.setattr(kvs, 'MERKLE_TREE', MerkleTree())
+    monkeypatch.setattr(kvs, 'CHANGE_LOG', deque(maxlen=100))
+    monkeypatch.setattr(kvs, 'SEQUENCE', 0)
+    monkeypatch.setattr(kvs, 'NUMBER_OF_REPLICAS', 2)
+    monkeypatch.setattr(kvs, 'IP_PORT', '10.0.0.20:8080')
+    monkeypatch.setattr(kvs, 'view', {'10.0.0.20:8080': 0, '10.0.0.21:8080': 0, '10.0.0.22:8080': 1, '10.0.0.23:8080': 1})
+    monkeypatch.setattr(kvs, 'RING', kvs.make_ring([0, 1]))
+    monkeypatch.setattr(kvs, 'PREVIOUS_RINGS', [])
+    return kvs
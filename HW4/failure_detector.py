@@ -0,0 +1,251 @@
+"""
+SWIM-style failure detector. Every PROBE_INTERVAL seconds a node pings one peer(round robin in a random
+order). If the peer does not answer, INDIRECT_PROBES other peers are asked to ping it for us, so a slow link
+between two nodes does not make one of them look dead. A peer nobody can reach becomes suspect, and dead
+SUSPECT_TIMEOUT seconds later unless it shows up again. Status changes are piggybacked on the pings(gossip),
+and a node that hears it is suspected refutes it by raising its incarnation number.
+"""
+import os
+import random
+import threading
+from time import sleep, time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+import requests
+import transport
+
+
+"""
+Number of seconds between two probes, and the time a peer has to answer a ping
+"""
+PROBE_INTERVAL = float(os.getenv('PROBE_INTERVAL', 1))
+PROBE_TIMEOUT = float(os.getenv('PROBE_TIMEOUT', 0.3))
+
+
+"""
+Number of peers asked to ping a peer that did not answer our own ping
+"""
+INDIRECT_PROBES = int(os.getenv('INDIRECT_PROBES', 3))
+
+
+"""
+Number of seconds a peer stays suspect before it is declared dead
+"""
+SUSPECT_TIMEOUT = float(os.getenv('SUSPECT_TIMEOUT', 5))
+
+
+"""
+Maximum number of status updates piggybacked on a ping, and number of times each update is sent
+"""
+GOSSIP_SIZE = int(os.getenv('GOSSIP_SIZE', 8))
+GOSSIP_RETRANSMIT = int(os.getenv('GOSSIP_RETRANSMIT', 6))
+
+
+ALIVE = 'alive'
+SUSPECT = 'suspect'
+DEAD = 'dead'
+
+
+class Member:
+
+    __slots__ = ('status', 'incarnation', 'since')
+
+    def __init__(self, status, incarnation):
+        self.status = status
+        self.incarnation = incarnation
+        self.since = time()
+
+
+class FailureDetector:
+
+    """
+    members() returns the peers to watch(it is called every round, so the view can change under us)
+    """
+    def __init__(self, members):
+        self.members_fn = members
+        self.me = None
+        self.incarnation = 0
+        self.members = {}
+        #status updates still to be gossiped {node: [status, incarnation, sends left]}
+        self.updates = {}
+        self.order = []
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=INDIRECT_PROBES + 1)
+
+    def start(self, me):
+        self.me = me
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def status(self, node):
+        member = self.members.get(node)
+        return ALIVE if member is None else member.status
+
+    def is_dead(self, node):
+        return self.status(node) == DEAD
+
+    """
+    Return the status of every peer for debugging
+    """
+    def statuses(self):
+        with self.lock:
+            return {node: {'status': m.status, 'incarnation': m.incarnation, 'since': m.since} for node, m in self.members.items()}
+
+    def run(self):
+        while True:
+            try:
+                target = self.next_target()
+                if target is not None:
+                    self.probe(target)
+                self.expire()
+            except Exception:
+                pass
+            sleep(PROBE_INTERVAL)
+
+    """
+    Return the next peer to probe. Every peer is probed once per round, in a new random order every round
+    """
+    def next_target(self):
+        peers = [node for node in self.members_fn() if node != self.me]
+        with self.lock:
+            for node in list(self.members):
+                if node not in peers:
+                    del self.members[node]
+                    self.updates.pop(node, None)
+            for node in peers:
+                if node not in self.members:
+                    self.members[node] = Member(ALIVE, 0)
+        self.order = [node for node in self.order if node in peers]
+        if not self.order:
+            self.order = peers[:]
+            random.shuffle(self.order)
+        return self.order.pop() if self.order else None
+
+    def probe(self, target):
+        if self.ping(target):
+            return
+        helpers = [node for node in self.members_fn() if node not in (self.me, target) and self.status(node) == ALIVE]
+        helpers = random.sample(helpers, min(INDIRECT_PROBES, len(helpers)))
+        futures = [self.pool.submit(self.ping_req, helper, target) for helper in helpers]
+        try:
+            for future in as_completed(futures, timeout=2*PROBE_TIMEOUT + 0.1):
+                if future.result():
+                    return
+        except TimeoutError:
+            pass
+        member = self.members.get(target)
+        if member is not None:
+            self.set_status(target, SUSPECT, member.incarnation)
+
+    """
+    Ping a peer directly. Return True if it answered
+    """
+    def ping(self, target):
+        try:
+            res = transport.put(target, '/kvs/ping', json=self.message(), timeout=PROBE_TIMEOUT, adaptive=False)
+        except requests.exceptions.RequestException:
+            return False
+        if res.status_code != 200:
+            return False
+        values = res.json()
+        self.merge(values['updates'])
+        self.heard_from(target, values['incarnation'])
+        return True
+
+    """
+    Ask helper to ping target for us. Return True if target answered the helper
+    """
+    def ping_req(self, helper, target):
+        message = self.message()
+        message['target'] = target
+        try:
+            res = transport.put(helper, '/kvs/ping_req', json=message, timeout=2*PROBE_TIMEOUT, adaptive=False)
+        except requests.exceptions.RequestException:
+            return False
+        if res.status_code != 200:
+            return False
+        values = res.json()
+        self.merge(values['updates'])
+        return values['ack']
+
+    """
+    Handle a ping(or the gossip of a ping_req) from another node and return our answer
+    """
+    def handle_ping(self, message):
+        self.merge(message['updates'])
+        self.heard_from(message['from'], message['incarnation'])
+        return {'incarnation': self.incarnation, 'updates': self.gossip()}
+
+    def message(self):
+        return {'from': self.me, 'incarnation': self.incarnation, 'updates': self.gossip()}
+
+    """
+    Return the updates to piggyback on the next message, the ones sent the least often first
+    """
+    def gossip(self):
+        with self.lock:
+            chosen = sorted(self.updates.items(), key=lambda item: -item[1][2])[:GOSSIP_SIZE]
+            for node, update in chosen:
+                update[2] -= 1
+                if update[2] <= 0:
+                    del self.updates[node]
+            return [[node, update[0], update[1]] for node, update in chosen]
+
+    """
+    Apply status updates gossiped by another node. An update only replaces what we know if it is newer:
+    a higher incarnation, or a worse status with the same incarnation
+    """
+    def merge(self, updates):
+        for node, status, incarnation in updates:
+            if node == self.me:
+                if status != ALIVE and incarnation >= self.incarnation:
+                    #refute the suspicion
+                    with self.lock:
+                        self.incarnation = incarnation + 1
+                        self.updates[self.me] = [ALIVE, self.incarnation, GOSSIP_RETRANSMIT]
+                continue
+            member = self.members.get(node)
+            if member is None:
+                continue
+            if incarnation > member.incarnation or (incarnation == member.incarnation and rank(status) > rank(member.status)):
+                self.set_status(node, status, incarnation)
+
+    """
+    A peer answered us or sent us something: whatever we heard about it before, it is alive
+    """
+    def heard_from(self, node, incarnation=None):
+        member = self.members.get(node)
+        if member is None:
+            return
+        incarnation = member.incarnation if incarnation is None else max(incarnation, member.incarnation)
+        if member.status != ALIVE or incarnation > member.incarnation:
+            self.set_status(node, ALIVE, incarnation)
+
+    def set_status(self, node, status, incarnation):
+        with self.lock:
+            member = self.members.get(node)
+            if member is None:
+                return
+            changed = member.status != status
+            member.incarnation = incarnation
+            if changed:
+                member.status = status
+                member.since = time()
+            self.updates[node] = [status, incarnation, GOSSIP_RETRANSMIT]
+        if changed:
+            for listener in self.listeners:
+                listener(node, status)
+
+    """
+    Declare dead the peers that have been suspect for too long
+    """
+    def expire(self):
+        now = time()
+        for node, member in list(self.members.items()):
+            if member.status == SUSPECT and now - member.since >= SUSPECT_TIMEOUT:
+                self.set_status(node, DEAD, member.incarnation)
+
+
+def rank(status):
+    return {ALIVE: 0, SUSPECT: 1, DEAD: 2}[status]
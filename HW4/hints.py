@@ -0,0 +1,114 @@
+"""
+Hinted handoff. A write that could not reach a replica(it is dead or did not answer) is kept here as a hint
+for that replica, and sent to it once it is reachable again, so a replica that was away only receives the
+writes it missed. Hints of the same key for the same replica are coalesced into the newest one, and there
+are at most limit hints: the oldest hints of the replica with the most are dropped first, anti-entropy
+still brings it up to date. With persistence on, hints are logged to their own storage(see storage.py)
+"""
+import threading
+from collections import OrderedDict
+import storage
+
+
+class HintStore:
+
+    def __init__(self, limit):
+        self.limit = limit
+        #{node: {key: entry}}, oldest hint first
+        self.hints = {}
+        self.count = 0
+        self.replaying = set()
+        self.storage = storage.MemoryStorage()
+        self.lock = threading.Lock()
+
+    """
+    Load the hints kept in a storage and log the next ones to it
+    """
+    def open(self, hint_storage):
+        self.storage = hint_storage
+        with self.lock:
+            for name, entry in hint_storage.load().items():
+                node, key = name.split('/', 1)
+                self.hints.setdefault(node, OrderedDict())[key] = entry
+                self.count += 1
+
+    def add(self, node, key, entry):
+        with self.lock:
+            hints = self.hints.setdefault(node, OrderedDict())
+            if hints.pop(key, None) is None:
+                self.count += 1
+            hints[key] = entry
+            self.storage.log_put(node + '/' + key, entry)
+            while self.count > self.limit:
+                largest = max(self.hints, key=lambda node: len(self.hints[node]))
+                self.discard(largest, next(iter(self.hints[largest])))
+
+    """
+    Return the oldest size hints of a node [(key, entry)]
+    """
+    def batch(self, node, size):
+        with self.lock:
+            hints = self.hints.get(node, {})
+            return [(key, hints[key]) for key, _ in zip(hints, range(size))]
+
+    """
+    Remove hints that were delivered, unless the key got a newer hint in the meantime
+    """
+    def remove(self, node, delivered):
+        with self.lock:
+            hints = self.hints.get(node, {})
+            for key, entry in delivered:
+                if hints.get(key) is entry:
+                    self.discard(node, key)
+
+    """
+    Remove every hint of a node(it left the view)
+    """
+    def drop(self, node):
+        with self.lock:
+            for key in list(self.hints.get(node, ())):
+                self.discard(node, key)
+
+    """
+    Remove a hint, the lock must be held
+    """
+    def discard(self, node, key):
+        hints = self.hints[node]
+        del hints[key]
+        self.count -= 1
+        self.storage.log_delete(node + '/' + key)
+        if not hints:
+            del self.hints[node]
+
+    def nodes(self):
+        with self.lock:
+            return list(self.hints)
+
+    """
+    Only one replay of the hints of a node at a time. Return False if one is running already
+    """
+    def start_replay(self, node):
+        with self.lock:
+            if node in self.replaying:
+                return False
+            self.replaying.add(node)
+            return True
+
+    def finish_replay(self, node):
+        with self.lock:
+            self.replaying.discard(node)
+
+    """
+    Snapshot the hints when their log is long enough(see DiskStorage.snapshot)
+    """
+    def compact(self):
+        def rotate():
+            with self.lock:
+                hints = {node + '/' + key: entry for node, entries in self.hints.items() for key, entry in entries.items()}
+                return hints, self.storage.start_segment()
+        if self.storage.should_snapshot():
+            self.storage.snapshot(rotate)
+
+    def status(self):
+        with self.lock:
+            return {node: len(hints) for node, hints in self.hints.items()}
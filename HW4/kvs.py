@@ -1,11 +1,30 @@
 import re
+import sys
 import os
 from time import sleep, time
 import random
 import json
+import hashlib
+import uuid
+from collections import deque, OrderedDict
+from itertools import islice, zip_longest
+from functools import lru_cache, reduce
+from bisect import bisect_right
+from urllib.parse import urlsplit
 import requests
 import threading
-from flask import Flask, request, jsonify, make_response
+import transport
+import storage
+import failure_detector
+import metrics
+import tracing
+from merkle import MerkleTree
+from blob_store import BlobStore, BlobRef
+from read_cache import ReadCache
+from hints import HintStore
+from replication import ReplicationQueue
+from concurrent.futures import as_completed, TimeoutError
+from flask import Flask, Response, request, jsonify, make_response, g
 
 app = Flask(__name__)
 #Set the size limit to 1.5MB
@@ -31,12 +50,96 @@ IP_PORT = None
 DB is our database. each key/value pair is stored as {key:[value, causal_payload, timestamp]} 
 NOTE: 
 Causal payload(vector clock) is used establish causality between events. 
-e.g. [1,0,0,0] (NOTE: the number of integer in the list is the number of replicas)
+e.g. (1,0,0,0) (NOTE: the number of integer in the tuple is the number of replicas)
+It is kept as a tuple of integers and only turned into the dotted string '1.0.0.0' for clients(see encode_clock)
 Timestamp is the wall clock time on the replica that first processed the write.
 """
 DB = {}
 
 
+"""
+Total size of the values in DB(see entry_size), kept up to date by set_entry and delete_entry
+"""
+DB_BYTES = 0
+
+
+"""
+Lock held while DB and the structures derived from it(e.g. MERKLE_TREE) are changed together
+"""
+DB_LOCK = threading.RLock()
+
+
+"""
+Where DB is persisted(see storage.py). Persistence is on when the DATA_DIR environment variable is set
+"""
+STORAGE = storage.MemoryStorage()
+
+
+"""
+String values longer than BLOB_THRESHOLD characters are kept in BLOB_STORE, a memory-mapped file, and DB only 
+holds their BlobRef. The store is created on the first large value and compacted by anti-entropy once 
+more than BLOB_COMPACT_BYTES of it are overwritten values
+"""
+BLOB_THRESHOLD = int(os.getenv('BLOB_THRESHOLD', 64*1024))
+BLOB_COMPACT_BYTES = int(os.getenv('BLOB_COMPACT_BYTES', 64*1024*1024))
+BLOB_STORE = None
+
+
+"""
+A WSGI server only writes bytes, so a value of the blob store is copied out of the mapping STREAM_CHUNK bytes
+at a time as the response is written(see value_response), never into a whole response body
+"""
+STREAM_CHUNK = int(os.getenv('STREAM_CHUNK', 64*1024))
+
+
+"""
+Remembers, for the thread handling a request, the log record its response has to wait for(see wait_durable)
+"""
+DURABILITY = threading.local()
+
+
+"""
+Merkle tree over the keys in DB, updated on every write(see set_entry). Anti-entropy compares the trees of 
+two replicas and only transfers the buckets where they differ
+"""
+MERKLE_TREE = MerkleTree(fanout=int(os.getenv('MERKLE_FANOUT', 16)), depth=int(os.getenv('MERKLE_DEPTH', 2)))
+
+
+"""
+Bounded log of the latest changes to DB as (sequence number, key), so a replica can pull only what changed
+since its last sync. SEQUENCE is the sequence number of the latest change and LOG_ID identifies this run
+of the node, since sequence numbers start over when a node restarts
+"""
+CHANGE_LOG = deque(maxlen=int(os.getenv('CHANGE_LOG_SIZE', 100000)))
+SEQUENCE = 0
+LOG_ID = uuid.uuid4().hex
+
+
+"""
+The position we have pulled up to in the change log of every other replica {ip_port: (log_id, sequence)}
+"""
+PEER_SEQUENCE = {}
+
+
+"""
+Maximum number of keys returned by one delta sync response
+"""
+DELTA_BATCH = int(os.getenv('DELTA_BATCH', 5000))
+
+
+"""
+Every MERKLE_EVERY rounds anti-entropy compares Merkle trees even if the change logs say we are up to date
+"""
+MERKLE_EVERY = int(os.getenv('MERKLE_EVERY', 20))
+
+
+"""
+Number of seconds between two anti-entropy rounds. Reads that touch several replicas repair the ones that are
+behind(see read_repair), so the interval can be longer when most keys are read with a quorum
+"""
+SYNC_INTERVAL = float(os.getenv('SYNC_INTERVAL', 3))
+
+
 """
 An integer to store the maximum number of replicas in a cluster
 """
@@ -49,6 +152,215 @@ A list to store the partiton members
 PARTITION_MEMBERS = None
 
 
+"""
+Number of points each partition gets on the consistent hash ring. More virtual nodes
+spread the keys more evenly between partitions
+"""
+VIRTUAL_NODES = int(os.getenv('VIRTUAL_NODES', 64))
+
+
+"""
+The consistent hash ring built from the partition ids in view, stored as two parallel sorted lists
+(ring positions, partition ids). It is rebuilt every time the view changes
+"""
+RING = ([], [])
+
+
+"""
+The rings of recent views [(ring, time until which it is used)]. While keys move to their new owner in the
+background, a key that its owner does not have yet is looked up at the partitions that owned it before
+"""
+PREVIOUS_RINGS = []
+
+
+"""
+Number of seconds a node keeps looking up keys at their owner in an older view(see PREVIOUS_RINGS)
+"""
+MIGRATION_GRACE = float(os.getenv('MIGRATION_GRACE', 300))
+
+
+"""
+Number of keys per second the rebalancer moves to their new owner(0 for no limit), and per transfer
+"""
+MIGRATION_RATE = float(os.getenv('MIGRATION_RATE', 2000))
+MIGRATION_BATCH = int(os.getenv('MIGRATION_BATCH', 200))
+
+
+"""
+Progress of the rebalancer of current node(see rebalance_job)
+"""
+MIGRATION = {'state': 'idle', 'started': None, 'finished': None, 'total_keys': 0, 'moved_keys': 0, 'bytes': 0, 'failed_batches': 0, 'restart': False}
+MIGRATION_LOCK = threading.Lock()
+
+
+"""
+Epoch of our view. Every view change increments it, so two nodes can tell whose view is newer.
+It is sent with every request and response between nodes in the X-View-Epoch header
+"""
+EPOCH = 0
+VIEW_LOCK = threading.RLock()
+
+
+"""
+The newest epoch another node told us about and that node [epoch, ip_port](see refresh_view)
+"""
+NEWEST_EPOCH = [0, None]
+CATCH_UP_LOCK = threading.Lock()
+
+
+"""
+Number of seconds a node has to acknowledge a view change
+"""
+VIEW_TIMEOUT = float(os.getenv('VIEW_TIMEOUT', 3))
+
+
+"""
+Number of times a coordinator makes a view change again after it lost a conflict with another coordinator
+"""
+VIEW_CHANGE_ATTEMPTS = int(os.getenv('VIEW_CHANGE_ATTEMPTS', 3))
+
+
+"""
+Bounded LRU cache {key: node} of the node that last answered a read or a forwarded write of a key we do not
+have, so the next read of the key asks that node alone instead of every member of the partition.
+It is cleared when the view changes, and a key is dropped when its node answers 404
+"""
+LOCATION_CACHE_SIZE = int(os.getenv('LOCATION_CACHE_SIZE', 10000))
+LOCATION_CACHE = OrderedDict()
+LOCATION_LOCK = threading.Lock()
+
+
+"""
+Optional cache of the hot keys other partitions own(see read_cache.py). It is off unless READ_CACHE_BYTES is set
+"""
+READ_CACHE = ReadCache(int(os.getenv('READ_CACHE_BYTES', 0)), float(os.getenv('READ_CACHE_TTL', 5)))
+
+
+"""
+Nodes that may cache keys we have {key: set of nodes}, told when the key changes(see notify_readers).
+A node is forgotten once it has been told, it registers again with its next read. A write made on another
+replica reaches us through anti-entropy, READ_CACHE_TTL bounds how long a cached value can lag behind it
+"""
+READERS = OrderedDict()
+READERS_SIZE = int(os.getenv('READERS_SIZE', 100000))
+READERS_LOCK = threading.Condition()
+INVALIDATIONS = {}
+
+
+"""
+Writes for replicas that could not be reached, sent to them when they are back(see hints.py), HINT_BATCH
+keys per request. They are persisted in DATA_DIR/hints when persistence is on
+"""
+HINTS = HintStore(int(os.getenv('HINTS_SIZE', 10000)))
+HINT_BATCH = int(os.getenv('HINT_BATCH', 500))
+
+
+"""
+Failure detector watching every other node in view(see failure_detector.py). Routing, fan-out and
+anti-entropy skip the nodes it declared dead instead of waiting for them to time out
+"""
+DETECTOR = failure_detector.FailureDetector(lambda: list(view))
+DETECTOR.listeners.append(lambda node, status: status == failure_detector.ALIVE and FANOUT_POOL.submit(replay_hints, node))
+#the next member takes over the migration of a member that died(see migrator)
+DETECTOR.listeners.append(lambda node, status: status == failure_detector.DEAD and IP_PORT in view and
+                          view.get(node) == view[IP_PORT] and start_rebalance())
+
+
+"""
+Writes on their way to the other members of our partition(see replication.py). A queue is flushed when it
+has REPLICATION_BATCH keys or its oldest write waited REPLICATION_INTERVAL seconds. A writer waits up to
+REPLICATION_BLOCK seconds when REPLICATION_MAX_PENDING keys are queued for a member, then the write becomes
+a hint. Anti-entropy is left to repair what this misses
+"""
+REPLICATION = ReplicationQueue(lambda node, entries: send_entries(node, entries, BATCH_TIMEOUT), lambda node, key, entry: HINTS.add(node, key, entry),
+                               lambda node: node in view and not DETECTOR.is_dead(node),
+                               batch_size=int(os.getenv('REPLICATION_BATCH', 200)),
+                               flush_interval=float(os.getenv('REPLICATION_INTERVAL', 0.005)),
+                               max_pending=int(os.getenv('REPLICATION_MAX_PENDING', 10000)),
+                               block_timeout=float(os.getenv('REPLICATION_BLOCK', 0.5)))
+
+
+"""
+Metrics served by /kvs/metrics(see metrics.py). Requests are labelled with their route, not their path,
+so a client can not make up new series
+"""
+REQUEST_SECONDS = metrics.Histogram('kvs_request_duration_seconds', 'Time to handle a request', ('route', 'method', 'status'))
+PEER_CALLS_PER_REQUEST = metrics.Histogram('kvs_peer_calls_per_request', 'Requests sent to other nodes while handling a request',
+                                           ('route',), metrics.COUNT_BUCKETS)
+PEER_SECONDS = metrics.Histogram('kvs_peer_request_duration_seconds', 'Round trip time of requests to other nodes', ('peer',))
+PEER_FAILURES = metrics.Counter('kvs_peer_request_failures_total', 'Requests to other nodes that failed or timed out', ('peer',))
+SYNC_SECONDS = metrics.Histogram('kvs_anti_entropy_duration_seconds', 'Time of an anti-entropy round with one replica', ('peer',))
+SYNC_BYTES = metrics.Counter('kvs_anti_entropy_bytes_total', 'Bytes of anti-entropy requests and responses', ('direction',))
+metrics.Gauge('kvs_keys', 'Keys in the DB of current node', lambda: len(DB))
+metrics.Gauge('kvs_value_bytes', 'Size of the values in the DB of current node', lambda: DB_BYTES)
+metrics.Gauge('kvs_hints', 'Writes kept for replicas that could not be reached', lambda: HINTS.count)
+metrics.Gauge('kvs_replication_pending', 'Writes queued for the other members of the partition',
+              lambda: sum(REPLICATION.status()['pending'].values()))
+metrics.Gauge('kvs_view_epoch', 'Epoch of the view of current node', lambda: EPOCH)
+transport.CALL_HOOKS.append(lambda node, seconds, failed: PEER_FAILURES.inc(node) if failed else PEER_SECONDS.observe(seconds, node))
+transport.RESPONSE_HOOKS.append(lambda node, res: DETECTOR.heard_from(node))
+
+
+"""
+Thread pool used to contact several nodes at the same time(see scatter_gather). Its tasks run in the
+context of the request that submitted them, so their requests join its trace(see tracing.py)
+"""
+FANOUT_POOL = tracing.ContextThreadPool(max_workers=int(os.getenv('FANOUT_WORKERS', 32)))
+
+
+"""
+Thread pool used by the batch routes to handle the sub-batches of different partitions at the same time.
+It is separate from FANOUT_POOL because every sub-batch waits on a fan-out of its own
+"""
+BATCH_POOL = tracing.ContextThreadPool(max_workers=int(os.getenv('BATCH_WORKERS', 16)))
+
+
+"""
+Spans of the last TRACE_BUFFER requests current node handled or sent, served by /kvs/traces
+"""
+TRACER = tracing.Tracer(int(os.getenv('TRACE_BUFFER', 10000)))
+transport.TRACER = TRACER
+
+
+"""
+Number of seconds a node has to answer a sub-batch of a batch request
+"""
+BATCH_TIMEOUT = float(os.getenv('BATCH_TIMEOUT', 3))
+
+
+"""
+Number of entries of a key transfer(see transfer_keys) the receiver merges into its DB at a time
+"""
+TRANSFER_BATCH = int(os.getenv('TRANSFER_BATCH', 500))
+
+
+"""
+Number of seconds a node has to receive a whole key transfer
+"""
+TRANSFER_TIMEOUT = float(os.getenv('TRANSFER_TIMEOUT', 60))
+
+
+"""
+Number of replicas that have to answer a read(R) and acknowledge a write(W) before the client gets its
+response, capped by the size of the partition. A request can ask for its own with the r and w parameters.
+With 1 a read is served by the first replica that has the key and a write by one replica, anti-entropy
+brings the others up to date. R + W > K makes a read see the last acknowledged write
+"""
+READ_QUORUM = int(os.getenv('READ_QUORUM', 1))
+WRITE_QUORUM = int(os.getenv('WRITE_QUORUM', 1))
+QUORUM_TIMEOUT = float(os.getenv('QUORUM_TIMEOUT', 1))
+
+
+"""
+The cluster statistics(see cluster_stats) are computed at most once every STATS_TTL seconds, the dashboards
+that poll them in the meantime share the same aggregate. A member has STATS_TIMEOUT seconds to send its own
+"""
+STATS_TTL = float(os.getenv('STATS_TTL', 2))
+STATS_TIMEOUT = float(os.getenv('STATS_TIMEOUT', 1))
+STATS_CACHE = {'time': 0, 'stats': None}
+STATS_LOCK = threading.Lock()
+
+
 ######################
 #   PUBLIC ROUTE     #
 ######################
@@ -57,6 +369,7 @@ PARTITION_MEMBERS = None
 support GET, POST, PUT, DELETE method 
 if current instance is not the main instance, forward the request to main instance
 Also set a timer to determine if the main instance crashes
+GET takes an optional r and PUT/POST an optional w parameter(see READ_QUORUM and WRITE_QUORUM)
 """
 @app.route('/kvs', methods=['GET', 'POST', 'PUT', 'DELETE'])
 def kvs():
@@ -71,6 +384,64 @@ def kvs():
         return delete(values)
 
 
+"""
+Batch versions of GET, PUT and DELETE on /kvs. The request body is json:
+/kvs/mget    {"keys": ["foo", "bar"]}
+/kvs/mput    {"entries": [{"key": "foo", "value": "bar", "causal_payload": ""}]}
+/kvs/mdelete {"keys": ["foo", "bar"]}
+The keys are grouped by the partition that owns them and each partition gets one sub-batch, all partitions
+at the same time. The response has the result of every key, the same fields /kvs returns for a single key
+e.g. {"msg": "success", "results": {"foo": {"msg": "success", "value": "bar", "causal_payload": "1.0", ...}}}
+A key that is not a valid string, or an entry that is not an object, gets the result "Key not valid".
+A body without the list is refused with 400
+"""
+@app.route('/kvs/mget', methods=['GET', 'POST', 'PUT'])
+def mget():
+    keys = batch_items('keys')
+    if keys is None:
+        return not_a_batch('keys')
+    return batch(keys, mget_partition)
+
+
+@app.route('/kvs/mput', methods=['POST', 'PUT'])
+def mput():
+    entries = batch_items('entries')
+    if entries is None:
+        return not_a_batch('entries')
+    results = {}
+    valid = {}
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get('key'), str) or not is_key_valid(entry['key']):
+            results[str(entry.get('key') if isinstance(entry, dict) else entry)] = {'msg': 'error', 'error': 'Key not valid'}
+        elif 'value' not in entry:
+            results[entry['key']] = {'msg': 'error', 'error': 'No value provided'}
+        else:
+            valid[entry['key']] = entry
+    return batch(list(valid.keys()), lambda partition_id, keys: mput_partition(partition_id, [valid[key] for key in keys]), results)
+
+
+@app.route('/kvs/mdelete', methods=['POST', 'PUT', 'DELETE'])
+def mdelete():
+    keys = batch_items('keys')
+    if keys is None:
+        return not_a_batch('keys')
+    return batch(keys, mdelete_partition)
+
+
+"""
+Return the list under name in the json body of a batch request, or None if the body has no list there
+"""
+def batch_items(name):
+    body = request.get_json(force=True)
+    items = body.get(name, []) if isinstance(body, dict) else None
+    return items if isinstance(items, list) else None
+
+
+def not_a_batch(name):
+    j = jsonify(msg='error', error=name + ' must be a list')
+    return make_response(j, 400, {'Content-Type':'application/json'})
+
+
 """
 Return the number of item in DB of current node
 """
@@ -82,9 +453,12 @@ def count():
 
 """
 View update: Handle client's add/remove nodes requests. 
+Every view change gets the next epoch and is sent as a diff to every node at the same time. We reply
+as soon as a majority of the nodes(us included) has it; a node that missed it catches up from the
+first node that talks to it with a newer epoch(see refresh_view)
 There are two cases for add a node
-1.If after adding this node we have to create another partition, we need to make sure other partition share 
-  some keys to this node
+1.If after adding this node we have to create another partition, the other partitions move the keys the new
+  partition owns to it in the background(see start_rebalance)
 2.Otherwise, we just add this node to all existing nodes' view
 There are also two case for deletion:
 1.If that partition has more than 1 replicas, just remove the node from every other nodes' view
@@ -96,44 +470,50 @@ def viewUpdate():
     values = request.values
     _type = values['type']
     ip_port = values['ip_port']
+    refresh_view()
 
     if _type == 'add':
-        flag = (len(view) % NUMBER_OF_REPLICAS == 0)
-        #Sends an add node request to all other nodes in view
-        for node, partition_id in view.items():
-            if node != IP_PORT:
-                requests.put('http://'+ node +'/kvs/add_node', params=values, timeout=10)
-        if ip_port not in view:
-            view[ip_port] = int(len(view)/NUMBER_OF_REPLICAS)
-
-        #send my view to the new node 
-        requests.put('http://'+ ip_port +'/kvs/accept_view', data=view, timeout=10)   
-        if flag and len(DB) > 10:
-            share_key(ip_port)
-        number_of_partitions = int(len(view)/NUMBER_OF_REPLICAS)+(len(view)%NUMBER_OF_REPLICAS!=0) 
-        sleep(3)
-        j = jsonify(msg='success', partition_id=view[ip_port], number_of_partitions=number_of_partitions)
+        if ip_port in view:
+            j = jsonify(msg='success', partition_id=view[ip_port], number_of_partitions=number_of_partitions())
+            return make_response(j, 200, {'Content-Type':'application/json'})
+        acked = propose_view_change(lambda: {'type': 'add', 'ip_port': ip_port,
+                                             'partition_id': view.get(ip_port, int(len(view)/NUMBER_OF_REPLICAS))})
+        #If a new partition was created, every other partition moves the keys the new partition owns on the ring.
+        #Every node starts when it applies the view(see apply_diff), a live member of every other partition is
+        #also asked to, in case the diff did not reach it
+        if get_members(view[ip_port]) == [ip_port]:
+            partition_ids = set(view.values()) - {view[ip_port], view[IP_PORT]}
+            futures = [FANOUT_POOL.submit(send_to_one, get_members(partition_id), 'PUT', '/kvs/share_key', deadline=VIEW_TIMEOUT, adaptive=False)
+                       for partition_id in partition_ids]
+            for future in futures:
+                future.result()
+        if not acked:
+            return view_not_acknowledged()
+        j = jsonify(msg='success', partition_id=view[ip_port], number_of_partitions=number_of_partitions())
         return make_response(j, 200, {'Content-Type':'application/json'})  
     else:
-        #count is the number of replicas in the partition of the node to be deleted
-        count = len(get_members(view[ip_port]))
-        _id = view[IP_PORT]
-        if ip_port in view:
-            del view[ip_port]
-        else:
+        if ip_port not in view:
             j = jsonify(msg='error', error='node does not exist')
             return make_response(j, 404, {'Content-Type':'application/json'})
-        #Sends a remove node request to all other nodes in view
-        for node in view:
-            if node != IP_PORT:
-                requests.put('http://'+node+'/kvs/remove_node', params=values, timeout=10)  
+        #count is the number of replicas in the partition of the node to be deleted
+        count = len(get_members(view[ip_port]))
+        acked = propose_view_change(lambda: {'type': 'remove', 'ip_port': ip_port})
         #If we are deleting the only replica in that partition
         if count == 1:
-            res = requests.put('http://'+ip_port+'/kvs/send_data?ip_port='+str(IP_PORT)+'&partition_id='+str(_id), timeout=10)
-        number_of_partitions = int(len(view)/NUMBER_OF_REPLICAS)+(len(view)%NUMBER_OF_REPLICAS!=0)
-        sleep(2)
-        j = jsonify(msg='success', number_of_partitions=number_of_partitions)
+            transport.put(ip_port, '/kvs/send_data', timeout=TRANSFER_TIMEOUT, adaptive=False)
+        if not acked:
+            return view_not_acknowledged()
+        j = jsonify(msg='success', number_of_partitions=number_of_partitions())
         return make_response(j, 200, {'Content-Type':'application/json'})   
+
+
+def number_of_partitions():
+    return int(len(view)/NUMBER_OF_REPLICAS)+(len(view)%NUMBER_OF_REPLICAS!=0)
+
+
+def view_not_acknowledged():
+    j = jsonify(msg='error', error='view change was not acknowledged by a majority of the nodes')
+    return make_response(j, 503, {'Content-Type':'application/json'})
       
 
 
@@ -179,6 +559,293 @@ def get_members(partition_id):
     return members
 
 
+######################
+#  CONSISTENT HASH   #
+######################
+
+"""
+Map a string to a position on the ring(the first 8 bytes of its md5 digest)
+"""
+def ring_position(string):
+    return int(hashlib.md5(string.encode('utf-8')).hexdigest()[:16], 16)
+
+
+"""
+Build a consistent hash ring over a list of partition ids. Every partition gets VIRTUAL_NODES points
+on the ring so adding or removing a partition only moves the keys next to its points
+"""
+def make_ring(partition_ids):
+    points = []
+    for partition_id in set(partition_ids):
+        for i in range(VIRTUAL_NODES):
+            points.append((ring_position(str(partition_id) + '-' + str(i)), partition_id))
+    points.sort()
+    return ([p[0] for p in points], [p[1] for p in points])
+
+
+"""
+Rebuild the ring from the partition ids in the current view. Must be called after every view change.
+The members of our partition are sorted again too: a node that joins it can take the vector clock slot of
+another member
+"""
+def rebuild_ring():
+    global RING, PREVIOUS_RINGS, PARTITION_MEMBERS
+    if IP_PORT in view:
+        PARTITION_MEMBERS = get_members(view[IP_PORT])
+    ring = make_ring(view.values())
+    now = time()
+    PREVIOUS_RINGS = [(old, until) for old, until in PREVIOUS_RINGS if until > now]
+    if RING[0] and ring != RING:
+        PREVIOUS_RINGS.append((RING, now + MIGRATION_GRACE))
+    RING = ring
+    with LOCATION_LOCK:
+        LOCATION_CACHE.clear()
+    READ_CACHE.clear()
+
+
+"""
+The partition ids of the rings in PREVIOUS_RINGS and the seconds they are kept for, sent to a node that joins
+"""
+def previous_partitions():
+    now = time()
+    return [[sorted(set(ring[1])), until - now] for ring, until in PREVIOUS_RINGS if until > now]
+
+
+"""
+Return the partitions that owned the key in recent views and may still have it, newest first
+"""
+def previous_owners(key):
+    owners = []
+    now = time()
+    for ring, until in reversed(PREVIOUS_RINGS):
+        partition_id = get_owner_partition(key, ring)
+        if until > now and partition_id != get_owner_partition(key) and partition_id not in owners:
+            owners.append(partition_id)
+    return owners
+
+
+"""
+Return the id of the partition that owns the key: the first ring point clockwise from the key's position
+"""
+def get_owner_partition(key, ring=None):
+    positions, partition_ids = RING if ring is None else ring
+    if not positions:
+        return None
+    i = bisect_right(positions, ring_position(key))
+    return partition_ids[i % len(positions)]
+
+
+
+######################
+#    VIEW EPOCHS     #
+######################
+
+def set_epoch(epoch):
+    global EPOCH
+    EPOCH = epoch
+    transport.HEADERS['X-View-Epoch'] = str(epoch)
+
+
+"""
+Apply a view change of ours: give it the next epoch and the view it leads to, apply it and return it
+"""
+def change_view(diff):
+    with VIEW_LOCK:
+        new_view = dict(view)
+        if diff['type'] == 'add':
+            new_view[diff['ip_port']] = int(diff['partition_id'])
+        else:
+            new_view.pop(diff['ip_port'], None)
+        diff.update(epoch=EPOCH + 1, view=new_view)
+        apply_diff(diff)
+    return diff
+
+
+"""
+Apply a view change. A diff carries the whole view it leads to, so a node that missed earlier changes
+catches up with it too. Return False if we have another view with the same epoch: another coordinator
+made a different change at the same time(see propose_view_change).
+When the ring changes, current node starts moving the keys it no longer owns(see start_rebalance)
+"""
+def apply_diff(diff):
+    with VIEW_LOCK:
+        if diff['epoch'] < EPOCH:
+            return True
+        if diff['epoch'] == EPOCH:
+            return {node: int(partition_id) for node, partition_id in diff['view'].items()} == view
+        return install_view(diff['epoch'], diff['view'])
+
+
+"""
+Replace our view by a newer one. Return False if it is not newer than ours. With force, a view with our
+epoch replaces ours too(we lost a conflict, see adopt_view)
+"""
+def install_view(epoch, new_view, force=False):
+    with VIEW_LOCK:
+        if epoch < EPOCH or (epoch == EPOCH and not force):
+            return False
+        old_ring = RING
+        for node in list(view):
+            if node not in new_view:
+                del view[node]
+                REPLICATION.stop(node)
+        for node, partition_id in new_view.items():
+            view[node] = int(partition_id)
+        rebuild_ring()
+        set_epoch(epoch)
+        if RING != old_ring and IP_PORT in view:
+            start_rebalance()
+        return True
+
+
+"""
+Make a view change and send it to every node, return True once a majority of the nodes of the view it
+changes(us included) has it. make_diff() returns the change for the current view. Two changes of the same
+view need a majority of the same nodes, so a node that took one of them refuses the other with 409: if we
+miss a majority because of that, we take its view and make our change again on top of it with the next
+epoch. The whole view goes with the retry, so the nodes that took our first change converge too
+"""
+def propose_view_change(make_diff):
+    for attempt in range(VIEW_CHANGE_ATTEMPTS):
+        with VIEW_LOCK:
+            voters = [node for node in view if node != IP_PORT]
+            diff = change_view(make_diff())
+        if diff['type'] == 'add':
+            #the new node gets the view and the rings before it joined, the others only get the diff
+            try:
+                transport.put(diff['ip_port'], '/kvs/accept_view', json={'epoch': diff['epoch'], 'view': diff['view'], 'previous': previous_partitions()},
+                              timeout=VIEW_TIMEOUT, adaptive=False)
+            except requests.exceptions.RequestException:
+                pass
+        conflicts = []
+        if disseminate(voters, diff, (len(voters) + 1)//2, conflicts):
+            return True
+        if not conflicts or not adopt_view(conflicts[0]):
+            return False
+    return False
+
+
+"""
+Send a view change to nodes at the same time. Return True as soon as needed of them acknowledged it,
+the others keep receiving it in the background. The nodes that answer it conflicts are added to conflicts
+"""
+def disseminate(nodes, diff, needed, conflicts=None):
+    futures = {FANOUT_POOL.submit(transport.put, node, '/kvs/view_diff', json=diff, timeout=VIEW_TIMEOUT, adaptive=False): node for node in nodes}
+    if needed <= 0:
+        return True
+    try:
+        for future in as_completed(futures, timeout=VIEW_TIMEOUT):
+            try:
+                res = future.result()
+            except requests.exceptions.RequestException:
+                continue
+            if res.status_code == 200:
+                needed -= 1
+                if needed <= 0:
+                    return True
+            elif res.status_code == 409 and conflicts is not None:
+                conflicts.append(futures[future])
+    except TimeoutError:
+        pass
+    return False
+
+
+"""
+Take the view of a node that has another view change with our epoch
+"""
+def adopt_view(node):
+    try:
+        res = transport.get(node, '/kvs/get_view', timeout=VIEW_TIMEOUT, adaptive=False)
+    except requests.exceptions.RequestException:
+        return False
+    if res.status_code != 200:
+        return False
+    values = res.json()
+    return install_view(values['epoch'], values['view'], force=True)
+
+
+"""
+Remember the newest epoch we heard about(epoch can be a header value or None)
+"""
+def observe_epoch(epoch, node):
+    if epoch is None or node is None:
+        return
+    epoch = int(epoch)
+    if epoch > NEWEST_EPOCH[0]:
+        NEWEST_EPOCH[:] = [epoch, node]
+
+
+"""
+If another node told us about a newer view, fetch it from that node. Return True if our view changed
+"""
+def refresh_view():
+    if NEWEST_EPOCH[0] <= EPOCH:
+        return False
+    with CATCH_UP_LOCK:
+        epoch, node = NEWEST_EPOCH
+        if epoch <= EPOCH:
+            return False
+        try:
+            res = transport.get(node, '/kvs/get_view', timeout=VIEW_TIMEOUT, adaptive=False)
+        except requests.exceptions.RequestException:
+            return False
+        values = res.json()
+        return install_view(values['epoch'], values['view'])
+
+
+transport.RESPONSE_HOOKS.append(lambda node, res: observe_epoch(res.headers.get('X-View-Epoch'), node))
+
+
+"""
+Time and trace every request and count the requests it sends to other nodes. These hooks are registered
+first, so the time includes the other hooks(catching up with a newer view, waiting for the disk)
+"""
+@app.before_request
+def start_metrics():
+    g.start = time()
+    g.route = request.url_rule.rule if request.url_rule is not None else 'unknown'
+    g.span = TRACER.start_request(request.headers, request.method + ' ' + g.route)
+    metrics.start_request()
+
+
+@app.after_request
+def record_metrics(response):
+    response.headers['Server-Timing'] = TRACER.finish_request(g.span, response.status_code)
+    response.headers['X-Trace-Id'] = g.span.trace_id
+    REQUEST_SECONDS.observe(time() - g.start, g.route, request.method, str(response.status_code))
+    PEER_CALLS_PER_REQUEST.observe(metrics.peer_calls(), g.route)
+    return response
+
+
+"""
+A request from a node with a newer view makes us catch up before we handle it, so we route with the same
+view as the sender. The view change routes carry the view themselves
+"""
+@app.before_request
+def check_view_epoch():
+    if request.path in ('/kvs/view_diff', '/kvs/accept_view', '/kvs/get_view'):
+        return
+    observe_epoch(request.headers.get('X-View-Epoch'), request.headers.get('X-Node'))
+    refresh_view()
+
+
+@app.after_request
+def add_view_epoch(response):
+    response.headers['X-View-Epoch'] = str(EPOCH)
+    response.headers['X-Node'] = str(IP_PORT)
+    return response
+
+
+"""
+Return the response to a write sent to us for keys our partition does not own in our view: the sender
+routed it with an older view, it catches up and sends the write again
+"""
+def stale_view(keys):
+    if all(get_owner_partition(key) == view.get(IP_PORT) for key in keys):
+        return None
+    j = jsonify(msg='error', error='stale view', epoch=EPOCH)
+    return make_response(j, 409, {'Content-Type':'application/json'})
+
 
 ######################
 #   PRIVATE METHOD   #
@@ -188,6 +855,9 @@ def get_members(partition_id):
 An example of put request: "/kvs?causal_payload=<payload>&key=<keyname>&value=<val>"
 put on a key that does not exist (say key=foo, val=bar) creates a resource at /kvs. 
 put on a key that exists (say key=foo) replaces the existing val with the new val (say baz)
+The key is written to the partition that owns it on the consistent hash ring. If the current node is 
+not in that partition, the request is forwarded to one of the partition members(see send_to_one), which
+versions the write and replicates it to the others
 """
 def put(values):
     #Extract key&value&causal_payload
@@ -202,126 +872,918 @@ def put(values):
         j = jsonify(msg='error', error='Key not valid')
         return make_response(j, 404, {'Content-Type':'application/json'})
 
-    """
-    NEED TO HANDLE WHEN CAUSALPAYLOAD IS GIVEN BUT THE KEY ALREAYD EXIST
-    """
-    #Check if key is already in our DB
-    if key in DB:
-        value = [val, increment_causal_payload(DB[key][1], PARTITION_MEMBERS.index(IP_PORT)), time()]
-        DB[key] = value
-        # broadcast_write(key, value)
-        j = jsonify(msg='success', partition_id=view[IP_PORT], causal_payload=str(DB[key][1]), timestamp=str(DB[key][2]))
-        return make_response(j, 200, {'Content-Type':'application/json'})
+    partition_id = get_owner_partition(key)
+    READ_CACHE.invalidate([key])
+    #If the key belongs to our partition, write it to our DB
+    needed = quorum_size(values, 'w', WRITE_QUORUM, partition_id)
+    if partition_id == view[IP_PORT]:
+        status = write_local(key, val, causal_payload)
+        if not replicate(key, needed - 1):
+            return quorum_not_reached()
+        j = jsonify(msg='success', partition_id=view[IP_PORT], causal_payload=encode_clock(DB[key][1]), timestamp=str(DB[key][2]))
+        return make_response(j, status, {'Content-Type':'application/json'})
+    #Otherwise send the put request to one member of the owner partition(call add_key route). For a quorum write
+    #it waits for needed - 1 other members to have its version before it answers
+    if needed > 1:
+        res = send_to_one(get_members(partition_id), 'PUT', '/kvs/add_key', ring_position(key), dict(values.items(), w=needed),
+                          QUORUM_TIMEOUT + 0.5, adaptive=False)
     else:
-        for node in view:
-            if node != IP_PORT:
-                try:
-                    res = requests.get('http://' + node + '/kvs/get_key', params=values, timeout=0.5)
-                    #if the status code is 404, the key doesn't exist in that node's database. Otherwise, send(redirect) the put request
-                    if res.status_code != 404:
-                        res = requests.put('http://' + node + '/kvs', params=values, timeout=0.5)
-                        return make_response(res.text, res.status_code, {'Content-Type':'application/json'})
-                except requests.exceptions.Timeout:
-                    pass
-    num = random.randint(0, int(len(view)/NUMBER_OF_REPLICAS)-(len(view)%NUMBER_OF_REPLICAS==0))
-    #if randomly generated node is current node, add key to DB
-    #else send a PUT request to the randomly generate node to add the key to it's DB(Call add_key route)
-    if view[IP_PORT] == num:
-        DB[key] = [val, increment_causal_payload(causal_payload, PARTITION_MEMBERS.index(IP_PORT)), time()]
-        j = jsonify(msg='success', partition_id=view[IP_PORT], causal_payload=str(DB[key][1]), timestamp=str(DB[key][2]))
-        return make_response(j, 201, {'Content-Type':'application/json'})
-    else:
-        res = requests.put('http://'+ get_members(num)[0]+'/kvs/add_key', params=values, timeout=0.5) 
+        res = send_to_one(get_members(partition_id), 'PUT', '/kvs/add_key', ring_position(key), values)
+    if res is None:
+        return not_available()
+    #the owner has a newer view than ours, route the write again with it
+    if res.status_code == 409 and refresh_view():
+        return put(values)
+    if res.status_code in (200, 201):
+        remember_location(key, response_node(res))
+    return make_response(res.text, res.status_code, {'Content-Type':'application/json'})
+
+
+"""
+An example of get request: "/kvs?key=<keyname>&causal_payload=<payload>"
+get on a key that does not exist returns a None
+get on a key that exists returns the last value successfully written (via put/post) to that key
+Only the members of the partition that owns the key are asked for it, the newest of their answers that arrived
+with the first one is returned and the stale members are repaired(see read_members)
+"""
+def get(values):
+    #Extract Key&causal_payload
+    key = values['key']
+    causal_payload = handle_empty_causal_payload(values['causal_payload'])
+    #Check if key is valid 
+    if not is_key_valid(key):
+        j = jsonify(msg='error', error='Key not valid')
+        return make_response(j, 404, {'Content-Type':'application/json'})
+    #A quorum read asks every replica, a miss is looked up the usual way below(the key may be moving)
+    partition_id = get_owner_partition(key)
+    needed = quorum_size(values, 'r', READ_QUORUM, partition_id)
+    if needed > 1:
+        res = quorum_read(key, values, partition_id, needed)
+        if res is not None:
+            return res
+    #if we own the key and it is in current node's DB, return the value. A key of another partition in our
+    #DB may not have been moved yet, the new owner's copy is newer if it has one(see below)
+    if key in DB and partition_id == view[IP_PORT]:
+        return value_response(key)
+
+    #Hot keys of other partitions are served from the read cache, unless the client has seen a newer write
+    cached = cached_read(key, causal_payload)
+    if cached is not None:
+        return make_response(cached, 200, {'Content-Type':'application/json'})
+
+    #Ask the node that answered last time first
+    node = cached_location(key)
+    if node is not None:
+        res = scatter_gather([node], 'GET', '/kvs/get_key', values)[0]
+        if res is not None and res.status_code == 200:
+            cache_read(key, res.content)
+            return make_response(res.text, res.status_code, {'Content-Type':'application/json'}) 
+        forget_location(key)
+
+    #Ask the other members of the owner partition if they have the key in their DB, all at the same time
+    nodes = [node for node in get_members(partition_id) if node != IP_PORT]
+    res, reachable = read_members(key, partition_id, nodes, values)
+    if res is not None:
+        remember_location(key, response_node(res))
+        if res.status_code == 200:
+            cache_read(key, res.content)
         return make_response(res.text, res.status_code, {'Content-Type':'application/json'}) 
+    if not reachable and partition_id != view[IP_PORT]:
+        return not_available()
+
+    #The key may not have been moved to its new owner yet. If no old owner has it either, it may have been
+    #moved in the meantime: the new owner acknowledges a key before the old owner deletes it
+    if key in DB:
+        return value_response(key)
+    old_partition_ids = previous_owners(key)
+    for old_partition_id in old_partition_ids:
+        old_nodes = [node for node in get_members(old_partition_id) if node != IP_PORT]
+        res = scatter_gather(old_nodes, 'GET', '/kvs/get_key', values)[0]
+        if res is not None:
+            remember_location(key, response_node(res))
+            return make_response(res.text, res.status_code, {'Content-Type':'application/json'}) 
+    if old_partition_ids:
+        res = scatter_gather(nodes, 'GET', '/kvs/get_key', values)[0]
+        if res is not None:
+            return make_response(res.text, res.status_code, {'Content-Type':'application/json'}) 
+    #the owner may have changed in a view we have not seen yet
+    if refresh_view():
+        return get(values)
+            
+    #If none of them have the key, return error
+    j = jsonify(msg='error', error='key does not exist')
+    return make_response(j, 404, {'Content-Type':'application/json'})
+
+
+# """
+# del on a key that does not exist returns a None
+# del on a key that exists (say foo) deletes the resource at /kvs and returns success. 
+# """
+def delete(values):
+    return None
+#     #Extract Key
+#     key = values['key']
+#     #Check if key is valid 
+#     if not is_key_valid(key):
+#         j = jsonify(msg='error', error='Key not valid')
+#         return make_response(j, 404, {'Content-Type':'application/json'})
+
+#     #If key is in current node's DB, return the value
+#     if key in DB:
+#         del DB[key]
+#         j = jsonify(msg='success')
+#         return make_response(j, 200, {'Content-Type':'application/json'})
+
+#     #Ask all other node to delete the key if they have the key
+#     for node in view:
+#         if node != IP_PORT:
+#             res = requests.delete('http://'+node+'/kvs/remove_key', params=values)
+#             if res.status_code != 404:
+#                 return make_response(res.text, res.status_code, {'Content-Type':'application/json'}) 
+#     j = jsonify(msg='error', error='key does not exist')
+#     return make_response(j, 404, {'Content-Type':'application/json'})
+
+
+"""
+If the client submited a put/post request but didn't give a value, return an error message 
+"""
+def no_value():
+    j = jsonify(msg='error', error='No value provided')
+    return make_response(j, 404, {'Content-Type':'application/json'})
+
+
+"""
+key should be in charset: [a-zA-Z0-9_] i.e. Alphanumeric including underscore, and case-sensitive
+and the size of key should be 1 to 250 characters
+
+"""
+def is_key_valid(key):
+    if re.match(r'^[A-Za-z0-9_]+$', key):
+        return 0 < len(key) < 251
+    return False
+
+
+"""
+When the key value store is not available at this moment, return error message
+"""
+def not_available():
+    j = jsonify(msg='error', error='key value store is not available')
+    return make_response(j, 404, {'Content-Type' : 'application/json'})
+
+
+"""
+Send the same request to all the nodes at the same time and return (response, reachable), where response 
+is the first response that is not a 404 and reachable tells if any node answered at all. 
+The requests that have not started yet are cancelled once we have a response, and the whole fan-out 
+has to finish before the deadline(in seconds), so a dead node costs at most one timeout
+"""
+def scatter_gather(nodes, method, path, params=None, deadline=0.5, **kwargs):
+    futures = [FANOUT_POOL.submit(transport.request, node, method, path, params=params, timeout=deadline, **kwargs) for node in live_nodes(nodes)]
+    metrics.add_peer_calls(len(futures))
+    reachable = False
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            try:
+                res = future.result()
+            except requests.exceptions.RequestException:
+                continue
+            reachable = True
+            if res.status_code != 404:
+                return res, True
+    except TimeoutError:
+        pass
+    finally:
+        for future in futures:
+            future.cancel()
+    return None, reachable
+
+
+"""
+Send a request to one of the nodes and return its response, or None if none of them answered. The nodes are
+tried one after the other from the one start picks, the next one only when a node is dead or did not answer
+before the deadline. Writes are forwarded this way with the hash of the key as start, so every node sends the
+writes of a key to the same member: it versions them(see write_local) and replicates them to the others
+"""
+def send_to_one(nodes, method, path, start=0, params=None, deadline=0.5, **kwargs):
+    live = live_nodes(nodes)
+    if not live:
+        return None
+    start %= len(live)
+    for node in live[start:] + live[:start]:
+        metrics.add_peer_calls(1)
+        try:
+            return transport.request(node, method, path, params=params, timeout=deadline, **kwargs)
+        except requests.exceptions.RequestException:
+            continue
+    return None
+
+
+"""
+Send the same request to all the nodes at the same time and return (responses, enough) as soon as needed of
+them gave a response accepted by accept, or when the deadline passes. The requests are not cancelled, so
+every node still gets it. missed(node) is called for every node that is dead or could not be reached,
+also after we returned
+"""
+def quorum(nodes, method, path, needed, accept, params=None, deadline=0.5, missed=None, **kwargs):
+    live = live_nodes(nodes)
+    futures = [FANOUT_POOL.submit(transport.request, node, method, path, params=params, timeout=deadline, **kwargs) for node in live]
+    metrics.add_peer_calls(len(futures))
+    if missed is not None:
+        for node in nodes:
+            if node not in live:
+                missed(node)
+        for node, future in zip(live, futures):
+            future.add_done_callback(lambda future, node=node: future.exception() is not None and missed(node))
+    responses = []
+    if needed <= 0:
+        return responses, True
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            try:
+                res = future.result()
+            except requests.exceptions.RequestException:
+                continue
+            if accept(res):
+                responses.append(res)
+                if len(responses) >= needed:
+                    return responses, True
+    except TimeoutError:
+        pass
+    return responses, False
+
+
+"""
+Return the quorum(r or w) a request asks for, between 1 and the number of members of the partition
+"""
+def quorum_size(values, name, default, partition_id):
+    try:
+        needed = int(values.get(name, default))
+    except ValueError:
+        needed = default
+    return max(1, min(needed, len(get_members(partition_id))))
+
+
+"""
+Send a key we just wrote to the other members of our partition and return True once needed of them have it.
+The members it could not be sent to get it as a hint(see HINTS). With needed 0 the key is queued for the
+live members instead(see REPLICATION). With block False a full queue does not make us wait, the key becomes
+a hint right away
+"""
+def replicate(key, needed, block=True):
+    nodes = [node for node in get_members(view[IP_PORT]) if node != IP_PORT]
+    if needed <= 0:
+        for node in nodes:
+            if DETECTOR.is_dead(node):
+                HINTS.add(node, key, get_entry(key))
+            else:
+                REPLICATION.push(node, key, get_entry(key), block)
+        return True
+    entry = get_entry(key)
+    return quorum(nodes, 'PUT', '/kvs/receive_keys', needed, lambda res: res.status_code == 200, deadline=QUORUM_TIMEOUT,
+                  missed=lambda node: HINTS.add(node, key, entry), data=entry_line(key, entry),
+                  headers={'Content-Type': 'application/x-ndjson'}, adaptive=False)[1]
+
+
+"""
+Read a key from every member of its partition at the same time and return the newest value(see choose_value)
+once needed of them answered, not_available if fewer did, or None if none of them has the key.
+The replicas that answered with an older value or without the key are repaired in the background
+"""
+def quorum_read(key, values, partition_id, needed):
+    members = get_members(partition_id)
+    #{node: entry of the key on the node, None if the node does not have it}
+    answers = {}
+    if IP_PORT in members:
+        needed -= 1
+        answers[IP_PORT] = get_entry(key) if key in DB else None
+    nodes = [node for node in members if node != IP_PORT]
+    responses, enough = quorum(nodes, 'GET', '/kvs/get_key', needed, lambda res: res.status_code in (200, 404), values, QUORUM_TIMEOUT)
+    if not enough:
+        return not_available()
+    for res in responses:
+        answers[response_node(res)] = result_entry(res.json()) if res.status_code == 200 else None
+    entries = [entry for entry in answers.values() if entry is not None]
+    if not entries:
+        return None
+    entry = reduce(choose_value, entries)
+    read_repair({node: {key: entry} for node, found in answers.items() if is_stale(found, entry)})
+    j = jsonify(msg='success', value=str(entry[0]), partition_id=partition_id, causal_payload=encode_clock(entry[1]), timestamp=str(entry[2]))
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
+
+"""
+Read a key from the other members of its partition(nodes) at the same time and return (response, reachable)
+like scatter_gather. The answers that arrived by the time the first one with the key did are compared and the
+newest is returned, so a read does not wait for more replicas to be more recent. Once every member answered,
+the ones with an older value or without the key are repaired in the background(see repair_members)
+"""
+def read_members(key, partition_id, nodes, values, deadline=0.5):
+    futures = {FANOUT_POOL.submit(transport.request, node, 'GET', '/kvs/get_key', params=values, timeout=deadline): node
+               for node in live_nodes(nodes)}
+    metrics.add_peer_calls(len(futures))
+    res, reachable = None, False
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            try:
+                answer = future.result()
+            except requests.exceptions.RequestException:
+                continue
+            reachable = True
+            if answer.status_code != 404:
+                res = answer
+                break
+    except TimeoutError:
+        pass
+    if res is None or res.status_code != 200:
+        return res, reachable
+    arrived = [(answer, result_entry(answer.json())) for answer in answers_of(futures).values() if answer is not None and answer.status_code == 200]
+    newest = reduce(choose_value, [entry for answer, entry in arrived])
+    res = next(answer for answer, entry in arrived if entry is newest)
+    local = partition_id == view.get(IP_PORT)
+    when_all_done(list(futures), lambda: repair_members(key, read_entries(answers_of(futures)), local))
+    return res, reachable
+
+
+"""
+Return the responses of the finished requests of futures {future: node} as {node: response}, None for a node
+that did not answer
+"""
+def answers_of(futures):
+    answers = {}
+    for future, node in futures.items():
+        if future.done() and not future.cancelled() and future.exception() is None:
+            answers[node] = future.result()
+        else:
+            answers[node] = None
+    return answers
+
+
+"""
+Call fn once every future is done
+"""
+def when_all_done(futures, fn):
+    pending = [len(futures)]
+    lock = threading.Lock()
+    def done(future):
+        with lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        fn()
+    for future in futures:
+        future.add_done_callback(done)
+
+
+"""
+Return the entries of the answers {node: response} to a read of a key {node: entry, None if the node does not
+have the key}. The nodes that did not answer are left out
+"""
+def read_entries(answers):
+    entries = {}
+    for node, res in answers.items():
+        if res is not None and res.status_code == 200:
+            entries[node] = result_entry(res.json())
+        elif res is not None and res.status_code == 404:
+            entries[node] = None
+    return entries
+
+
+"""
+Repair the members of a partition after a read of a key: entries {node: entry or None} are what the other
+members answered, and current node is repaired too when local(see read_entries)
+"""
+def repair_members(key, entries, local):
+    entries = dict(entries)
+    if local:
+        entries[IP_PORT] = get_entry(key) if key in DB else None
+    found = [entry for entry in entries.values() if entry is not None]
+    if not found:
+        return
+    newest = reduce(choose_value, found)
+    read_repair({node: {key: newest} for node, entry in entries.items() if is_stale(entry, newest)})
+
+
+"""
+Return the entry [value, vector clock, timestamp] of the fields of a read response
+"""
+def result_entry(fields):
+    return [fields['value'], decode_clock(fields['causal_payload']), float(fields['timestamp'])]
+
+
+"""
+True if a replica that answered a read with entry(None if it did not have the key) is behind the newest value
+"""
+def is_stale(entry, newest):
+    return entry is None or entry[1] != newest[1] or entry[2] != newest[2]
+
+
+"""
+Send the newest entries to the replicas that answered a read with an older value {node: {key: entry}}.
+The writes are not waited for, they are merged like anti-entropy does(see receive_keys)
+"""
+def read_repair(repairs):
+    for node, entries in repairs.items():
+        if node == IP_PORT:
+            FANOUT_POOL.submit(sync_database, entries)
+            continue
+        body = b''.join(entry_line(key, entry) for key, entry in entries.items())
+        FANOUT_POOL.submit(transport.put, node, '/kvs/receive_keys', data=body, headers={'Content-Type': 'application/x-ndjson'},
+                           timeout=QUORUM_TIMEOUT, adaptive=False)
+
+
+def quorum_not_reached():
+    j = jsonify(msg='error', error='not enough replicas answered')
+    return make_response(j, 404, {'Content-Type':'application/json'})
+
+
+"""
+Return the node that answered last time for a key we do not have(see LOCATION_CACHE), or None
+"""
+def cached_location(key):
+    with LOCATION_LOCK:
+        node = LOCATION_CACHE.get(key)
+        if node is not None:
+            LOCATION_CACHE.move_to_end(key)
+        return node
+
+
+def remember_location(key, node):
+    with LOCATION_LOCK:
+        LOCATION_CACHE[key] = node
+        LOCATION_CACHE.move_to_end(key)
+        if len(LOCATION_CACHE) > LOCATION_CACHE_SIZE:
+            LOCATION_CACHE.popitem(last=False)
+
+
+def forget_location(key):
+    with LOCATION_LOCK:
+        LOCATION_CACHE.pop(key, None)
+
+
+def response_node(res):
+    return urlsplit(res.url).netloc
+
+
+"""
+Return the cached response body for a read of a key, or None if it is not cached or the causal payload
+of the client is newer than or concurrent with the cached value
+"""
+def cached_read(key, causal_payload):
+    if not READ_CACHE.enabled():
+        return None
+    cached = READ_CACHE.get(key)
+    if cached is None:
+        return None
+    body, vector_clock = cached
+    if vector_clock != causal_payload and compare_casual_payloads(vector_clock, causal_payload) != 0:
+        return None
+    return body
+
+
+"""
+Cache the response body of a read of a key another partition owns
+"""
+def cache_read(key, body):
+    if READ_CACHE.enabled() and get_owner_partition(key) != view.get(IP_PORT):
+        READ_CACHE.put(key, body, handle_empty_causal_payload(json.loads(body.decode('utf-8'))['causal_payload']))
+
+
+"""
+Remember that the sender of a get_key may cache the key, if it has a read cache
+"""
+def add_reader(key, headers):
+    node = headers.get('X-Node')
+    if node is None or not headers.get('X-Read-Cache'):
+        return
+    with READERS_LOCK:
+        READERS.setdefault(key, set()).add(node)
+        READERS.move_to_end(key)
+        if len(READERS) > READERS_SIZE:
+            READERS.popitem(last=False)
+
+
+"""
+A key changed: queue an invalidation for every node that may cache it(see invalidation_job)
+"""
+def notify_readers(key):
+    if not READERS:
+        return
+    with READERS_LOCK:
+        nodes = READERS.pop(key, None)
+        if nodes:
+            for node in nodes:
+                INVALIDATIONS.setdefault(node, set()).add(key)
+            READERS_LOCK.notify()
+
+
+"""
+Send the queued invalidations, in one request per node for all the keys that changed since the last batch
+"""
+def invalidation_job():
+    while True:
+        with READERS_LOCK:
+            while not INVALIDATIONS:
+                READERS_LOCK.wait()
+            pending = dict(INVALIDATIONS)
+            INVALIDATIONS.clear()
+        futures = [FANOUT_POOL.submit(transport.put, node, '/kvs/invalidate', json={'keys': list(keys)}, timeout=0.5, adaptive=False)
+                   for node, keys in pending.items() if not DETECTOR.is_dead(node)]
+        for future in futures:
+            try:
+                future.result()
+            except requests.exceptions.RequestException:
+                pass
+        sleep(0.01)
+
+
+"""
+Return the nodes the failure detector has not declared dead
+"""
+def live_nodes(nodes):
+    return [node for node in nodes if not DETECTOR.is_dead(node)]
+
+
+"""
+Send the same request to all the nodes at the same time and wait for all of them(or the deadline)
+Return a dictionary {node: response}, where response is None if the node did not answer
+"""
+def gather(nodes, method, path, params=None, deadline=0.5, **kwargs):
+    futures = {node: FANOUT_POOL.submit(transport.request, node, method, path, params=params, timeout=deadline, **kwargs) for node in live_nodes(nodes)}
+    metrics.add_peer_calls(len(futures))
+    responses = {node: None for node in nodes}
+    for node, future in futures.items():
+        try:
+            responses[node] = future.result(timeout=deadline)
+        except (requests.exceptions.RequestException, TimeoutError):
+            future.cancel()
+            responses[node] = None
+    return responses
+
+
+"""
+Return the response fields of a key in the DB of current node
+"""
+def key_result(key):
+    return {'msg': 'success', 'value': str(entry_value(DB[key])), 'partition_id': view[IP_PORT], 'causal_payload': encode_clock(DB[key][1]), 'timestamp': str(DB[key][2])}
+
+
+"""
+Group the keys by owner partition and call handle(partition_id, keys) for every partition at the same time.
+handle returns a dictionary {key: result}. Invalid keys are rejected before anything is sent
+"""
+def batch(keys, handle, results=None):
+    results = {} if results is None else results
+    partitions = {}
+    for key in keys:
+        if not isinstance(key, str) or not is_key_valid(key):
+            results[str(key)] = {'msg': 'error', 'error': 'Key not valid'}
+        else:
+            partitions.setdefault(get_owner_partition(key), []).append(key)
+    futures = [BATCH_POOL.submit(handle, partition_id, keys) for partition_id, keys in partitions.items()]
+    for future in futures:
+        results.update(future.result())
+    j = jsonify(msg='success', results=results)
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
+
+"""
+Read the keys owned by one partition. The keys current node has are read locally, the others are asked to 
+each other member of the partition in one request
+"""
+def mget_partition(partition_id, keys):
+    reachable = partition_id == view[IP_PORT]
+    results = {key: key_result(key) for key in keys if key in DB} if reachable else {}
+    missing = [key for key in keys if key not in results]
+    nodes = [node for node in get_members(partition_id) if node != IP_PORT]
+    if missing and nodes:
+        reachable = get_keys_from(nodes, missing, results, repair=True) or reachable
+    if reachable:
+        #keys of another partition we have not moved to it yet
+        results.update({key: key_result(key) for key in missing if key not in results and key in DB})
+        #keys that have not been moved to their new owner yet, or that were moved while we were asking
+        moving = [key for key in missing if key not in results and previous_owners(key)]
+        for old_partition_id, keys in group_by_previous_owner(moving).items():
+            get_keys_from([node for node in get_members(old_partition_id) if node != IP_PORT], keys, results)
+        moving = [key for key in moving if key not in results]
+        if moving and nodes:
+            get_keys_from(nodes, moving, results)
+    for key in missing:
+        if key not in results:
+            error = 'key does not exist' if reachable else 'key value store is not available'
+            results[key] = {'msg': 'error', 'error': error}
+    return results
+
+
+"""
+Ask every node for the keys at the same time and add the results to results. A replica may not have every
+key yet, so we take each key from whichever node has it, the newest value if several do. With repair, the
+nodes are replicas of the keys and the ones that answered with an older value or without a key are repaired
+Return True if any node answered
+"""
+def get_keys_from(nodes, keys, results, repair=False):
+    #{node: {key: result}}
+    answers = {}
+    for node, res in gather(nodes, 'PUT', '/kvs/get_keys', deadline=BATCH_TIMEOUT, json={'keys': keys}).items():
+        if res is not None and res.status_code == 200:
+            answers[node] = res.json()['results']
+    repairs = {}
+    for key in keys:
+        found = {node: result_entry(answer[key]) for node, answer in answers.items() if key in answer}
+        if not found:
+            continue
+        newest = reduce(choose_value, found.values())
+        node = next(node for node, entry in found.items() if entry is newest)
+        results.setdefault(key, answers[node][key])
+        if repair:
+            for node in answers:
+                if is_stale(found.get(node), newest):
+                    repairs.setdefault(node, {})[key] = newest
+    read_repair(repairs)
+    return bool(answers)
+
+
+def group_by_previous_owner(keys):
+    partitions = {}
+    for key in keys:
+        for partition_id in previous_owners(key):
+            partitions.setdefault(partition_id, []).append(key)
+    return partitions
+
+
+"""
+Write the entries owned by one partition, locally if current node is in it, otherwise in one request to one member
+of the partition, which replicates them(see send_to_one)
+"""
+def mput_partition(partition_id, entries):
+    READ_CACHE.invalidate([entry['key'] for entry in entries])
+    if partition_id == view[IP_PORT]:
+        return write_entries(entries)
+    res = send_to_one(get_members(partition_id), 'PUT', '/kvs/add_keys', ring_position(entries[0]['key']), deadline=BATCH_TIMEOUT,
+                      json={'entries': entries})
+    if res is None:
+        return {entry['key']: {'msg': 'error', 'error': 'key value store is not available'} for entry in entries}
+    #the owner has a newer view than ours, route the entries again with it
+    if res.status_code == 409:
+        if not refresh_view():
+            return {entry['key']: {'msg': 'error', 'error': 'stale view'} for entry in entries}
+        partitions = {}
+        for entry in entries:
+            partitions.setdefault(get_owner_partition(entry['key']), []).append(entry)
+        results = {}
+        for partition_id, entries in partitions.items():
+            results.update(mput_partition(partition_id, entries))
+        return results
+    return res.json()['results']
+
+
+"""
+Delete the keys owned by one partition from every member of it, so that anti-entropy can not bring them back
+"""
+def mdelete_partition(partition_id, keys):
+    deleted = set(remove_keys_local(keys)) if partition_id == view[IP_PORT] else set()
+    nodes = [node for node in get_members(partition_id) if node != IP_PORT]
+    responses = gather(nodes, 'PUT', '/kvs/remove_keys', deadline=BATCH_TIMEOUT, json={'keys': keys})
+    for res in responses.values():
+        if res is not None and res.status_code == 200:
+            deleted.update(res.json()['deleted'])
+    return {key: {'msg': 'success'} if key in deleted else {'msg': 'error', 'error': 'key does not exist'} for key in keys}
+
+
+"""
+Write a list of entries({"key", "value", "causal_payload"}) to the DB of current node, queue them for the other
+members(see replicate) and return their results
+"""
+def write_entries(entries):
+    results = {}
+    catch_up_keys([entry['key'] for entry in entries])
+    for entry in entries:
+        key = entry['key']
+        status = write_local(key, entry['value'], handle_empty_causal_payload(entry.get('causal_payload', '')), catch_up=False)
+        replicate(key, 0)
+        results[key] = {'msg': 'success', 'status': status, 'partition_id': view[IP_PORT], 'causal_payload': encode_clock(DB[key][1]), 'timestamp': str(DB[key][2])}
+    return results
+
+
+"""
+Remove a list of keys from the DB of current node and return the keys that were there
+"""
+def remove_keys_local(keys):
+    deleted = []
+    for key in keys:
+        if delete_entry(key) is not None:
+            deleted.append(key)
+    return deleted
+
+
+"""
+Write a key to the DB of current node and return the status code for the response(200 if the key 
+was updated, 201 if it was created). If the key already exists, its vector clock is incremented,
+otherwise the causal payload supplied by the client is incremented. A key that may not have been moved
+here yet is fetched first(see catch_up_keys), unless the caller did it for a batch
+"""
+def write_local(key, val, causal_payload, catch_up=True):
+    if catch_up:
+        catch_up_keys([key])
+    position = PARTITION_MEMBERS.index(IP_PORT)
+    with DB_LOCK:
+        if key in DB:
+            set_entry(key, [val, increment_causal_payload(DB[key][1], position), time()])
+            return 200
+        set_entry(key, [val, increment_causal_payload(causal_payload, position), time()])
+        return 201
+
+
+"""
+Before current node versions writes to keys it does not have but a previous owner may still have(the rebalancer
+has not moved them yet, see previous_owners), merge the newest entry the old owners or the other members of our
+partition have into DB. Vector clocks of different partitions count different nodes, so a new clock would not
+descend from the old one and the old entry could win when it arrives. The write now increments the old clock
+"""
+def catch_up_keys(keys):
+    keys = [key for key in keys if key not in DB and previous_owners(key)]
+    if not keys:
+        return
+    nodes = [node for node in get_members(view[IP_PORT]) if node != IP_PORT]
+    for partition_id in group_by_previous_owner(keys):
+        nodes.extend(get_members(partition_id))
+    results = {}
+    get_keys_from(nodes, keys, results)
+    sync_database({key: result_entry(fields) for key, fields in results.items()})
+
+
+"""
+Every change to DB goes through set_entry and delete_entry so the Merkle tree stays up to date
+"""
+def set_entry(key, entry):
+    global DB_BYTES
+    with DB_LOCK:
+        old_entry = DB.get(key)
+        DURABILITY.ticket = STORAGE.log_put(key, entry)
+        entry = store_value(entry)
+        DB[key] = entry
+        DB_BYTES += entry_size(entry) - (entry_size(old_entry) if old_entry is not None else 0)
+        MERKLE_TREE.update(key, old_entry, entry)
+        log_change(key)
+        free_value(old_entry)
+    notify_readers(key)
+
+
+"""
+Remove a key from DB and return its entry(None if the key was not there)
+"""
+def delete_entry(key):
+    global DB_BYTES
+    with DB_LOCK:
+        entry = DB.pop(key, None)
+        if entry is not None:
+            DB_BYTES -= entry_size(entry)
+            MERKLE_TREE.update(key, entry, None)
+            log_change(key)
+            DURABILITY.ticket = STORAGE.log_delete(key)
+            free_value(entry)
+    if entry is not None:
+        notify_readers(key)
+    return entry
+
+
+"""
+Move the value of an entry to the blob store if it is large
+"""
+def store_value(entry):
+    if isinstance(entry[0], str) and len(entry[0]) > BLOB_THRESHOLD:
+        return [blob_store().put(entry[0]), entry[1], entry[2]]
+    return entry
+
+
+def blob_store():
+    global BLOB_STORE
+    if BLOB_STORE is None:
+        BLOB_STORE = BlobStore(os.getenv('DATA_DIR'))
+    return BLOB_STORE
+
+
+def free_value(entry):
+    if entry is not None and isinstance(entry[0], BlobRef) and entry[0].store is BLOB_STORE:
+        BLOB_STORE.free(entry[0])
+
+
+"""
+Return the value of an entry of DB, reading it from the blob store if it is kept there
+"""
+def entry_value(entry):
+    if isinstance(entry[0], BlobRef):
+        return entry[0].value()
+    return entry[0]
+
+
+"""
+Return the entry of a key with its value, for sending it to another node or to disk
+"""
+def get_entry(key):
+    entry = DB[key]
+    if isinstance(entry[0], BlobRef):
+        return [entry[0].value(), entry[1], entry[2]]
+    return entry
 
 
 """
-An example of get request: "/kvs?key=<keyname>&causal_payload=<payload>"
-get on a key that does not exist returns a None
-get on a key that exists returns the last value successfully written (via put/post) to that key
+Return the response to a read of a key in our DB. A value kept in the blob store is already json encoded,
+so it is streamed from the mapped file after the other fields(see STREAM_CHUNK)
 """
-def get(values):
-    #Extract Key&causal_payload
-    key = values['key']
-    causal_payload = handle_empty_causal_payload(values['causal_payload'])
-    #Check if key is valid 
-    if not is_key_valid(key):
-        j = jsonify(msg='error', error='Key not valid')
-        return make_response(j, 404, {'Content-Type':'application/json'})
-    #if key is in current node's DB, return the value
-    if key in DB:
-        j = jsonify(msg='success', value=str(DB[key][0]), partition_id=view[IP_PORT], causal_payload=str(DB[key][1]), timestamp=str(DB[key][2]))
+def value_response(key):
+    entry = DB[key]
+    if not isinstance(entry[0], BlobRef):
+        j = jsonify(msg='success', value=str(entry[0]), partition_id=view[IP_PORT], causal_payload=encode_clock(entry[1]), timestamp=str(entry[2]))
         return make_response(j, 200, {'Content-Type':'application/json'})
-
-    #Ask all other nodes if they have the key in their DB
-    for node in view:
-        if node != IP_PORT:
-            try:
-                res = requests.get('http://'+node+'/kvs/get_key', params=values, timeout=0.5)
-                if res.status_code != 404:
-                    return make_response(res.text, res.status_code, {'Content-Type':'application/json'}) 
-            except requests.exceptions.Timeout:
-                pass
-            
-    #If none of them have the key, return error
-    j = jsonify(msg='error', error='key does not exist')
-    return make_response(j, 404, {'Content-Type':'application/json'})
+    fields = json.dumps({'msg': 'success', 'partition_id': view[IP_PORT], 'causal_payload': encode_clock(entry[1]), 'timestamp': str(entry[2])})
+    head = fields[:-1].encode('utf-8') + b', "value": '
+    return Response(stream_value(head, entry[0].read(), b'}'), 200,
+                    {'Content-Type':'application/json', 'Content-Length': str(len(head) + entry[0].length + 1)})
 
 
-# """
-# del on a key that does not exist returns a None
-# del on a key that exists (say foo) deletes the resource at /kvs and returns success. 
-# """
-def delete(values):
-    return None
-#     #Extract Key
-#     key = values['key']
-#     #Check if key is valid 
-#     if not is_key_valid(key):
-#         j = jsonify(msg='error', error='Key not valid')
-#         return make_response(j, 404, {'Content-Type':'application/json'})
+def stream_value(head, value, tail):
+    yield head
+    for i in range(0, len(value), STREAM_CHUNK):
+        yield bytes(value[i:i+STREAM_CHUNK])
+    yield tail
 
-#     #If key is in current node's DB, return the value
-#     if key in DB:
-#         del DB[key]
-#         j = jsonify(msg='success')
-#         return make_response(j, 200, {'Content-Type':'application/json'})
 
-#     #Ask all other node to delete the key if they have the key
-#     for node in view:
-#         if node != IP_PORT:
-#             res = requests.delete('http://'+node+'/kvs/remove_key', params=values)
-#             if res.status_code != 404:
-#                 return make_response(res.text, res.status_code, {'Content-Type':'application/json'}) 
-#     j = jsonify(msg='error', error='key does not exist')
-#     return make_response(j, 404, {'Content-Type':'application/json'})
+"""
+Move the values still in use to a new blob store once most of the old one is overwritten values
+"""
+def compact_blobs():
+    global BLOB_STORE
+    if BLOB_STORE is None or BLOB_STORE.garbage() < max(BLOB_STORE.live, BLOB_COMPACT_BYTES):
+        return
+    with DB_LOCK:
+        refs = [entry[0] for entry in DB.values() if isinstance(entry[0], BlobRef)]
+        BLOB_STORE, moved = BLOB_STORE.compact(refs, os.getenv('DATA_DIR'))
+        for key, entry in DB.items():
+            if isinstance(entry[0], BlobRef):
+                DB[key] = [moved[entry[0]], entry[1], entry[2]]
 
 
 """
-If the client submited a put/post request but didn't give a value, return an error message 
+Before a response is sent, wait until the writes made while handling the request are on disk.
+Requests handled at the same time share one fsync(group commit)
 """
-def no_value():
-    j = jsonify(msg='error', error='No value provided')
-    return make_response(j, 404, {'Content-Type':'application/json'})
+@app.after_request
+def wait_durable(response):
+    STORAGE.wait(getattr(DURABILITY, 'ticket', 0))
+    DURABILITY.ticket = 0
+    return response
 
 
 """
-key should be in charset: [a-zA-Z0-9_] i.e. Alphanumeric including underscore, and case-sensitive
-and the size of key should be 1 to 250 characters
+Load DB from disk when the node starts
+"""
+def restore_database():
+    global DB_BYTES
+    with DB_LOCK:
+        for key, entry in STORAGE.load().items():
+            entry = store_value([entry[0], decode_clock(entry[1]), entry[2]])
+            DB[key] = entry
+            DB_BYTES += entry_size(entry)
+            MERKLE_TREE.update(key, None, entry)
+
 
 """
-def is_key_valid(key):
-    if re.match(r'^[A-Za-z0-9_]+$', key):
-        return 0 < len(key) < 251
-    return False
+Take a snapshot of DB when enough was written to the log, so the log can be truncated and restarts stay fast
+"""
+def snapshot_job():
+    def rotate():
+        with DB_LOCK:
+            return {key: get_entry(key) for key in DB}, STORAGE.start_segment()
+    while True:
+        sleep(1)
+        if STORAGE.should_snapshot():
+            STORAGE.snapshot(rotate)
+        HINTS.compact()
 
 
-# """
-# When the key value store is not available at this moment, return error message
-# """
-# def not_available()
-#     j = jsonify(msg='error', error='key value store is not available')
-#     return make_response(j, 404, {'Content-Type' : 'application/json'})
+def log_change(key):
+    global SEQUENCE
+    SEQUENCE += 1
+    CHANGE_LOG.append((SEQUENCE, key))
+
+
+"""
+Return the entries of the keys changed after sequence number since, at most DELTA_BATCH keys, and the
+sequence number they go up to. Return None if since is no longer in the change log
+"""
+def changes_since(since):
+    with DB_LOCK:
+        if since > SEQUENCE or (CHANGE_LOG and since < CHANGE_LOG[0][0] - 1) or (not CHANGE_LOG and since != SEQUENCE):
+            return None
+        entries = {}
+        sequence = since
+        start = since - CHANGE_LOG[0][0] + 1 if CHANGE_LOG else 0
+        for sequence, key in islice(CHANGE_LOG, start, None):
+            if key in DB:
+                entries[key] = get_entry(key)
+            if len(entries) >= DELTA_BATCH:
+                break
+        return entries, sequence
 
 
 
@@ -334,22 +1796,51 @@ def is_key_valid(key):
 ######################
 
 """
-add a key in to DB
+add a key in to DB. The write was forwarded to current node alone, so it versions it and replicates it to the
+other members of the partition
 """
 @app.route('/kvs/add_key', methods=['GET', 'POST', 'PUT', 'DELETE'])
 def add_key():
     values = request.values
     key = values['key'] 
     val = values['value']
+    stale = stale_view([key])
+    if stale is not None:
+        return stale
     causal_payload = handle_empty_causal_payload(values['causal_payload'])    
-    value = [val, increment_causal_payload(causal_payload, PARTITION_MEMBERS.index(IP_PORT)), time()]
-    if key in DB:
-        DB[key] = value
-        j = jsonify(msg='success', partition_id=view[IP_PORT], causal_payload=str(DB[key][1]), timestamp=str(DB[key][2]))
-        return make_response(j, 200, {'Content-Type':'application/json'})
-    DB[key] = value
-    j = jsonify(msg='success', partition_id=view[IP_PORT], causal_payload=str(DB[key][1]), timestamp=str(DB[key][2]))
-    return make_response(j, 201, {'Content-Type':'application/json'})
+    status = write_local(key, val, causal_payload)
+    if not replicate(key, quorum_size(values, 'w', WRITE_QUORUM, view[IP_PORT]) - 1):
+        return quorum_not_reached()
+    j = jsonify(msg='success', partition_id=view[IP_PORT], causal_payload=encode_clock(DB[key][1]), timestamp=str(DB[key][2]))
+    return make_response(j, status, {'Content-Type':'application/json'})
+
+
+"""
+Batch versions of get_key, add_key and remove_key used by /kvs/mget, /kvs/mput and /kvs/mdelete.
+They only look at the DB of current node, add_keys replicates what it wrote like add_key
+"""
+@app.route('/kvs/get_keys', methods=['GET', 'POST', 'PUT'])
+def get_keys():
+    keys = request.get_json(force=True)['keys']
+    j = jsonify(msg='success', results={key: key_result(key) for key in keys if key in DB})
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
+
+@app.route('/kvs/add_keys', methods=['POST', 'PUT'])
+def add_keys():
+    entries = request.get_json(force=True)['entries']
+    stale = stale_view([entry['key'] for entry in entries])
+    if stale is not None:
+        return stale
+    j = jsonify(msg='success', results=write_entries(entries))
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
+
+@app.route('/kvs/remove_keys', methods=['POST', 'PUT', 'DELETE'])
+def remove_keys():
+    keys = request.get_json(force=True)['keys']
+    j = jsonify(msg='success', deleted=remove_keys_local(keys))
+    return make_response(j, 200, {'Content-Type':'application/json'})
 
 
 """
@@ -359,8 +1850,7 @@ Remove key from database
 def remove_key():
     values = request.values
     key = values['key']
-    if key in DB:
-        del DB[key]
+    if delete_entry(key) is not None:
         j = jsonify(msg='success')
         return make_response(j, 200, {'Content-Type':'application/json'})
     j = jsonify(msg='error', error='key does not exist')
@@ -370,7 +1860,7 @@ def remove_key():
 def send():
     res = requests.get('http://localhost:8086/kvs/print_view')
     return make_response(res.text, res.status_code, {'Content-Type':'application/json'})
-    # j = jsonify(msg='success', partition_id=view[IP_PORT], causal_payload=str(DB[key][1]), timestamp=str(DB[key][2]))
+    # j = jsonify(msg='success', partition_id=view[IP_PORT], causal_payload=encode_clock(DB[key][1]), timestamp=str(DB[key][2]))
     # return make_response(j, 201, {'Content-Type':'application/json'})
 
 
@@ -387,9 +1877,8 @@ def get_key():
         j = jsonify(msg='error', error='key does not exist')
         return make_response(j, 404, {'Content-Type':'application/json'})   
     causal_payload = values['causal_payload']   
-
-    j = jsonify(msg='success', value=str(DB[key][0]), partition_id=view[IP_PORT], causal_payload=str(DB[key][1]), timestamp=str(DB[key][2]))
-    return make_response(j, 200, {'Content-Type':'application/json'})
+    add_reader(key, request.headers)
+    return value_response(key)
     # if compare_casual_payloads(causal_payload, DB[key][1]) == 1:
     #     vector_clock = increment_causal_payload(causal_payload, 0)
     # else:
@@ -399,65 +1888,223 @@ def get_key():
    
 
 """
-Private route to handle add node requests. 
-Add the node into view
+An owner tells us that keys we may cache have changed
 """
-@app.route('/kvs/add_node', methods=['GET', 'POST', 'PUT'])
-def add_node():
-    values = request.values
-    ip_port = values['ip_port']
-    if ip_port not in view:
-        view[ip_port] = int(len(view)/NUMBER_OF_REPLICAS)
-    j = jsonify(msg='Success')
-    return make_response(j, 200, {'Content-Type':'application/json'})   
+@app.route('/kvs/invalidate', methods=['PUT'])
+def invalidate():
+    READ_CACHE.invalidate(request.get_json(force=True)['keys'])
+    j = jsonify(msg='success')
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
+
+"""
+Failure detector probes(see failure_detector.py). A ping carries gossip about the status of other nodes
+and is answered with ours; ping_req asks us to ping a node for the sender
+"""
+@app.route('/kvs/ping', methods=['PUT'])
+def ping():
+    j = jsonify(DETECTOR.handle_ping(request.get_json(force=True)))
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
 
+@app.route('/kvs/ping_req', methods=['PUT'])
+def ping_req():
+    message = request.get_json(force=True)
+    answer = DETECTOR.handle_ping(message)
+    answer['ack'] = DETECTOR.ping(message['target'])
+    j = jsonify(answer)
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
+
+"""
+Private route to handle view changes. The body is a diff {"epoch", "type": "add" or "remove", "ip_port",
+"partition_id", "view"}, view is the whole view it leads to. A diff with our epoch and another view is
+refused with 409: the sender raced another coordinator(see propose_view_change)
+"""
+@app.route('/kvs/view_diff', methods=['POST', 'PUT'])
+def view_diff():
+    diff = request.get_json(force=True)
+    if not apply_diff(diff):
+        j = jsonify(msg='error', error='conflicting view change', epoch=EPOCH)
+        return make_response(j, 409, {'Content-Type':'application/json'})
+    j = jsonify(msg='Success', epoch=EPOCH)
+    return make_response(j, 200, {'Content-Type':'application/json'})   
 
 
 """
 Function to allow the added node to learn about the existing node without share keys
+The body is the whole view with its epoch {"epoch", "view": {ip_port: partition_id}, "previous": previous_partitions()}
 """
 @app.route('/kvs/accept_view', methods=['GET', 'POST', 'PUT'])
 def accept_view():
-    values = request.form.to_dict()
-    for key, value in values.items():
-        view[key] = int(value)
-    global PARTITION_MEMBERS
-    PARTITION_MEMBERS = get_members(view[IP_PORT])
+    values = request.get_json(force=True)
+    install_view(values['epoch'], values['view'])
+    #The keys our partition owns may still be on their owners in the views before we joined, until they are moved
+    for partition_ids, seconds in values.get('previous', []):
+        ring = make_ring(partition_ids)
+        if ring != RING and all(ring != old for old, until in PREVIOUS_RINGS):
+            PREVIOUS_RINGS.append((ring, time() + seconds))
     j = jsonify(msg='Success')
     return make_response(j, 200, {'Content-Type':'application/json'})   
 
 
 """
-Route to handle remove node requests. 
-remove the node from view
+Return our view with its epoch, for a node that has fallen behind
 """
-@app.route('/kvs/remove_node', methods=['GET', 'POST', 'PUT'])
-def remove_node():
-    values = request.values
-    ip_port = values['ip_port']
-    if ip_port in view:
-        del view[ip_port]   
-    j = jsonify(msg='Success')
-    return make_response(j, 200, {'Content-Type':'application/json'})   
-      
+@app.route('/kvs/get_view', methods=['GET'])
+def get_view():
+    with VIEW_LOCK:
+        j = jsonify(msg='success', epoch=EPOCH, view=view)
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
 
 """
 Send the keys to other nodes before deletion
+Every key is sent to the partition that owns it on the ring once current node is out of the view
 """
 @app.route('/kvs/send_data', methods=['GET', 'POST', 'PUT'])
 def send_data():
-    values = request.values
-    ip_port = values['ip_port']
-    partition_id = int(values['partition_id'])
-    del view[IP_PORT]
-    del view[ip_port]
-    for key in DB:
-        num = random.randint(smallest_partition(), smallest_partition()+int(len(view)/NUMBER_OF_REPLICAS)-(len(view)%NUMBER_OF_REPLICAS == 0))
-        requests.put('http://'+get_members(num)[0]+'/kvs/add_key?key='+str(key)+'&value='+str(DB[key][0])+'&causal_payload=', timeout=3)  
+    if IP_PORT in view:
+        del view[IP_PORT]
+    rebuild_ring()
+    partitions = misplaced_keys()
+    futures = [FANOUT_POOL.submit(transfer_keys, get_members(partition_id), keys) for partition_id, keys in partitions.items()]
+    for future in futures:
+        future.result()
     j = jsonify(msg='Success')
     return make_response(j, 200, {'Content-Type':'application/json'})   
 
 
+"""
+Route to ask current node to move the keys a new partition owns to it(see start_rebalance)
+"""
+@app.route('/kvs/share_key', methods=['GET', 'POST', 'PUT'])
+def share_key_route():
+    start_rebalance()
+    j = jsonify(msg='Success')
+    return make_response(j, 200, {'Content-Type':'application/json'})   
+
+
+"""
+Receive a key transfer: a chunked stream of json entries, one per line(see entry_lines). The entries are
+merged into DB like anti-entropy does, TRANSFER_BATCH at a time, and the keys that were received are
+acknowledged all at once in the response. A malformed line ends the transfer with 400, the sender sends it again
+"""
+@app.route('/kvs/receive_keys', methods=['POST', 'PUT'])
+def receive_keys():
+    received = []
+    try:
+        for replica in entry_batches(request.stream):
+            sync_database(replica)
+            received.extend(replica)
+    except (ValueError, KeyError):
+        j = jsonify(msg='error', error='malformed entry', received=received)
+        return make_response(j, 400, {'Content-Type':'application/json'})
+    j = jsonify(msg='success', received=received)
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
+
+"""
+Return the lines of a key transfer, one json object per key with its value, causal_payload and timestamp.
+A value kept in the blob store is already json encoded, so the line is sent in parts and the value is a
+memoryview of the mapped file, it is not copied into the line
+"""
+def entry_lines(keys):
+    for key in keys:
+        entry = DB.get(key)
+        if entry is None:
+            continue
+        line = json.dumps({'key': key, 'causal_payload': encode_clock(entry[1]), 'timestamp': entry[2]})[:-1].encode('utf-8')
+        if isinstance(entry[0], BlobRef):
+            yield line + b', "value": '
+            yield entry[0].read()
+            yield b'}\n'
+        else:
+            yield line + b', "value": ' + json.dumps(entry[0]).encode('utf-8') + b'}\n'
+
+
+"""
+Return the line of a key transfer for an entry [value, vector clock, timestamp] that is not in DB.
+The vector clock is a list when the entry was read from disk
+"""
+def entry_line(key, entry):
+    fields = {'key': key, 'value': entry[0], 'causal_payload': encode_clock(decode_clock(entry[1])), 'timestamp': entry[2]}
+    return json.dumps(fields).encode('utf-8') + b'\n'
+
+
+"""
+Send entries [(key, entry)] to a node in one key transfer and return the keys it acknowledged
+"""
+def send_entries(node, entries, timeout=TRANSFER_TIMEOUT):
+    res = transport.put(node, '/kvs/receive_keys', data=b''.join(entry_line(key, entry) for key, entry in entries),
+                        headers={'Content-Type': 'application/x-ndjson'}, timeout=timeout, adaptive=False)
+    if res.status_code != 200:
+        return []
+    return res.json()['received']
+
+
+"""
+Send the hints of a node that is reachable again, HINT_BATCH keys per request. Hints of nodes that left
+the view are dropped
+"""
+def replay_hints(node):
+    if node not in view:
+        HINTS.drop(node)
+        return
+    if not HINTS.start_replay(node):
+        return
+    try:
+        while DETECTOR.status(node) == failure_detector.ALIVE:
+            hints = HINTS.batch(node, HINT_BATCH)
+            if not hints:
+                break
+            try:
+                received = set(send_entries(node, hints, BATCH_TIMEOUT))
+            except requests.exceptions.RequestException:
+                break
+            if not received:
+                break
+            HINTS.remove(node, [(key, entry) for key, entry in hints if key in received])
+    finally:
+        HINTS.finish_replay(node)
+
+
+"""
+Read the lines of a key transfer and return them in batches {key: [value, causal_payload, timestamp]}
+"""
+def entry_batches(lines):
+    replica = {}
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        entry = json.loads(line.decode('utf-8') if isinstance(line, bytes) else line)
+        replica[entry['key']] = [entry['value'], entry['causal_payload'], entry['timestamp']]
+        if len(replica) >= TRANSFER_BATCH:
+            yield replica
+            replica = {}
+    if replica:
+        yield replica
+
+
+"""
+Stream the entries of keys to the first node of nodes that accepts them, in a single chunked request.
+Return the keys the receiver acknowledged(an empty list if no node could be reached)
+"""
+def transfer_keys(nodes, keys):
+    for node in live_nodes(nodes):
+        if node == IP_PORT:
+            continue
+        try:
+            res = transport.put(node, '/kvs/receive_keys', data=entry_lines(keys), headers={'Content-Type': 'application/x-ndjson'},
+                                timeout=TRANSFER_TIMEOUT, adaptive=False)
+        except requests.exceptions.RequestException:
+            continue
+        if res.status_code == 200:
+            return res.json()['received']
+    return []
+
+
 """
 Method to send a put request for every key in current database to other nodes before delete current node 
 """
@@ -474,27 +2121,126 @@ def smallest_partition():
     return smallest_id
 
 
+######################
+#    REBALANCING     #
+######################
+
+"""
+Start moving the keys current node has but no longer owns to their new owner in the background, or make
+the running rebalancer look at the keys again after a view change. Only the migrator of a partition moves
+keys(see migrator), it removes them from the other members as it goes, so every key crosses the network
+once and MIGRATION_RATE is the rate of the whole partition. Reads of a key that has not been moved
+yet are served by the old owner(see previous_owners) when the new owner does not have it. Writes go to the
+new owner, which first takes the old entry(see catch_up_keys), so the write descends from it and wins over
+it when the transfer merges it with choose_value
+"""
+def start_rebalance():
+    with MIGRATION_LOCK:
+        MIGRATION['restart'] = True
+        if MIGRATION['state'] != 'idle':
+            return
+        MIGRATION.update(state='running', started=time(), finished=None, total_keys=0, moved_keys=0, bytes=0, failed_batches=0)
+    thread = threading.Thread(target=rebalance_job)
+    thread.daemon = True
+    thread.start()
+
+
+"""
+The member of a partition that moves its misplaced keys: the first live one in sorted order. When it dies
+the next one takes over(see the listener of DETECTOR)
+"""
+def migrator(partition_id):
+    members = live_nodes(get_members(partition_id))
+    return members[0] if members else None
+
+
+"""
+Return the keys in our DB that another partition owns on the ring, grouped by owner {partition_id: [keys]}
+"""
+def misplaced_keys():
+    partition_id = view.get(IP_PORT)
+    with DB_LOCK:
+        keys = list(DB)
+    partitions = {}
+    for key in keys:
+        owner = get_owner_partition(key)
+        if owner is not None and owner != partition_id:
+            partitions.setdefault(owner, []).append(key)
+    return partitions
+
+
+"""
+Move the misplaced keys MIGRATION_BATCH at a time, at most MIGRATION_RATE keys per second, until there are
+none left. Keys whose owner could not be reached are tried again after a few seconds
+"""
+def rebalance_job():
+    while True:
+        with MIGRATION_LOCK:
+            if not MIGRATION['restart'] or migrator(view.get(IP_PORT)) != IP_PORT:
+                MIGRATION.update(state='idle', finished=time(), restart=False)
+                return
+            MIGRATION['restart'] = False
+        partitions = misplaced_keys()
+        with MIGRATION_LOCK:
+            MIGRATION['total_keys'] = MIGRATION['moved_keys'] + sum(len(keys) for keys in partitions.values())
+        failed = False
+        for partition_id, keys in partitions.items():
+            for i in range(0, len(keys), MIGRATION_BATCH):
+                if MIGRATION['restart']:
+                    break
+                if not move_keys(partition_id, keys[i:i+MIGRATION_BATCH]):
+                    failed = True
+                    break
+                if MIGRATION_RATE:
+                    delay = MIGRATION['started'] + MIGRATION['moved_keys']/MIGRATION_RATE - time()
+                    if delay > 0:
+                        sleep(delay)
+        if failed:
+            with MIGRATION_LOCK:
+                MIGRATION.update(state='retrying', failed_batches=MIGRATION['failed_batches'] + 1, restart=True)
+            sleep(3)
+            with MIGRATION_LOCK:
+                MIGRATION['state'] = 'running'
+
+
+"""
+Stream a batch of keys to their new owner, then remove the keys it acknowledged from current node and,
+with one bulk request, from the other members of our partition. Return False if the owner could not be reached
+"""
+def move_keys(partition_id, keys):
+    size = sum(entry_size(DB[key]) for key in keys if key in DB)
+    received = transfer_keys(get_members(partition_id), keys)
+    if not received:
+        return not any(key in DB for key in keys)
+    remove_keys_local(received)
+    members = [node for node in get_members(view.get(IP_PORT)) if node != IP_PORT]
+    gather(members, 'PUT', '/kvs/remove_keys', deadline=TRANSFER_TIMEOUT, adaptive=False, json={'keys': received})
+    with MIGRATION_LOCK:
+        MIGRATION['moved_keys'] += len(received)
+        MIGRATION['bytes'] += size
+    return True
+
+
+def entry_size(entry):
+    if isinstance(entry[0], BlobRef):
+        return entry[0].length
+    return len(str(entry[0]))
+
+
 """
-Method to share keys with the new node 
+Progress and throughput of the rebalancer of current node
 """
-def share_key(ip_port):   
-    # number_of_partitions = len(view)/NUMBER_OF_REPLICAS
-    # if len(view)%NUMBER_OF_REPLICAS != 0:
-    #     number_of_partitions += 1
-    # #Define estimated average as (# of key in database)/(# of nodes in old view)*(# of node in new view)
-    # average = int((len(DB)/(number_of_partitions))*(number_of_partitions-1))
-    # #diff is the number of keys that should be sent to the new node
-    # diff = len(DB) - average
-    diff = int(len(DB)/2)
-    keys = list(DB.keys())
-    for i in range(diff+1):
-        requests.put('http://'+ip_port+'/kvs/add_key?key='+str(keys[i])+'&value='+str(DB[keys[i]][0])+'&causal_payload=', timeout=3)
-        del DB[keys[i]]
-        members = get_members(view[IP_PORT])
-        members.remove(IP_PORT)
-        for node in members:
-            requests.put('http://'+node+'/kvs/remove_key?key='+str(keys[i]), timeout=3)
-    return "Success"
+@app.route('/kvs/rebalance_status', methods=['GET'])
+def rebalance_status():
+    with MIGRATION_LOCK:
+        status = dict(MIGRATION)
+    elapsed = (status['finished'] or time()) - status['started'] if status['started'] else 0
+    j = jsonify(msg='success', state=status['state'], total_keys=status['total_keys'], moved_keys=status['moved_keys'],
+                remaining_keys=max(status['total_keys'] - status['moved_keys'], 0), bytes=status['bytes'],
+                failed_batches=status['failed_batches'], elapsed=elapsed,
+                keys_per_second=status['moved_keys']/elapsed if elapsed else 0, bytes_per_second=status['bytes']/elapsed if elapsed else 0,
+                dual_read=any(until > time() for ring, until in PREVIOUS_RINGS))
+    return make_response(j, 200, {'Content-Type':'application/json'})
 
 
 ####################################
@@ -510,22 +2256,188 @@ def print_view():
     return make_response(j, 200, {'Content-Type':'application/json'})
 
 
+"""
+Number of keys in the cluster, the sum of the keys of every partition(see cluster_stats). When a partition
+did not answer the sum misses its keys, return an error with the partial total and those partitions
+"""
 @app.route('/kvs/total_number_of_keys', methods=['GET', 'POST', 'PUT'])
 def total_number_of_keys():
-    total_count = []
-    #Send get_number_of_keys request to all other nodes 
-    for node in view:
-            if node != IP_PORT:
-                res = requests.put('http://'+ node+ '/kvs/get_number_of_keys', timeout=3)
-                count = res.json()['count']
-                if count not in total_count:
-                    total_count.append(count)
-    if len(DB) not in total_count:
-        total_count.append(len(DB))
-    j = jsonify(total=sum(total_count))
+    stats, age = cluster_stats(0)
+    if not stats['complete']:
+        missing = [partition['partition_id'] for partition in stats['partitions'] if 'error' in partition]
+        j = jsonify(msg='error', error='not every partition answered', total=stats['total_keys'], unreachable_partitions=missing)
+        return make_response(j, 404, {'Content-Type': 'application/json'})
+    j = jsonify(total=stats['total_keys'])
     return make_response(j, 200, {'Content-Type': 'application/json'})
 
 
+"""
+Statistics of the whole cluster: the keys, bytes and replica divergence of every partition and their totals.
+The aggregate is cached for STATS_TTL seconds(or the max_age parameter), age is how old it is
+"""
+@app.route('/kvs/cluster_stats', methods=['GET'])
+def get_cluster_stats():
+    try:
+        max_age = float(request.values.get('max_age', STATS_TTL))
+    except ValueError:
+        max_age = STATS_TTL
+    stats, age = cluster_stats(max_age)
+    j = jsonify(msg='success', age=age, **stats)
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
+
+"""
+Private route: statistics of the partition of current node(see partition_stats)
+"""
+@app.route('/kvs/partition_stats', methods=['GET'])
+def get_partition_stats():
+    j = jsonify(partition_stats())
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
+
+"""
+Private route: statistics of the DB of current node(see node_stats)
+"""
+@app.route('/kvs/node_stats', methods=['GET'])
+def get_node_stats():
+    j = jsonify(node_stats())
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
+
+"""
+Return the cluster statistics and their age in seconds, computed again if they are older than max_age.
+Only one request computes them at a time, the others wait for its result
+"""
+def cluster_stats(max_age):
+    with STATS_LOCK:
+        if STATS_CACHE['stats'] is None or time() - STATS_CACHE['time'] > max_age:
+            start = time()
+            STATS_CACHE['stats'] = collect_cluster_stats()
+            STATS_CACHE['time'] = start
+        return STATS_CACHE['stats'], time() - STATS_CACHE['time']
+
+
+"""
+Ask one live member of every partition for the statistics of its partition, all partitions at the same time
+"""
+def collect_cluster_stats():
+    futures = [BATCH_POOL.submit(fetch_partition_stats, partition_id) for partition_id in sorted(set(view.values()))]
+    partitions = [future.result() for future in futures]
+    reached = [partition for partition in partitions if 'error' not in partition]
+    return {'partitions': partitions, 'number_of_partitions': len(partitions), 'complete': len(reached) == len(partitions),
+            'total_keys': sum(partition['keys'] for partition in reached), 'total_bytes': sum(partition['bytes'] for partition in reached),
+            'divergent_replicas': sum(len(partition['divergent']) for partition in reached)}
+
+
+"""
+Return the statistics of a partition from its first live member that answers(current node for its own)
+"""
+def fetch_partition_stats(partition_id):
+    if view.get(IP_PORT) == partition_id:
+        return partition_stats()
+    for node in live_nodes(get_members(partition_id)):
+        metrics.add_peer_calls(1)
+        try:
+            res = transport.get(node, '/kvs/partition_stats', timeout=2 * STATS_TIMEOUT)
+        except requests.exceptions.RequestException:
+            continue
+        if res.status_code == 200:
+            return res.json()
+    return {'partition_id': partition_id, 'error': 'key value store is not available'}
+
+
+"""
+Statistics of the partition of current node. The other live members send theirs at the same time. A replica
+diverges when its Merkle root is not the one most replicas have(anti-entropy has not caught up yet), and the
+partition has as many keys and bytes as its most complete replica
+"""
+def partition_stats():
+    partition_id = view[IP_PORT]
+    others = [node for node in get_members(partition_id) if node != IP_PORT]
+    replicas = {IP_PORT: node_stats()}
+    for node, res in gather(others, 'GET', '/kvs/node_stats', deadline=STATS_TIMEOUT).items():
+        if res is not None and res.status_code == 200:
+            replicas[node] = res.json()
+    roots = [stats['root'] for stats in replicas.values()]
+    majority = max(roots, key=lambda root: (roots.count(root), root == replicas[IP_PORT]['root']))
+    counts = [stats['keys'] for stats in replicas.values()]
+    return {'partition_id': partition_id, 'reported_by': IP_PORT, 'keys': max(counts),
+            'bytes': max(stats['bytes'] for stats in replicas.values()), 'key_count_spread': max(counts) - min(counts),
+            'replicas': replicas, 'unreachable': sorted(node for node in others if node not in replicas),
+            'divergent': sorted(node for node, stats in replicas.items() if stats['root'] != majority)}
+
+
+"""
+Number of keys, size of the values and Merkle root of the DB of current node
+"""
+def node_stats():
+    with DB_LOCK:
+        return {'keys': len(DB), 'bytes': DB_BYTES, 'root': MERKLE_TREE.root()}
+
+
+"""
+Print the failure detector state of the members of the view(alive, suspect or dead, and their incarnation)
+and the incarnation of current node
+"""
+@app.route('/kvs/members_status', methods=['GET'])
+def members_status():
+    j = jsonify(members=DETECTOR.statuses(), incarnation=DETECTOR.incarnation)
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
+
+@app.route('/kvs/hints_status', methods=['GET'])
+def hints_status():
+    j = jsonify(hints=HINTS.status())
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
+
+@app.route('/kvs/replication_status', methods=['GET'])
+def replication_status():
+    j = jsonify(REPLICATION.status())
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
+
+"""
+Metrics of current node in the Prometheus text format
+"""
+@app.route('/kvs/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'})
+
+
+"""
+Spans current node recorded for a trace(/kvs/traces?trace_id=<id>), or its last spans(limit=<n>, 100 by
+default). With cluster=true the spans of every node in the view are gathered, sorted by start time
+"""
+@app.route('/kvs/traces', methods=['GET'])
+def traces():
+    trace_id = request.args.get('trace_id')
+    spans = TRACER.spans(trace_id, int(request.args.get('limit', 100)))
+    if request.args.get('cluster') == 'true':
+        params = {key: value for key, value in request.args.items() if key != 'cluster'}
+        for res in gather([node for node in view if node != IP_PORT], 'GET', '/kvs/traces', params, BATCH_TIMEOUT).values():
+            if res is not None and res.status_code == 200:
+                spans.extend(res.json()['spans'])
+        spans.sort(key=lambda span: span['start'])
+    j = jsonify(spans=spans)
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
+
+@app.route('/kvs/read_cache_status', methods=['GET'])
+def read_cache_status():
+    j = jsonify(READ_CACHE.status())
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
+
+"""
+Print the round trip estimates and circuit breaker state of the peers we have talked to
+"""
+@app.route('/kvs/print_peers', methods=['GET'])
+def print_peers():
+    j = jsonify(peers=transport.status())
+    return make_response(j, 200, {'Content-Type':'application/json'})
+
+
 """
 Print the number of keys the current node has
 """
@@ -540,7 +2452,8 @@ Print the databse
 """
 @app.route('/kvs/print_DB', methods=['GET'])
 def print_DB():
-    j = jsonify(current_DB=DB)
+    with DB_LOCK:
+        j = jsonify(current_DB={key: get_entry(key) for key in DB})
     return make_response(j, 200, {'Content-Type':'application/json'})
 
 
@@ -577,42 +2490,57 @@ def construct_initial_view(viewString):
         view[node] = partition_id
         if (i+1)%NUMBER_OF_REPLICAS == 0:
             partition_id += 1
-    global PARTITION_MEMBERS
-    PARTITION_MEMBERS = get_members(view[IP_PORT])
+    rebuild_ring()
+
+
+"""
+Turn a vector clock into the dotted string we send to clients, e.g. (1, 0, 2) -> '1.0.2'
+The same clocks are encoded over and over when keys are read, so the strings are cached
+"""
+@lru_cache(maxsize=65536)
+def encode_clock(vector_clock):
+    return '.'.join(map(str, vector_clock))
+
+
+"""
+Turn a causal payload from a client('1.0.2', '[1.0.2]') or from another node([1, 0, 2]) into a vector clock
+"""
+def decode_clock(causal_payload):
+    if isinstance(causal_payload, (list, tuple)):
+        return tuple(int(clock) for clock in causal_payload)
+    causal_payload = causal_payload.strip('[]"\' ')
+    if not causal_payload:
+        return ()
+    return tuple(int(clock) for clock in causal_payload.split('.'))
 
 
 """
 Merger two vector clocks(take the point-wise max)
-e.g. [2.2.0.0]+[1.3.0.1] -> [2.3.0.1]
+e.g. (2,2,0,0)+(1,3,0,1) -> (2,3,0,1)
 """
-def merge(causal_payload_1, causal_payload_2):
-    vector_clock_1 = list(map(int, causal_payload_1.split('.')))
-    vector_clock_2 = list(map(int, causal_payload_2.split('.')))
-    new_vector_clock = [max(clock) for clock in zip(vector_clock_1, vector_clock_2)]
-    string_payload = ''.join(str(clock) + '.' for clock in new_vector_clock)
-    return string_payload[:-1]  # remove the extra dot
+def merge(vector_clock_1, vector_clock_2):
+    return tuple(max(clock) for clock in zip_longest(vector_clock_1, vector_clock_2, fillvalue=0))
 
 
 """
 Handle empty causal payload(set the causal payload to all zeros when the causal payload was not supplied by the client)
+and return the vector clock of the causal payload
 """
 def handle_empty_causal_payload(causal_payload):
-    if len(causal_payload) < 3:
-        vector_clock = [0 for x in range(NUMBER_OF_REPLICAS)]
-        string_payload = ''.join(str(clock)+'.' for clock in vector_clock)
-        return string_payload[:-1]
-    return causal_payload[1:-1]
+    vector_clock = decode_clock(causal_payload)
+    if len(vector_clock) < NUMBER_OF_REPLICAS:
+        vector_clock += (0,) * (NUMBER_OF_REPLICAS - len(vector_clock))
+    return vector_clock
 
 
 """
 This function increment the clock of a replica in a vector clock
-e.g. incrementCausalPayload('1.0.0.4', 2) --> return 1.0.1.4 
+e.g. increment_causal_payload((1,0,0,4), 2) --> return (1,0,1,4)
 """
-def increment_causal_payload(causal_payload, position):
-    vector_clock = causal_payload.split('.')
-    vector_clock[position] = str(int(vector_clock[position])+1)
-    string_payload = ''.join(str(clock)+'.' for clock in vector_clock)
-    return string_payload[:-1]#remove the extra dot
+def increment_causal_payload(vector_clock, position):
+    if position >= len(vector_clock):
+        vector_clock += (0,) * (position + 1 - len(vector_clock))
+    return vector_clock[:position] + (vector_clock[position]+1,) + vector_clock[position+1:]
 
 
 """
@@ -622,16 +2550,15 @@ Otherwise, they are said to be concurrent
 if VC1 wins return 0, and if VC2 wins return 1
 if they are concurrent return 2
 """
-def compare_casual_payloads(causal_payload_1, causal_payload_2):
-    #convert the casual payload into list of integers
-    vector_clock_1 = list(map(int, causal_payload_1.split('.')))
-    vector_clock_2 = list(map(int, causal_payload_2.split('.')))
+def compare_casual_payloads(vector_clock_1, vector_clock_2):
+    if vector_clock_1 == vector_clock_2:
+        return 2
     flag1 = False
     flag2 = False
-    for i in range(len(vector_clock_1)):
-        if vector_clock_1[i] > vector_clock_2[i]:
+    for clock1, clock2 in zip_longest(vector_clock_1, vector_clock_2, fillvalue=0):
+        if clock1 > clock2:
             flag1 = True
-        elif vector_clock_1[i] < vector_clock_2[i]:
+        elif clock1 < clock2:
             flag2 = True
     if flag1 == flag2:
         return 2
@@ -644,53 +2571,175 @@ def compare_casual_payloads(causal_payload_1, causal_payload_2):
 #   Backgroud process(Sync)    #
 ################################
 
+"""
+True once the background jobs are running, so the async server and before_first_request do not both start them
+"""
+JOBS_STARTED = False
+
+
 """
 Implement anti-entropy protocol
+Every 3 seconds current node pulls the changes it missed from every other member of the partition(see delta_sync)
+and every MERKLE_EVERY rounds it also compares Merkle trees with them(see merkle_sync)
 """
 @app.before_first_request
 def activate_job():
+    global JOBS_STARTED
+    with DB_LOCK:
+        if JOBS_STARTED:
+            return
+        JOBS_STARTED = True
     def background_job():
         sleep(3)
+        rounds = 0
         while True:
-            members = get_members(view[IP_PORT])
+            refresh_view()
+            members = live_nodes(get_members(view[IP_PORT]))
             for node in members:
                 if node != IP_PORT:
+                    start = time()
                     try:
-                        requests.put("http://"+node+"/kvs/sync", json=json.dumps(DB), timeout=0.8)
-                    except requests.exceptions.Timeout:
+                        delta_sync(node)
+                        if rounds % MERKLE_EVERY == 0:
+                            merkle_sync(node)
+                    except requests.exceptions.RequestException:
                         pass
-            sleep(3)
+                    SYNC_SECONDS.observe(time() - start, node)
+            #keys the other members had and we did not may have come with merkle_sync, the migrator moves them too
+            if rounds % MERKLE_EVERY == 0 and rounds and migrator(view[IP_PORT]) == IP_PORT:
+                start_rebalance()
+            compact_blobs()
+            #a node that did not answer a write may be back without the failure detector seeing it go
+            for node in HINTS.nodes():
+                if DETECTOR.status(node) == failure_detector.ALIVE:
+                    replay_hints(node)
+            rounds += 1
+            sleep(SYNC_INTERVAL)
     thread = threading.Thread(target=background_job)
+    thread.daemon = True
     thread.start()
-
-"""
-Route to synchronize database
+    DETECTOR.start(IP_PORT)
+    thread = threading.Thread(target=invalidation_job)
+    thread.daemon = True
+    thread.start()
+    if STORAGE.persistent:
+        thread = threading.Thread(target=snapshot_job)
+        thread.daemon = True
+        thread.start()
+
+
+"""
+Synchronize with another replica by walking down the two Merkle trees together. We send the hashes the 
+replica has to compare at one level, starting from the root, and only go down into the nodes that differ. 
+When we reach the leaves, both replicas exchange the entries of the differing buckets and keep the winner 
+of every key(see choose_value). Replicas that agree cost a single request with one hash
+"""
+def merkle_sync(node):
+    levels = MERKLE_TREE.hashes()
+    indices = [0]
+    for level in range(MERKLE_TREE.depth + 1):
+        res = transport.put(node, '/kvs/sync', json={'mode': 'merkle_hashes', 'level': level, 'indices': indices}, timeout=0.8, adaptive=False)
+        count_sync_bytes(res)
+        hashes = res.json()['hashes']
+        differing = [i for i in indices if hashes[str(i)] != levels[level][i]]
+        if not differing:
+            return
+        if level < MERKLE_TREE.depth:
+            indices = [child for i in differing for child in MERKLE_TREE.children(i)]
+    with DB_LOCK:
+        entries = {key: get_entry(key) for key in MERKLE_TREE.keys_in(differing) if key in DB}
+    res = transport.put(node, '/kvs/sync', json={'mode': 'merkle_buckets', 'buckets': differing, 'entries': entries}, timeout=3, adaptive=False)
+    count_sync_bytes(res)
+    sync_database(res.json()['entries'])
+
+
+def count_sync_bytes(res):
+    SYNC_BYTES.inc('sent', amount=len(res.request.body or b''))
+    SYNC_BYTES.inc('received', amount=len(res.content))
+
+
+"""
+Pull the changes another replica made since our last sync with it from its change log. If we have never synced
+with it, it restarted, or we fell off its log, fall back to a Merkle sync and continue from its current sequence
+number next time
+"""
+def delta_sync(node):
+    log_id, since = PEER_SEQUENCE.get(node, (None, 0))
+    while True:
+        res = transport.put(node, '/kvs/sync', json={'mode': 'delta', 'log_id': log_id, 'since': since}, timeout=3, adaptive=False)
+        count_sync_bytes(res)
+        body = res.json()
+        if body.get('resync'):
+            merkle_sync(node)
+            PEER_SEQUENCE[node] = (body['log_id'], body['sequence'])
+            return
+        sync_database(body['entries'])
+        PEER_SEQUENCE[node] = (log_id, body['sequence'])
+        if not body['more']:
+            return
+        since = body['sequence']
+
+
+"""
+Route to synchronize database. The json body is one of
+{"mode": "delta", "log_id": "...", "since": 42}: return the entries changed after sequence number 42 of our 
+change log, or resync=true if the caller has to fall back to a Merkle sync
+{"mode": "merkle_hashes", "level": 1, "indices": [0, 3]}: return the hashes of these nodes of our Merkle tree
+{"mode": "merkle_buckets", "buckets": [5], "entries": {...}}: merge the entries and return ours in these buckets
+a json string of a whole database(older nodes): merge it and return our whole database
 """
 @app.route('/kvs/sync', methods=['GET', 'PUT', 'POST'])
 def sync():
-    DB2 = json.loads(request.get_json())
-    sync_database(DB2)
-    j = jsonify(current_DB=DB)
+    body = request.get_json()
+    if not isinstance(body, dict):
+        sync_database(json.loads(body))
+        with DB_LOCK:
+            j = jsonify(current_DB={key: get_entry(key) for key in DB})
+        return make_response(j, 200, {'Content-Type': 'application/json'})
+    if body['mode'] == 'delta':
+        changes = changes_since(body['since']) if body['log_id'] == LOG_ID else None
+        if changes is None:
+            j = jsonify(msg='success', resync=True, log_id=LOG_ID, sequence=SEQUENCE)
+        else:
+            entries, sequence = changes
+            j = jsonify(msg='success', resync=False, entries=entries, sequence=sequence, more=sequence < SEQUENCE)
+        return make_response(j, 200, {'Content-Type': 'application/json'})
+    if body['mode'] == 'merkle_hashes':
+        level = MERKLE_TREE.hashes()[body['level']]
+        j = jsonify(msg='success', hashes={i: level[i] for i in body['indices']})
+        return make_response(j, 200, {'Content-Type': 'application/json'})
+    sync_database(body['entries'])
+    with DB_LOCK:
+        entries = {key: get_entry(key) for key in MERKLE_TREE.keys_in(body['buckets']) if key in DB}
+    j = jsonify(msg='success', entries=entries)
     return make_response(j, 200, {'Content-Type': 'application/json'})
 
 
+"""
+Merge the entries of another replica into DB. Entries that went through json have their vector clock
+as a list(or a string from older nodes), so they are turned back into tuples first
+"""
 def sync_database(replica):
-    for key in replica.keys():
-        if key not in DB:
-            DB[key] = replica[key]
-        DB[key] = choose_value(DB[key], replica[key])
+    with DB_LOCK:
+        for key, entry in replica.items():
+            entry = [entry[0], decode_clock(entry[1]), entry[2]]
+            if key not in DB:
+                set_entry(key, entry)
+                continue
+            value = choose_value(DB[key], entry)
+            if value is not DB[key] and (value[1] != DB[key][1] or value[2] != DB[key][2]):
+                set_entry(key, value)
 
 """
 This function will return the value with either higher vector clock or timestamp
 """
 def choose_value(values1, values2):
-    causal_payload1 = values1[1]
-    causal_payload2 = values2[1]
     timestamp1 = values1[2]
     timestamp2 = values2[2]
-    if compare_casual_payloads(causal_payload1, causal_payload2) == 0:
+    result = compare_casual_payloads(values1[1], values2[1])
+    if result == 0:
         return values1
-    elif compare_casual_payloads(causal_payload1, causal_payload2) == 1:
+    elif result == 1:
         return values2
 
     if timestamp1 > timestamp2:
@@ -715,7 +2764,25 @@ if __name__ == "__main__":
     VIEW = os.getenv('VIEW')
     #Extract the number of replicas per partition
     NUMBER_OF_REPLICAS = int(os.getenv('K'))
+    transport.HEADERS['X-Node'] = IP_PORT
+    TRACER.node = IP_PORT
+    if READ_CACHE.enabled():
+        transport.HEADERS['X-Read-Cache'] = '1'
+    set_epoch(0)
+    #Load the database from disk if persistence is on
+    STORAGE = storage.open_storage(os.getenv('DATA_DIR'), sync=os.getenv('WAL_SYNC', '1') == '1',
+                                   snapshot_interval=float(os.getenv('SNAPSHOT_INTERVAL', 60)))
+    restore_database()
+    if os.getenv('DATA_DIR'):
+        HINTS.open(storage.open_storage(os.path.join(os.getenv('DATA_DIR'), 'hints'), sync=False,
+                                        snapshot_interval=float(os.getenv('SNAPSHOT_INTERVAL', 60))))
     #Need to handle empty view
     construct_initial_view(VIEW)
     handle_empty_view()
-    app.run(host="0.0.0.0", port=8080)
+    #Listen on the port of our ip_port, so several nodes can run on one host(see cluster.py)
+    port = int(IP_PORT.rsplit(':', 1)[1])
+    if os.getenv('SERVER') == 'async':
+        import async_server
+        async_server.run(sys.modules[__name__], host="0.0.0.0", port=port)
+    else:
+        app.run(host="0.0.0.0", port=port, threaded=True)
@@ -0,0 +1,257 @@
+"""
+Load generator and latency benchmark for the key-value store(it works against HW3 nodes too).
+Worker processes send a mix of reads, writes and misses(reads of keys that were never written) to a list
+of nodes for a fixed time, each in a closed loop on a keep-alive connection. Keys are chosen with a Zipf
+distribution over the key space, so a few keys are hot. The report is json: throughput and latency
+percentiles(p50, p95, p99, p999) of every operation, and the errors by operation and cause.
+
+e.g. python loadgen.py --nodes 127.0.0.1:8080,127.0.0.1:8081 --processes 8 --duration 30 --preload \
+        --mix read=0.8,write=0.15,miss=0.05 --keys 10000 --zipf 0.99 --value-size lognormal:200:1 --output report.json
+
+Size distributions(--key-size and --value-size, in characters):
+  fixed:N          always N
+  uniform:A:B      between A and B
+  lognormal:M:S    median M, sigma S(long tail of large values)
+"""
+import sys
+import json
+import math
+import random
+import argparse
+from bisect import bisect_left
+from itertools import accumulate
+from multiprocessing import Pool
+from time import perf_counter, time, sleep
+import requests
+
+
+OPERATIONS = ('read', 'write', 'miss')
+PERCENTILES = (('p50', 50), ('p95', 95), ('p99', 99), ('p999', 99.9))
+
+
+"""
+Return a function rng -> size for a size distribution spec(see the module docstring)
+"""
+def parse_size(spec):
+    kind, *args = spec.split(':')
+    if kind == 'fixed':
+        size = int(args[0])
+        return lambda rng: size
+    if kind == 'uniform':
+        low, high = int(args[0]), int(args[1])
+        return lambda rng: rng.randint(low, high)
+    if kind == 'lognormal':
+        median, sigma = float(args[0]), float(args[1])
+        return lambda rng: max(1, int(rng.lognormvariate(math.log(median), sigma)))
+    raise argparse.ArgumentTypeError('unknown size distribution ' + spec)
+
+
+"""
+Turn 'read=0.8,write=0.2' into the cumulative weights of OPERATIONS
+"""
+def parse_mix(spec):
+    weights = dict.fromkeys(OPERATIONS, 0.0)
+    for part in spec.split(','):
+        name, weight = part.split('=')
+        if name not in weights:
+            raise argparse.ArgumentTypeError('unknown operation ' + name)
+        weights[name] = float(weight)
+    total = sum(weights.values())
+    if total <= 0:
+        raise argparse.ArgumentTypeError('the mix has no operation')
+    return list(accumulate(weights[name] / total for name in OPERATIONS))
+
+
+"""
+Name of the key of rank index. The ranks are scattered over the names(multiplication by an odd number is a
+bijection modulo 2**32) so the hot keys land on different partitions. Keys are padded to a size drawn from
+key_size with a generator seeded by the rank, so every process picks the same name for a key
+"""
+def key_name(prefix, index, key_size):
+    name = '%s%d' % (prefix, (index * 2654435761) % 2**32)
+    size = min(250, key_size(random.Random(index)))
+    return name + '_' * (size - len(name)) if size > len(name) else name
+
+
+"""
+Cumulative weights of the ranks of a Zipf distribution with exponent s(0 is uniform)
+"""
+def zipf_cdf(keys, s):
+    return list(accumulate(1.0 / (rank ** s) for rank in range(1, keys + 1)))
+
+
+def pick(cdf, rng):
+    return min(bisect_left(cdf, rng.random() * cdf[-1]), len(cdf) - 1)
+
+
+def nearest_rank(ordered, percent):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(math.ceil(percent / 100.0 * len(ordered))) - 1))]
+
+
+"""
+Write every key once so reads find them. Batches go to /kvs/mput, nodes that do not have it(HW3) get
+one PUT per key
+"""
+def preload(args, worker):
+    key_size = parse_size(args.key_size)
+    value_size = parse_size(args.value_size)
+    rng = random.Random(args.seed * 1000 + worker)
+    session = requests.Session()
+    indices = list(range(worker, args.keys, args.processes))
+    batch_route = True
+    for start in range(0, len(indices), args.batch):
+        entries = [{'key': key_name('k', index, key_size), 'value': 'v' * value_size(rng), 'causal_payload': ''}
+                   for index in indices[start:start + args.batch]]
+        node = args.nodes[(start // args.batch + worker) % len(args.nodes)]
+        if batch_route:
+            res = session.put('http://' + node + '/kvs/mput', json={'entries': entries}, timeout=args.timeout * 10)
+            if res.status_code == 200:
+                continue
+            batch_route = False
+        for entry in entries:
+            session.put('http://' + node + '/kvs', data=entry, timeout=args.timeout)
+    return len(indices)
+
+
+"""
+Run the load of one worker process until the end of the run and return its latencies and errors
+"""
+def run_worker(args, worker, start_at):
+    rng = random.Random(args.seed * 1000 + worker + 1)
+    key_size = parse_size(args.key_size)
+    value_size = parse_size(args.value_size)
+    mix = parse_mix(args.mix)
+    cdf = zipf_cdf(args.keys, args.zipf)
+    names = {}
+    session = requests.Session()
+    latencies = {name: [] for name in OPERATIONS}
+    errors = {}
+    interval = 1.0 / args.rate if args.rate else 0
+    measure_from = start_at + args.warmup
+    end = start_at + args.warmup + args.duration
+    while time() < start_at:
+        sleep(0.001)
+    next_at = perf_counter()
+    while time() < end:
+        operation = OPERATIONS[min(bisect_left(mix, rng.random()), len(OPERATIONS) - 1)]
+        node = args.nodes[rng.randrange(len(args.nodes))]
+        if operation == 'miss':
+            key = key_name('miss', rng.randrange(2**31), key_size)
+        else:
+            index = pick(cdf, rng)
+            key = names.get(index)
+            if key is None:
+                key = names[index] = key_name('k', index, key_size)
+        started = perf_counter()
+        measured = time() >= measure_from
+        try:
+            if operation == 'write':
+                res = session.put('http://' + node + '/kvs', data={'key': key, 'value': 'v' * value_size(rng), 'causal_payload': ''},
+                                  timeout=args.timeout)
+                ok = res.status_code in (200, 201)
+            else:
+                res = session.get('http://' + node + '/kvs', params={'key': key, 'causal_payload': ''}, timeout=args.timeout)
+                ok = res.status_code == (404 if operation == 'miss' else 200)
+            cause = 'status %d' % res.status_code
+        except requests.exceptions.RequestException as error:
+            ok = False
+            cause = type(error).__name__
+        if measured:
+            latencies[operation].append(perf_counter() - started)
+            if not ok:
+                name = operation + ' ' + cause
+                errors[name] = errors.get(name, 0) + 1
+        if interval:
+            next_at += interval
+            delay = next_at - perf_counter()
+            if delay > 0:
+                sleep(delay)
+    return latencies, errors
+
+
+def call_worker(job):
+    args, worker, start_at = job
+    return run_worker(args, worker, start_at)
+
+
+def call_preload(job):
+    args, worker = job
+    return preload(args, worker)
+
+
+"""
+Merge the results of the workers into the json report
+"""
+def report(args, results):
+    latencies = {name: [] for name in OPERATIONS}
+    errors = {}
+    for worker_latencies, worker_errors in results:
+        for name in OPERATIONS:
+            latencies[name].extend(worker_latencies[name])
+        for name, count in worker_errors.items():
+            errors[name] = errors.get(name, 0) + count
+    operations = {}
+    for name in OPERATIONS:
+        ordered = sorted(latencies[name])
+        if not ordered:
+            continue
+        failed = sum(count for error, count in errors.items() if error.split(' ', 1)[0] == name)
+        latency = {'mean': sum(ordered) / len(ordered) * 1000, 'max': ordered[-1] * 1000}
+        for label, percent in PERCENTILES:
+            latency[label] = nearest_rank(ordered, percent) * 1000
+        operations[name] = {'count': len(ordered), 'errors': failed, 'throughput': len(ordered) / args.duration,
+                            'latency_ms': {key: round(value, 3) for key, value in latency.items()}}
+    count = sum(len(values) for values in latencies.values())
+    return {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'total': {'count': count, 'errors': sum(errors.values()), 'throughput': count / args.duration},
+        'operations': operations,
+        'errors': errors,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load generator and latency benchmark for the key-value store')
+    parser.add_argument('--nodes', required=True, type=lambda value: value.split(','), help='comma separated ip:port of the nodes')
+    parser.add_argument('--processes', type=int, default=4, help='number of worker processes')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of measured load')
+    parser.add_argument('--warmup', type=float, default=1, help='seconds of load before measuring')
+    parser.add_argument('--mix', default='read=0.9,write=0.1', help='weights of read, write and miss')
+    parser.add_argument('--keys', type=int, default=10000, help='number of keys reads and writes pick from')
+    parser.add_argument('--zipf', type=float, default=0.99, help='exponent of the Zipf distribution of the keys(0 is uniform)')
+    parser.add_argument('--key-size', default='fixed:12', help='size distribution of the keys')
+    parser.add_argument('--value-size', default='fixed:100', help='size distribution of the values')
+    parser.add_argument('--rate', type=float, default=0, help='operations per second of each process(0 is as fast as it can)')
+    parser.add_argument('--timeout', type=float, default=5, help='seconds a request may take')
+    parser.add_argument('--preload', action='store_true', help='write every key once before the run')
+    parser.add_argument('--batch', type=int, default=500, help='keys per request of the preload')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='also write the report to this file')
+    args = parser.parse_args(argv)
+    parse_size(args.key_size)
+    parse_size(args.value_size)
+    parse_mix(args.mix)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with Pool(args.processes) as pool:
+        if args.preload:
+            pool.map(call_preload, [(args, worker) for worker in range(args.processes)])
+        #every worker starts at the same time, after the processes are up
+        start_at = time() + 0.5
+        results = pool.map(call_worker, [(args, worker, start_at) for worker in range(args.processes)])
+    result = report(args, results)
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+    return result
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
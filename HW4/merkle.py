@@ -0,0 +1,90 @@
+"""
+Merkle tree over the keys of a replica, used by anti-entropy to find the keys two replicas disagree on.
+The keys are hashed into fanout**depth buckets(the leaves). The hash of a leaf is the XOR of the hashes of
+its entries, so a write updates it in O(1) without looking at the other keys of the bucket. The hash of an
+inner node is the md5 of the hashes of its children, recomputed lazily when someone asks for it.
+"""
+import hashlib
+import json
+import threading
+from blob_store import value_digest
+
+
+class MerkleTree:
+
+    def __init__(self, fanout=16, depth=2):
+        self.fanout = fanout
+        self.depth = depth
+        self.size = fanout ** depth
+        self.leaves = [0] * self.size
+        self.bucket_keys = [set() for i in range(self.size)]
+        self.levels = None
+        self.lock = threading.Lock()
+
+    """
+    Return the leaf a key belongs to
+    """
+    def bucket(self, key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16) % self.size
+
+    """
+    Hash of a key together with its entry [value, causal_payload, timestamp], so two replicas that have the
+    same key with a different version end up with different leaves. The value is hashed through its digest,
+    so it does not matter whether a replica keeps it in DB or in the blob store
+    """
+    def entry_hash(self, key, entry):
+        data = key + '|' + value_digest(entry[0]) + '|' + json.dumps(list(entry[1:]), separators=(',', ':'))
+        return int(hashlib.md5(data.encode('utf-8')).hexdigest(), 16)
+
+    """
+    Replace the old entry of a key by the new one(either can be None when the key is added or removed)
+    """
+    def update(self, key, old_entry, new_entry):
+        b = self.bucket(key)
+        with self.lock:
+            if old_entry is not None:
+                self.leaves[b] ^= self.entry_hash(key, old_entry)
+            if new_entry is not None:
+                self.leaves[b] ^= self.entry_hash(key, new_entry)
+                self.bucket_keys[b].add(key)
+            else:
+                self.bucket_keys[b].discard(key)
+            self.levels = None
+
+    """
+    Return the hashes of every level of the tree, level 0 is the root and level depth are the leaves
+    """
+    def hashes(self):
+        with self.lock:
+            if self.levels is None:
+                levels = [['%032x' % leaf for leaf in self.leaves]]
+                while len(levels[0]) > 1:
+                    children = levels[0]
+                    parents = []
+                    for i in range(0, len(children), self.fanout):
+                        parents.append(hashlib.md5(''.join(children[i:i+self.fanout]).encode('utf-8')).hexdigest())
+                    levels.insert(0, parents)
+                self.levels = levels
+            return self.levels
+
+    def root(self):
+        return self.hashes()[0][0]
+
+    """
+    Return the indices of the children of a node at the next level
+    """
+    def children(self, index):
+        return list(range(index*self.fanout, (index+1)*self.fanout))
+
+    """
+    Return the keys stored in a list of leaves
+    """
+    def keys_in(self, buckets):
+        with self.lock:
+            return [key for b in buckets for key in self.bucket_keys[b]]
+
+    def clear(self):
+        with self.lock:
+            self.leaves = [0] * self.size
+            self.bucket_keys = [set() for i in range(self.size)]
+            self.levels = None
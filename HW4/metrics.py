@@ -0,0 +1,139 @@
+"""
+Counters, gauges and histograms of a node, rendered in the Prometheus text format by /kvs/metrics.
+Recording is a dictionary lookup and a few additions under the lock of the metric, so it stays on under load.
+Histogram buckets are fixed when the metric is created and counted one by one, they are only added up
+into the cumulative counts Prometheus expects when the metrics are rendered
+"""
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 16, 32, 64, 128)
+
+
+"""
+Every metric created, in the order they are rendered
+"""
+REGISTRY = []
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('%s="%s"' % (name, value))
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name + format_labels(self.labels, labels), value) for labels, value in self.values.items()]
+
+
+"""
+A gauge reads its value when the metrics are rendered: read() returns a number, or {label values: number}
+"""
+class Gauge:
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, read, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.read = read
+        REGISTRY.append(self)
+
+    def samples(self):
+        values = self.read()
+        if not isinstance(values, dict):
+            return [(self.name, values)]
+        return [(self.name + format_labels(self.labels, labels), value) for labels, value in values.items()]
+
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        #{label values: [count of every bucket and of +Inf, sum]}
+        self.series = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 2)
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self.lock:
+            series = [(labels, counts[:]) for labels, counts in self.series.items()]
+        samples = []
+        for labels, counts in series:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                samples.append((self.name + '_bucket' + format_labels(self.labels + ('le',), labels + (bound,)), total))
+            samples.append((self.name + '_sum' + format_labels(self.labels, labels), counts[-1]))
+            samples.append((self.name + '_count' + format_labels(self.labels, labels), total))
+        return samples
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for name, value in metric.samples():
+            lines.append('%s %s' % (name, repr(float(value)) if isinstance(value, float) else value))
+    return '\n'.join(lines) + '\n'
+
+
+"""
+Number of peer requests the request being handled has sent so far([count], None outside of a request).
+A context variable, so it follows a request on its thread and on its task of the event loop
+"""
+PEER_CALLS = ContextVar('peer_calls', default=None)
+
+
+def start_request():
+    PEER_CALLS.set([0])
+
+
+def add_peer_calls(count):
+    calls = PEER_CALLS.get()
+    if calls is not None:
+        calls[0] += count
+
+
+def peer_calls():
+    calls = PEER_CALLS.get()
+    return 0 if calls is None else calls[0]
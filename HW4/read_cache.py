@@ -0,0 +1,71 @@
+"""
+Read-through cache for hot keys on nodes outside the partition that owns them. It keeps the response body of
+the owner together with the vector clock of the value, evicts the least recently used entries when it holds
+more than max_bytes, and drops entries older than ttl seconds. kvs.py invalidates entries when an owner
+notifies a write, and skips the cache when a client shows a causal payload the cached value has not seen.
+"""
+import threading
+from collections import OrderedDict
+from time import time
+
+
+class ReadCache:
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        #{key: (body, vector clock, time it was cached)}
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def enabled(self):
+        return self.max_bytes > 0
+
+    """
+    Return (body, vector clock) of a key, or None if it is not cached or has expired
+    """
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time() - entry[2] > self.ttl:
+                if entry is not None:
+                    self.remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, key, body, clock):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (body, clock, time())
+            self.bytes += len(body)
+            while self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    """
+    Remove a key, the lock must be held
+    """
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(entry[0])
+
+    def status(self):
+        return {'keys': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses}
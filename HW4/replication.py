@@ -0,0 +1,146 @@
+"""
+Asynchronous replication of writes to the other members of a partition. Every peer has its own queue of
+pending writes: a write to a key that is still queued replaces the queued one(coalescing), and the queue is
+flushed by a thread of its own when it holds batch_size keys or its oldest write waited flush_interval
+seconds. A write stays queued until the peer acknowledged it, so a failed batch is sent again. A queue
+holds at most max_pending keys: a writer waits up to block_timeout seconds for room(backpressure), then
+the write goes to overflow, which kvs.py keeps as a hint. So do the queued writes of a peer that died.
+The queue of a peer that left the view is dropped with stop(node), which also ends its thread.
+"""
+import threading
+from collections import OrderedDict
+from time import time
+
+
+class ReplicationQueue:
+
+    """
+    send(node, [(key, entry)]) sends a batch to a peer and returns the keys it acknowledged, or raises.
+    overflow(node, key, entry) takes the writes that could not be queued or sent, alive(node) tells if a
+    peer is still worth sending to
+    """
+    def __init__(self, send, overflow, alive, batch_size, flush_interval, max_pending, block_timeout):
+        self.send = send
+        self.overflow = overflow
+        self.alive = alive
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.block_timeout = block_timeout
+        #{node: {key: entry}}, oldest write first
+        self.queues = {}
+        #{node: time the oldest write in the queue was queued}
+        self.oldest = {}
+        self.stats = {'queued': 0, 'coalesced': 0, 'sent': 0, 'batches': 0, 'failed_batches': 0, 'overflowed': 0, 'dropped': 0}
+        self.lock = threading.Lock()
+        #{node: condition on lock}, so a write only wakes the thread and the writers of its peer
+        self.conditions = {}
+
+    """
+    Queue a write for a peer. With block False a full queue sends it to overflow without waiting
+    """
+    def push(self, node, key, entry, block=True):
+        with self.lock:
+            queue = self.queues.get(node)
+            if queue is None:
+                queue = self.queues[node] = OrderedDict()
+                self.conditions[node] = threading.Condition(self.lock)
+                thread = threading.Thread(target=self.flush_job, args=(node, queue, self.conditions[node]))
+                thread.daemon = True
+                thread.start()
+            condition = self.conditions[node]
+            if key in queue:
+                del queue[key]
+                self.stats['coalesced'] += 1
+            else:
+                deadline = time() + (self.block_timeout if block else 0)
+                while len(queue) >= self.max_pending and time() < deadline and self.queues.get(node) is queue:
+                    condition.wait(deadline - time())
+                if self.queues.get(node) is not queue:
+                    #the peer left the view while we waited
+                    self.stats['dropped'] += 1
+                    return
+            full = len(queue) >= self.max_pending
+            if full:
+                self.stats['overflowed'] += 1
+            else:
+                queue[key] = entry
+                self.stats['queued'] += 1
+                if node not in self.oldest:
+                    self.oldest[node] = time()
+                    condition.notify_all()
+                elif len(queue) >= self.batch_size:
+                    condition.notify_all()
+        if full:
+            self.overflow(node, key, entry)
+
+    """
+    Send the queue of a peer until it is stopped
+    """
+    def flush_job(self, node, queue, condition):
+        failures = 0
+        while True:
+            with self.lock:
+                while self.queues.get(node) is queue and (not queue or (len(queue) < self.batch_size and
+                                                                        time() - self.oldest[node] < self.flush_interval)):
+                    condition.wait(None if not queue else self.oldest[node] + self.flush_interval - time())
+                if self.queues.get(node) is not queue:
+                    return
+                batch = [(key, queue[key]) for key, _ in zip(queue, range(self.batch_size))]
+            if not self.alive(node):
+                self.give_up(node, queue)
+                continue
+            try:
+                acknowledged = set(self.send(node, batch))
+            except Exception:
+                acknowledged = set()
+            #a peer that answers with an error acknowledges nothing, it is backed off like one that does not answer
+            failures = 0 if acknowledged else failures + 1
+            with self.lock:
+                self.stats['batches'] += 1
+                if not acknowledged:
+                    self.stats['failed_batches'] += 1
+                if self.queues.get(node) is not queue:
+                    return
+                for key, entry in batch:
+                    if key in acknowledged and queue.get(key) is entry:
+                        del queue[key]
+                        self.stats['sent'] += 1
+                if not queue:
+                    self.oldest.pop(node, None)
+                condition.notify_all()
+            if failures:
+                #the peer is slow or down: wait before sending again, the failure detector may declare it dead
+                threading.Event().wait(min(self.flush_interval * 2 ** failures, 1))
+
+    """
+    Hand the queued writes of a dead peer to overflow
+    """
+    def give_up(self, node, queue):
+        with self.lock:
+            if self.queues.get(node) is not queue:
+                return
+            pending = list(queue.items())
+            queue.clear()
+            self.oldest.pop(node, None)
+            self.stats['overflowed'] += len(pending)
+            self.conditions[node].notify_all()
+        for key, entry in pending:
+            self.overflow(node, key, entry)
+
+    """
+    Drop the queue of a peer that left the view and end its thread. Its writes are not kept as hints, the
+    keys it should have had are moved by the rebalance of the new view
+    """
+    def stop(self, node):
+        with self.lock:
+            queue = self.queues.pop(node, None)
+            if queue is None:
+                return
+            self.stats['dropped'] += len(queue)
+            self.oldest.pop(node, None)
+            self.conditions.pop(node).notify_all()
+
+    def status(self):
+        with self.lock:
+            return dict(self.stats, pending={node: len(queue) for node, queue in self.queues.items()})
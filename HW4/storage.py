@@ -0,0 +1,228 @@
+"""
+Persistence of the database of a node, so a restarted node comes back with its keys instead of being
+refilled by anti-entropy. open_storage returns MemoryStorage(nothing is written) when no directory is
+configured, or DiskStorage, which keeps:
+  wal-<n>.log    append-only write-ahead log, one json record per line, in numbered segments
+  snapshot.json  a compact copy of the whole database and the first wal segment that is not in it
+Writes are made durable with group commit: a flusher thread fsyncs the log for every writer that is
+waiting at that moment, instead of one fsync per write.
+"""
+import os
+import json
+import threading
+from time import time
+
+
+"""
+Storage that keeps nothing, used when persistence is off
+"""
+class MemoryStorage:
+
+    persistent = False
+
+    def load(self):
+        return {}
+
+    def log_put(self, key, entry):
+        return 0
+
+    def log_delete(self, key):
+        return 0
+
+    def wait(self, ticket):
+        pass
+
+    def should_snapshot(self):
+        return False
+
+    def snapshot(self, rotate):
+        pass
+
+    def close(self):
+        pass
+
+
+class DiskStorage:
+
+    persistent = True
+
+    def __init__(self, directory, sync=True, commit_interval=0.005, snapshot_interval=60, snapshot_bytes=64*1024*1024):
+        self.directory = directory
+        self.sync = sync
+        self.commit_interval = commit_interval
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_bytes = snapshot_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.committed = threading.Condition(self.lock)
+        #ticket of the last record appended and of the last record that is on disk
+        self.appended = 0
+        self.synced = 0
+        self.segment = None
+        self.file = None
+        self.segment_bytes = 0
+        #bytes of the wal segments replayed by load, they are in the log but not in the snapshot yet
+        self.replayed_bytes = 0
+        self.last_snapshot = time()
+        self.closed = False
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def segments(self):
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith('wal-') and name.endswith('.log'):
+                numbers.append(int(name[4:-4]))
+        return sorted(numbers)
+
+    """
+    Read the snapshot and replay the wal segments written after it. Return the database {key: entry}
+    A record cut in half by a crash can only be the last line of a segment and is skipped
+    """
+    def load(self):
+        db = {}
+        first_segment = 0
+        if os.path.exists(self.path('snapshot.json')):
+            with open(self.path('snapshot.json')) as f:
+                snapshot = json.load(f)
+            db = snapshot['db']
+            first_segment = snapshot['segment']
+        segments = self.segments()
+        for segment in segments:
+            if segment < first_segment:
+                continue
+            self.replayed_bytes += os.path.getsize(self.path('wal-%d.log' % segment))
+            with open(self.path('wal-%d.log' % segment)) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if record[0] == 'put':
+                        db[record[1]] = record[2]
+                    else:
+                        db.pop(record[1], None)
+        self.open_segment(max(segments + [first_segment - 1]) + 1)
+        flusher = threading.Thread(target=self.flush_job)
+        flusher.daemon = True
+        flusher.start()
+        return db
+
+    def open_segment(self, segment):
+        self.segment = segment
+        self.file = open(self.path('wal-%d.log' % segment), 'a')
+        self.segment_bytes = 0
+
+    """
+    Append a record to the log and return its ticket. The record is on disk once wait(ticket) returns
+    """
+    def append(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.segment_bytes += len(line)
+            self.appended += 1
+            self.committed.notify_all()
+            return self.appended
+
+    def log_put(self, key, entry):
+        return self.append(['put', key, entry])
+
+    def log_delete(self, key):
+        return self.append(['del', key])
+
+    """
+    Block until the record of the ticket has been fsynced(returns right away if sync is off)
+    """
+    def wait(self, ticket):
+        if not self.sync or not ticket:
+            return
+        with self.lock:
+            while self.synced < ticket and not self.closed:
+                self.committed.wait()
+
+    """
+    Group commit: whenever records are waiting, flush and fsync all of them at once, then wake up their writers
+    """
+    def flush_job(self):
+        while not self.closed:
+            with self.lock:
+                while self.synced == self.appended and not self.closed:
+                    self.committed.wait()
+                if self.closed:
+                    return
+                self.file.flush()
+                ticket = self.appended
+                fd = os.dup(self.file.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            with self.lock:
+                self.synced = max(self.synced, ticket)
+                self.committed.notify_all()
+            if self.commit_interval:
+                #let more writers join the next group
+                threading.Event().wait(self.commit_interval)
+
+    """
+    A snapshot is due when the log grew by snapshot_bytes, or every snapshot_interval seconds if it grew at all
+    """
+    def should_snapshot(self):
+        grown = self.segment_bytes + self.replayed_bytes
+        return grown >= self.snapshot_bytes or (grown > 0 and time() - self.last_snapshot >= self.snapshot_interval)
+
+    """
+    Write a snapshot and drop the log segments it covers. rotate() is called by the caller with the database
+    locked: it has to call start_segment() and return a copy of the database at that point
+    """
+    def snapshot(self, rotate):
+        db, segment = rotate()
+        tmp = self.path('snapshot.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'segment': segment, 'db': db}, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path('snapshot.json'))
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        for old in self.segments():
+            if old < segment:
+                os.remove(self.path('wal-%d.log' % old))
+        self.replayed_bytes = 0
+        self.last_snapshot = time()
+
+    """
+    Close the current log segment and start the next one. Return the number of the new segment
+    """
+    def start_segment(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.synced = self.appended
+            self.committed.notify_all()
+            self.file.close()
+            self.open_segment(self.segment + 1)
+            return self.segment
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.committed.notify_all()
+
+
+"""
+Return DiskStorage in directory, or MemoryStorage if directory is empty
+"""
+def open_storage(directory, **kwargs):
+    if not directory:
+        return MemoryStorage()
+    return DiskStorage(directory, **kwargs)
@@ -0,0 +1,116 @@
+"""
+Error paths of the data path served on the event loop(see async_server.py). The other nodes of the view are
+faked: a node answers only the requests a test gives it an answer for
+"""
+import asyncio
+import json
+from collections import OrderedDict
+import pytest
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp.test_utils import TestClient, TestServer
+import async_server
+
+
+@pytest.fixture
+def server(node, monkeypatch):
+    monkeypatch.setattr(node, 'JOBS_STARTED', True)
+    monkeypatch.setattr(node, 'PARTITION_MEMBERS', [])
+    monkeypatch.setattr(node, 'LOCATION_CACHE', OrderedDict())
+    #{(node, path): (status, fields)}
+    node.answers = {}
+    node.calls = []
+    async def call_peer(kvs, session, peer, method, path, params, deadline):
+        node.calls.append((peer, path))
+        if (peer, path) not in node.answers:
+            raise aiohttp.ClientConnectionError(peer + ' is unreachable')
+        status, fields = node.answers[(peer, path)]
+        return status, json.dumps(fields).encode('utf-8'), peer
+    monkeypatch.setattr(async_server, 'call_peer', call_peer)
+    node.rebuild_ring()
+    return node
+
+
+def call(kvs, method, path, **kwargs):
+    async def send():
+        async with TestClient(TestServer(async_server.make_app(kvs))) as client:
+            res = await client.request(method, path, **kwargs)
+            return res.status, json.loads(await res.text())
+    return asyncio.run(send())
+
+
+def key_of(kvs, partition_id):
+    return next(key for key in ('key%d' % i for i in range(100)) if kvs.get_owner_partition(key) == partition_id)
+
+
+def test_get_of_an_invalid_key(server):
+    status, fields = call(server, 'GET', '/kvs', params={'key': 'not-valid', 'causal_payload': ''})
+    assert status == 404 and fields['error'] == 'Key not valid'
+
+
+def test_put_without_a_value(server):
+    status, fields = call(server, 'PUT', '/kvs', data={'key': 'foo', 'causal_payload': ''})
+    assert status == 404 and fields['error'] == 'No value provided'
+
+
+def test_get_when_no_member_of_the_owner_answers(server):
+    status, fields = call(server, 'GET', '/kvs', params={'key': key_of(server, 1), 'causal_payload': ''})
+    assert status == 404 and fields['error'] == 'key value store is not available'
+    assert sorted(peer for peer, path in server.calls) == ['10.0.0.22:8080', '10.0.0.23:8080']
+
+
+def test_put_when_no_member_of_the_owner_answers(server):
+    status, fields = call(server, 'PUT', '/kvs', data={'key': key_of(server, 1), 'value': 'bar', 'causal_payload': ''})
+    assert status == 404 and fields['error'] == 'key value store is not available'
+
+
+def test_get_of_a_key_no_member_has(server):
+    server.answers[('10.0.0.21:8080', '/kvs/get_key')] = (404, {'msg': 'error', 'error': 'key does not exist'})
+    status, fields = call(server, 'GET', '/kvs', params={'key': key_of(server, 0), 'causal_payload': ''})
+    assert status == 404 and fields['error'] == 'key does not exist'
+
+
+def test_get_key_of_a_key_we_do_not_have(server):
+    status, fields = call(server, 'GET', '/kvs/get_key', params={'key': 'foo', 'causal_payload': ''})
+    assert status == 404 and fields['error'] == 'key does not exist'
+
+
+def test_add_key_of_another_partition_is_refused(server):
+    status, fields = call(server, 'PUT', '/kvs/add_key', data={'key': key_of(server, 1), 'value': 'bar', 'causal_payload': ''})
+    assert status == 409 and fields['epoch'] == server.EPOCH
+
+
+def test_other_routes_are_served_by_the_flask_app(server):
+    status, fields = call(server, 'PUT', '/kvs/mget', data=json.dumps({'keys': ['not-valid']}))
+    assert status == 200 and fields['results']['not-valid']['error'] == 'Key not valid'
+
+
+def test_receive_keys_refuses_a_malformed_line(server):
+    body = server.entry_line('a', ['1', (1, 0), 1.0]) + b'{"key": "b", "val\n'
+    status, fields = call(server, 'PUT', '/kvs/receive_keys', data=body, headers={'Content-Type': 'application/x-ndjson'})
+    assert status == 400 and fields['error'] == 'malformed entry'
+
+
+def test_value_of_the_blob_store_is_written_from_the_mapping(server, monkeypatch):
+    monkeypatch.setattr(server, 'BLOB_THRESHOLD', 10)
+    monkeypatch.setattr(server, 'BLOB_STORE', None)
+    server.set_entry('a', ['large "value" ' * 5, (1, 0), 1.0])
+    status, fields = call(server, 'GET', '/kvs/get_key', params={'key': 'a', 'causal_payload': ''})
+    assert status == 200 and fields['value'] == 'large "value" ' * 5
+
+
+def test_read_returns_the_newest_answer_and_repairs_the_others(server, monkeypatch):
+    repairs = []
+    monkeypatch.setattr(server, 'read_repair', repairs.append)
+    server.answers[('10.0.0.22:8080', '/kvs/get_key')] = (200, {'msg': 'success', 'value': 'old', 'partition_id': 1,
+                                                                  'causal_payload': '0.1', 'timestamp': '1.0'})
+    server.answers[('10.0.0.23:8080', '/kvs/get_key')] = (200, {'msg': 'success', 'value': 'new', 'partition_id': 1,
+                                                                  'causal_payload': '1.1', 'timestamp': '2.0'})
+    key = key_of(server, 1)
+    async def send():
+        async with TestClient(TestServer(async_server.make_app(server))) as client:
+            res = await client.get('/kvs', params={'key': key, 'causal_payload': ''})
+            fields = json.loads(await res.text())
+            await asyncio.gather(*async_server.BACKGROUND)
+            return fields
+    assert asyncio.run(send())['value'] == 'new'
+    assert repairs == [{'10.0.0.22:8080': {key: ['new', (1, 1), 2.0]}}]
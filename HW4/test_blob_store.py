@@ -0,0 +1,65 @@
+"""
+Large values kept in the memory-mapped blob store(see blob_store.py and store_value in kvs.py)
+"""
+import json
+from blob_store import BlobStore, BlobRef, value_digest
+
+
+def test_value_is_read_back_json_encoded():
+    store = BlobStore(capacity=4096)
+    ref = store.put('value "quoted"')
+    assert ref.read() == json.dumps('value "quoted"').encode('utf-8')
+    assert ref.value() == 'value "quoted"'
+
+
+def test_values_do_not_overlap():
+    store = BlobStore(capacity=4096)
+    refs = [store.put('v%d' % i * 10) for i in range(20)]
+    assert [ref.value() for ref in refs] == ['v%d' % i * 10 for i in range(20)]
+
+
+def test_store_grows_past_its_capacity():
+    store = BlobStore(capacity=1024)
+    small = store.put('a' * 100)
+    large = store.put('b' * 5000)
+    assert len(store.mm) >= 5000
+    assert small.value() == 'a' * 100 and large.value() == 'b' * 5000
+
+
+def test_digest_is_the_digest_of_the_plain_value():
+    store = BlobStore(capacity=4096)
+    assert store.put('value').digest == value_digest('value')
+    assert value_digest(store.put('value')) == value_digest('value')
+
+
+def test_freed_values_are_garbage_until_compacted():
+    store = BlobStore(capacity=4096)
+    kept = store.put('k' * 100)
+    freed = store.put('f' * 200)
+    store.free(freed)
+    assert store.garbage() == freed.length
+    compacted, moved = store.compact([kept])
+    assert compacted.garbage() == 0
+    assert moved[kept].value() == 'k' * 100
+    assert moved[kept].digest == kept.digest
+
+
+def test_large_values_of_the_database_go_to_the_blob_store(node, monkeypatch):
+    monkeypatch.setattr(node, 'BLOB_THRESHOLD', 10)
+    monkeypatch.setattr(node, 'BLOB_STORE', BlobStore(capacity=4096))
+    node.set_entry('small', ['short', (1, 0), 1.0])
+    node.set_entry('large', ['x' * 100, (1, 0), 1.0])
+    assert node.DB['small'][0] == 'short'
+    assert isinstance(node.DB['large'][0], BlobRef)
+    assert node.get_entry('large') == ['x' * 100, (1, 0), 1.0]
+    node.set_entry('large', ['short', (2, 0), 2.0])
+    assert node.BLOB_STORE.garbage() > 0
+
+
+def test_read_is_a_view_of_the_mapping():
+    store = BlobStore(capacity=1024)
+    ref = store.put('a' * 100)
+    data = ref.read()
+    assert isinstance(data, memoryview) and data.obj is store.mm
+    store.put('b' * 5000)
+    assert bytes(data) == json.dumps('a' * 100).encode('utf-8')
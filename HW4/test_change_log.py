@@ -0,0 +1,60 @@
+"""
+Sequencing of the change log that delta_sync pulls from(see changes_since in kvs.py)
+"""
+
+
+def entry(i):
+    return ['value%d' % i, (i, 0), 1000.0 + i]
+
+
+def test_changes_come_with_the_sequence_they_go_up_to(node):
+    for i in range(3):
+        node.set_entry('key%d' % i, entry(i))
+    assert node.changes_since(0) == ({'key0': entry(0), 'key1': entry(1), 'key2': entry(2)}, 3)
+    assert node.changes_since(2) == ({'key2': entry(2)}, 3)
+
+
+def test_nothing_new_returns_the_same_sequence(node):
+    assert node.changes_since(0) == ({}, 0)
+    node.set_entry('key', entry(1))
+    assert node.changes_since(1) == ({}, 1)
+
+
+def test_key_changed_twice_is_sent_once_with_its_last_entry(node):
+    node.set_entry('key', entry(1))
+    node.set_entry('key', entry(2))
+    assert node.changes_since(0) == ({'key': entry(2)}, 2)
+
+
+def test_deleted_key_is_not_sent(node):
+    node.set_entry('key', entry(1))
+    node.set_entry('other', entry(2))
+    node.delete_entry('key')
+    assert node.changes_since(0) == ({'other': entry(2)}, 3)
+
+
+def test_sequence_from_the_future_is_unknown(node):
+    node.set_entry('key', entry(1))
+    assert node.changes_since(5) is None
+
+
+def test_sequence_older_than_the_log_is_unknown(node):
+    for i in range(node.CHANGE_LOG.maxlen + 10):
+        node.set_entry('key%d' % i, entry(i))
+    assert node.changes_since(0) is None
+    assert node.changes_since(9) is None
+    entries, sequence = node.changes_since(10)
+    assert len(entries) == node.CHANGE_LOG.maxlen and sequence == node.SEQUENCE
+
+
+def test_changes_are_sent_in_batches(node, monkeypatch):
+    monkeypatch.setattr(node, 'DELTA_BATCH', 4)
+    for i in range(10):
+        node.set_entry('key%d' % i, entry(i))
+    since = 0
+    pulled = {}
+    while since < node.SEQUENCE:
+        entries, since = node.changes_since(since)
+        assert len(entries) <= 4
+        pulled.update(entries)
+    assert pulled == {'key%d' % i: entry(i) for i in range(10)}
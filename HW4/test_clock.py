@@ -0,0 +1,87 @@
+"""
+Vector clocks: encoding, comparison, merge, and how replicas pick the entry that wins
+"""
+import kvs
+
+
+def test_encode_and_decode_are_inverse():
+    assert kvs.encode_clock((1, 0, 12)) == '1.0.12'
+    assert kvs.decode_clock('1.0.12') == (1, 0, 12)
+
+
+def test_decode_every_form_a_payload_comes_in():
+    assert kvs.decode_clock('[1.0.2]') == (1, 0, 2)
+    assert kvs.decode_clock('"1.0.2"') == (1, 0, 2)
+    assert kvs.decode_clock([1, 0, 2]) == (1, 0, 2)
+    assert kvs.decode_clock(('1', '0', '2')) == (1, 0, 2)
+    assert kvs.decode_clock('') == ()
+    assert kvs.decode_clock('[]') == ()
+
+
+def test_empty_payload_is_all_zeros(node):
+    assert node.handle_empty_causal_payload('') == (0, 0)
+    assert node.handle_empty_causal_payload('3') == (3, 0)
+    assert node.handle_empty_causal_payload('1.2') == (1, 2)
+
+
+def test_compare_ordered_clocks():
+    assert kvs.compare_casual_payloads((2, 1), (1, 1)) == 0
+    assert kvs.compare_casual_payloads((1, 1), (1, 2)) == 1
+
+
+def test_compare_concurrent_and_equal_clocks():
+    assert kvs.compare_casual_payloads((2, 0), (0, 2)) == 2
+    assert kvs.compare_casual_payloads((1, 1), (1, 1)) == 2
+
+
+def test_compare_pads_the_shorter_clock_with_zeros():
+    assert kvs.compare_casual_payloads((1,), (1, 1)) == 1
+    assert kvs.compare_casual_payloads((1, 1), ()) == 0
+    assert kvs.compare_casual_payloads((1, 0), (1,)) == 2
+
+
+def test_merge_takes_the_pointwise_max():
+    assert kvs.merge((2, 2, 0, 0), (1, 3, 0, 1)) == (2, 3, 0, 1)
+    assert kvs.merge((1,), (0, 4)) == (1, 4)
+
+
+def test_merged_clock_descends_from_both():
+    clock1, clock2 = (3, 0, 1), (1, 2, 1)
+    merged = kvs.merge(clock1, clock2)
+    assert kvs.compare_casual_payloads(merged, clock1) == 0
+    assert kvs.compare_casual_payloads(merged, clock2) == 0
+
+
+def test_increment_one_position():
+    assert kvs.increment_causal_payload((1, 0, 0, 4), 2) == (1, 0, 1, 4)
+    assert kvs.increment_causal_payload((1,), 2) == (1, 0, 1)
+
+
+def test_newer_clock_wins_over_a_later_timestamp():
+    older = ['old', (1, 0), 200.0]
+    newer = ['new', (1, 1), 100.0]
+    assert kvs.choose_value(older, newer) is newer
+    assert kvs.choose_value(newer, older) is newer
+
+
+def test_later_timestamp_wins_between_concurrent_clocks():
+    first = ['first', (1, 0), 100.0]
+    second = ['second', (0, 1), 101.0]
+    assert kvs.choose_value(first, second) is second
+    assert kvs.choose_value(second, first) is second
+
+
+def test_sync_database_keeps_the_newer_entries(node):
+    node.set_entry('kept', ['ours', (2, 0), 100.0])
+    node.set_entry('replaced', ['ours', (1, 0), 100.0])
+    node.sync_database({'kept': ['theirs', [1, 0], 200.0], 'replaced': ['theirs', [1, 1], 50.0], 'new': ['theirs', '1.0', 1.0]})
+    assert node.DB['kept'] == ['ours', (2, 0), 100.0]
+    assert node.DB['replaced'] == ['theirs', (1, 1), 50.0]
+    assert node.DB['new'] == ['theirs', (1, 0), 1.0]
+
+
+def test_sync_database_of_the_same_entry_changes_nothing(node):
+    node.set_entry('key', ['value', (1, 0), 100.0])
+    sequence = node.SEQUENCE
+    node.sync_database({'key': ['value', [1, 0], 100.0]})
+    assert node.SEQUENCE == sequence
@@ -0,0 +1,111 @@
+"""
+Suspicion, death and refutation of peers(see failure_detector.py)
+"""
+import pytest
+import failure_detector
+from failure_detector import FailureDetector, ALIVE, SUSPECT, DEAD
+
+
+ME = '10.0.0.20:8080'
+PEERS = ['10.0.0.21:8080', '10.0.0.22:8080', '10.0.0.23:8080']
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(failure_detector, 'time', clock)
+    monkeypatch.setattr(failure_detector, 'SUSPECT_TIMEOUT', 5)
+    monkeypatch.setattr(failure_detector, 'GOSSIP_RETRANSMIT', 2)
+    return clock
+
+
+@pytest.fixture
+def detector(clock):
+    detector = FailureDetector(lambda: [ME] + PEERS)
+    detector.me = ME
+    detector.changes = []
+    detector.listeners.append(lambda node, status: detector.changes.append((node, status)))
+    #nobody answers unless a test says so
+    detector.ping = lambda target: False
+    detector.ping_req = lambda helper, target: False
+    detector.next_target()
+    yield detector
+    detector.pool.shutdown()
+
+
+def test_every_peer_is_probed_once_per_round(detector):
+    detector.order = []
+    targets = [detector.next_target() for node in PEERS]
+    assert sorted(targets) == PEERS
+    assert detector.statuses().keys() == set(PEERS)
+
+
+def test_peer_left_out_of_the_view_is_forgotten(detector):
+    detector.members_fn = lambda: [ME] + PEERS[:2]
+    detector.next_target()
+    assert PEERS[2] not in detector.statuses()
+    assert detector.status(PEERS[2]) == ALIVE
+
+
+def test_peer_that_nobody_reaches_is_suspect_then_dead(detector, clock):
+    detector.probe(PEERS[0])
+    assert detector.status(PEERS[0]) == SUSPECT
+    clock.now += failure_detector.SUSPECT_TIMEOUT - 1
+    detector.expire()
+    assert detector.status(PEERS[0]) == SUSPECT
+    clock.now += 1
+    detector.expire()
+    assert detector.is_dead(PEERS[0])
+    assert detector.changes == [(PEERS[0], SUSPECT), (PEERS[0], DEAD)]
+
+
+def test_peer_reached_through_another_peer_stays_alive(detector):
+    detector.ping_req = lambda helper, target: helper == PEERS[1]
+    detector.probe(PEERS[0])
+    assert detector.status(PEERS[0]) == ALIVE
+    assert detector.changes == []
+
+
+def test_suspect_peer_that_answers_is_alive_again(detector, clock):
+    detector.probe(PEERS[0])
+    answer = detector.handle_ping({'from': PEERS[0], 'incarnation': 1, 'updates': []})
+    assert answer['incarnation'] == 0
+    assert detector.status(PEERS[0]) == ALIVE
+    clock.now += failure_detector.SUSPECT_TIMEOUT
+    detector.expire()
+    assert detector.changes == [(PEERS[0], SUSPECT), (PEERS[0], ALIVE)]
+
+
+def test_node_refutes_the_suspicion_gossiped_about_it(detector):
+    detector.merge([[ME, SUSPECT, 0]])
+    assert detector.incarnation == 1
+    assert [ME, ALIVE, 1] in detector.gossip()
+    detector.merge([[ME, SUSPECT, 0]])
+    assert detector.incarnation == 1
+
+
+def test_refutation_overrides_the_suspicion(detector):
+    detector.merge([[PEERS[0], SUSPECT, 0]])
+    assert detector.status(PEERS[0]) == SUSPECT
+    detector.merge([[PEERS[0], ALIVE, 0]])
+    assert detector.status(PEERS[0]) == SUSPECT
+    detector.merge([[PEERS[0], ALIVE, 1]])
+    assert detector.status(PEERS[0]) == ALIVE
+    detector.merge([[PEERS[0], SUSPECT, 0]])
+    assert detector.status(PEERS[0]) == ALIVE
+
+
+def test_updates_are_gossiped_a_limited_number_of_times(detector):
+    detector.merge([[PEERS[0], SUSPECT, 0]])
+    for i in range(failure_detector.GOSSIP_RETRANSMIT):
+        assert detector.gossip() == [[PEERS[0], SUSPECT, 0]]
+    assert detector.gossip() == []
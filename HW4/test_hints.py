@@ -0,0 +1,77 @@
+"""
+Hints kept for the writes a replica missed(see hints.py)
+"""
+import storage
+from hints import HintStore
+
+
+def test_hints_of_a_key_are_coalesced_into_the_newest():
+    hints = HintStore(100)
+    hints.add('n1', 'a', ['1', [1], 1.0])
+    hints.add('n1', 'b', ['2', [1], 2.0])
+    hints.add('n1', 'a', ['3', [2], 3.0])
+    assert hints.count == 2
+    assert hints.batch('n1', 10) == [('b', ['2', [1], 2.0]), ('a', ['3', [2], 3.0])]
+
+
+def test_batch_returns_the_oldest_hints_first():
+    hints = HintStore(100)
+    for i in range(5):
+        hints.add('n1', 'key%d' % i, [str(i), [i], float(i)])
+    assert [key for key, entry in hints.batch('n1', 2)] == ['key0', 'key1']
+    assert hints.batch('unknown', 2) == []
+
+
+def test_limit_drops_the_oldest_hints_of_the_node_with_the_most():
+    hints = HintStore(4)
+    for i in range(3):
+        hints.add('n1', 'key%d' % i, [str(i), [i], float(i)])
+    hints.add('n2', 'key0', ['0', [0], 0.0])
+    hints.add('n2', 'key1', ['1', [1], 1.0])
+    assert hints.count == 4
+    assert hints.status() == {'n1': 2, 'n2': 2}
+    assert [key for key, entry in hints.batch('n1', 10)] == ['key1', 'key2']
+
+
+def test_delivered_hints_are_removed_unless_they_changed():
+    hints = HintStore(100)
+    hints.add('n1', 'a', ['1', [1], 1.0])
+    hints.add('n1', 'b', ['2', [1], 2.0])
+    delivered = hints.batch('n1', 10)
+    hints.add('n1', 'b', ['3', [2], 3.0])
+    hints.remove('n1', delivered)
+    assert hints.batch('n1', 10) == [('b', ['3', [2], 3.0])]
+    assert hints.count == 1
+
+
+def test_drop_removes_every_hint_of_a_node():
+    hints = HintStore(100)
+    hints.add('n1', 'a', ['1', [1], 1.0])
+    hints.add('n2', 'a', ['1', [1], 1.0])
+    hints.drop('n1')
+    assert hints.nodes() == ['n2']
+    assert hints.count == 1
+
+
+def test_one_replay_per_node_at_a_time():
+    hints = HintStore(100)
+    assert hints.start_replay('n1')
+    assert not hints.start_replay('n1')
+    assert hints.start_replay('n2')
+    hints.finish_replay('n1')
+    assert hints.start_replay('n1')
+
+
+def test_hints_survive_a_restart(tmp_path):
+    hints = HintStore(100)
+    hints.open(storage.DiskStorage(str(tmp_path), sync=False))
+    hints.add('10.0.0.2:8080', 'a', ['1', [1], 1.0])
+    hints.add('10.0.0.2:8080', 'b/c', ['2', [1], 2.0])
+    hints.add('10.0.0.3:8080', 'a', ['1', [1], 1.0])
+    hints.drop('10.0.0.3:8080')
+    hints.storage.close()
+    restarted = HintStore(100)
+    restarted.open(storage.DiskStorage(str(tmp_path), sync=False))
+    assert restarted.count == 2
+    assert dict(restarted.batch('10.0.0.2:8080', 10)) == {'a': ['1', [1], 1.0], 'b/c': ['2', [1], 2.0]}
+    restarted.storage.close()
@@ -0,0 +1,95 @@
+"""
+Merkle trees of two replicas and the descent merkle_sync does to find the keys they disagree on
+"""
+from merkle import MerkleTree
+from blob_store import BlobStore
+
+
+ENTRIES = {'key%d' % i: ['value%d' % i, (i, 0), 1000.0 + i] for i in range(300)}
+
+
+def tree_of(entries, fanout=4, depth=3):
+    tree = MerkleTree(fanout, depth)
+    for key, entry in entries.items():
+        tree.update(key, None, entry)
+    return tree
+
+
+"""
+Leaves where two trees differ, going down only through the inner nodes that differ(like merkle_sync)
+"""
+def differing_leaves(tree, other):
+    indices = [0]
+    for level in range(tree.depth + 1):
+        ours, theirs = tree.hashes()[level], other.hashes()[level]
+        indices = [i for i in indices if ours[i] != theirs[i]]
+        if level < tree.depth:
+            indices = [child for i in indices for child in tree.children(i)]
+    return indices
+
+
+def test_levels_go_from_the_root_to_the_leaves():
+    levels = tree_of(ENTRIES).hashes()
+    assert [len(level) for level in levels] == [1, 4, 16, 64]
+
+
+def test_same_entries_give_the_same_root_whatever_the_order():
+    reordered = dict(reversed(list(ENTRIES.items())))
+    assert tree_of(ENTRIES).root() == tree_of(reordered).root()
+
+
+def test_root_depends_on_the_version_of_an_entry():
+    changed = dict(ENTRIES, key7=['value7', (7, 1), 1007.0])
+    assert tree_of(ENTRIES).root() != tree_of(changed).root()
+
+
+def test_replacing_an_entry_and_back_restores_the_root():
+    tree = tree_of(ENTRIES)
+    root = tree.root()
+    newer = ['other', (8, 1), 2000.0]
+    tree.update('key3', ENTRIES['key3'], newer)
+    assert tree.root() != root
+    tree.update('key3', newer, ENTRIES['key3'])
+    assert tree.root() == root
+
+
+def test_removing_a_key_is_the_same_as_never_adding_it():
+    tree = tree_of(ENTRIES)
+    tree.update('key5', ENTRIES['key5'], None)
+    without = {key: entry for key, entry in ENTRIES.items() if key != 'key5'}
+    assert tree.root() == tree_of(without).root()
+    assert 'key5' not in tree.keys_in(range(tree.size))
+
+
+def test_descent_finds_the_keys_that_differ():
+    changed = dict(ENTRIES, key7=['value7', (7, 1), 1007.0])
+    del changed['key42']
+    changed['new'] = ['value', (1, 0), 1.0]
+    tree, other = tree_of(ENTRIES), tree_of(changed)
+    leaves = differing_leaves(tree, other)
+    assert sorted(leaves) == sorted({tree.bucket(key) for key in ('key7', 'key42', 'new')})
+    keys = set(tree.keys_in(leaves)) | set(other.keys_in(leaves))
+    assert {'key7', 'key42', 'new'} <= keys
+    assert len(keys) < len(ENTRIES) / 4
+
+
+def test_identical_trees_have_no_differing_leaf():
+    assert differing_leaves(tree_of(ENTRIES), tree_of(ENTRIES)) == []
+
+
+def test_value_in_the_blob_store_hashes_like_the_value():
+    store = BlobStore(capacity=4096)
+    entry = ENTRIES['key1']
+    assert MerkleTree().entry_hash('key1', entry) == MerkleTree().entry_hash('key1', [store.put(entry[0])] + entry[1:])
+
+
+def test_clock_as_list_or_tuple_hashes_the_same():
+    entry = ENTRIES['key1']
+    assert MerkleTree().entry_hash('key1', entry) == MerkleTree().entry_hash('key1', [entry[0], list(entry[1]), entry[2]])
+
+
+def test_clear_empties_the_tree():
+    tree = tree_of(ENTRIES)
+    tree.clear()
+    assert tree.root() == tree_of({}).root()
+    assert tree.keys_in(range(tree.size)) == []
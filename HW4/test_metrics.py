@@ -0,0 +1,75 @@
+"""
+Metrics rendered in the Prometheus text format(see metrics.py)
+"""
+from contextvars import copy_context
+import pytest
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(metrics, 'REGISTRY', [])
+
+
+def test_counter_has_a_sample_per_label_values():
+    counter = metrics.Counter('kvs_requests_total', 'Requests', ('route', 'status'))
+    counter.inc('/kvs', 200)
+    counter.inc('/kvs', 200, amount=2)
+    counter.inc('/kvs', 404)
+    assert metrics.render() == ('# HELP kvs_requests_total Requests\n'
+                                '# TYPE kvs_requests_total counter\n'
+                                'kvs_requests_total{route="/kvs",status="200"} 3\n'
+                                'kvs_requests_total{route="/kvs",status="404"} 1\n')
+
+
+def test_gauge_reads_its_value_when_rendered():
+    values = {'keys': 1}
+    metrics.Gauge('kvs_keys', 'Keys', lambda: values['keys'])
+    values['keys'] = 5
+    assert metrics.render().splitlines()[-1] == 'kvs_keys 5'
+
+
+def test_gauge_with_labels():
+    metrics.Gauge('kvs_pending', 'Pending', lambda: {('10.0.0.2:8080',): 3}, ('node',))
+    assert metrics.render().splitlines()[-1] == 'kvs_pending{node="10.0.0.2:8080"} 3'
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram('kvs_latency_seconds', 'Latency', ('route',), buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value, '/kvs')
+    lines = metrics.render().splitlines()
+    assert lines[2:] == ['kvs_latency_seconds_bucket{route="/kvs",le="0.1"} 2',
+                         'kvs_latency_seconds_bucket{route="/kvs",le="1"} 3',
+                         'kvs_latency_seconds_bucket{route="/kvs",le="+Inf"} 4',
+                         'kvs_latency_seconds_sum{route="/kvs"} 2.65',
+                         'kvs_latency_seconds_count{route="/kvs"} 4']
+
+
+def test_label_values_are_escaped():
+    assert metrics.format_labels(('key',), ('a"b\\c\nd',)) == '{key="a\\"b\\\\c\\nd"}'
+    assert metrics.format_labels((), ()) == ''
+
+
+def test_metrics_are_rendered_in_the_order_they_were_created():
+    metrics.Counter('kvs_b', 'B').inc()
+    metrics.Counter('kvs_a', 'A').inc()
+    names = [line.split()[2] for line in metrics.render().splitlines() if line.startswith('# TYPE')]
+    assert names == ['kvs_b', 'kvs_a']
+
+
+def test_peer_calls_are_counted_per_request():
+    def handle(calls):
+        metrics.start_request()
+        metrics.add_peer_calls(calls)
+        metrics.add_peer_calls(1)
+        return metrics.peer_calls()
+    assert copy_context().run(handle, 2) == 3
+    assert copy_context().run(handle, 0) == 1
+
+
+def test_peer_calls_outside_of_a_request_are_not_counted():
+    def outside():
+        metrics.add_peer_calls(5)
+        return metrics.peer_calls()
+    assert copy_context().run(outside) == 0
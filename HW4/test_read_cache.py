@@ -0,0 +1,102 @@
+"""
+Hot-key read cache on nodes outside the owner partition(see read_cache.py)
+"""
+import pytest
+import read_cache
+from read_cache import ReadCache
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(read_cache, 'time', clock)
+    return clock
+
+
+def test_cached_body_is_returned_with_its_clock(clock):
+    cache = ReadCache(100, 10)
+    assert cache.get('a') is None
+    cache.put('a', b'body', (1, 0))
+    assert cache.get('a') == (b'body', (1, 0))
+    assert cache.status() == {'keys': 1, 'bytes': 4, 'hits': 1, 'misses': 1}
+
+
+def test_entry_expires_after_the_ttl(clock):
+    cache = ReadCache(100, 10)
+    cache.put('a', b'body', (1, 0))
+    clock.now += 10
+    assert cache.get('a') is not None
+    clock.now += 0.1
+    assert cache.get('a') is None
+    assert cache.status()['keys'] == 0 and cache.status()['bytes'] == 0
+
+
+def test_least_recently_used_entry_is_evicted_first(clock):
+    cache = ReadCache(12, 10)
+    cache.put('a', b'aaaa', (1,))
+    cache.put('b', b'bbbb', (1,))
+    cache.put('c', b'cccc', (1,))
+    cache.get('a')
+    cache.put('d', b'dddd', (1,))
+    assert list(cache.entries) == ['c', 'a', 'd']
+    assert cache.bytes == 12
+
+
+def test_entries_are_evicted_until_the_new_body_fits(clock):
+    cache = ReadCache(10, 10)
+    cache.put('a', b'aaaa', (1,))
+    cache.put('b', b'bbbb', (1,))
+    cache.put('c', b'cccccccc', (1,))
+    assert list(cache.entries) == ['c'] and cache.bytes == 8
+
+
+def test_body_larger_than_the_cache_is_not_cached(clock):
+    cache = ReadCache(4, 10)
+    cache.put('a', b'aaaa', (1,))
+    cache.put('b', b'bbbbb', (1,))
+    assert list(cache.entries) == ['a']
+
+
+def test_replaced_entry_is_counted_once(clock):
+    cache = ReadCache(100, 10)
+    cache.put('a', b'aaaa', (1,))
+    cache.put('a', b'aa', (2,))
+    assert cache.bytes == 2 and cache.get('a') == (b'aa', (2,))
+    cache.invalidate(['a', 'missing'])
+    assert cache.bytes == 0 and cache.get('a') is None
+
+
+def test_disabled_cache(clock):
+    assert not ReadCache(0, 10).enabled()
+
+
+@pytest.fixture
+def cached(node, clock, monkeypatch):
+    monkeypatch.setattr(node, 'READ_CACHE', ReadCache(100, 10))
+    node.READ_CACHE.put('a', b'body', (2, 1))
+    return node
+
+
+def test_read_with_an_older_or_equal_payload_is_served_from_the_cache(cached):
+    assert cached.cached_read('a', (2, 1)) == b'body'
+    assert cached.cached_read('a', (1, 1)) == b'body'
+    assert cached.cached_read('a', (0, 0)) == b'body'
+
+
+def test_read_with_a_newer_or_concurrent_payload_skips_the_cache(cached):
+    assert cached.cached_read('a', (3, 1)) is None
+    assert cached.cached_read('a', (2, 2)) is None
+    assert cached.cached_read('a', (3, 0)) is None
+
+
+def test_read_of_a_key_that_is_not_cached(cached):
+    assert cached.cached_read('b', (0, 0)) is None
@@ -0,0 +1,42 @@
+"""
+Keys moved to their new owner after a view change(see REBALANCING in kvs.py)
+"""
+import pytest
+
+
+@pytest.fixture
+def rebalancer(node, monkeypatch):
+    moved = []
+    monkeypatch.setattr(node, 'MIGRATION_RATE', 0)
+    monkeypatch.setattr(node, 'MIGRATION', dict(node.MIGRATION, restart=True, moved_keys=0))
+    monkeypatch.setattr(node, 'misplaced_keys', lambda: {1: ['a', 'b']})
+    monkeypatch.setattr(node, 'move_keys', lambda partition_id, keys: moved.append((partition_id, keys)) or True)
+    node.moved = moved
+    return node
+
+
+def test_first_member_of_the_partition_moves_the_keys(rebalancer):
+    assert rebalancer.migrator(0) == rebalancer.IP_PORT
+    rebalancer.rebalance_job()
+    assert rebalancer.moved == [(1, ['a', 'b'])]
+    assert rebalancer.MIGRATION['state'] == 'idle'
+
+
+def test_other_members_do_not_move_the_same_keys(rebalancer, monkeypatch):
+    monkeypatch.setattr(rebalancer, 'IP_PORT', '10.0.0.21:8080')
+    rebalancer.rebalance_job()
+    assert rebalancer.moved == []
+    assert rebalancer.MIGRATION['state'] == 'idle' and not rebalancer.MIGRATION['restart']
+
+
+def test_next_member_takes_over_from_a_dead_migrator(rebalancer, monkeypatch):
+    monkeypatch.setattr(rebalancer, 'IP_PORT', '10.0.0.21:8080')
+    monkeypatch.setattr(rebalancer, 'live_nodes', lambda nodes: [node for node in nodes if node != '10.0.0.20:8080'])
+    assert rebalancer.migrator(0) == '10.0.0.21:8080'
+    rebalancer.rebalance_job()
+    assert rebalancer.moved == [(1, ['a', 'b'])]
+
+
+def test_partition_without_live_members_has_no_migrator(rebalancer, monkeypatch):
+    monkeypatch.setattr(rebalancer, 'live_nodes', lambda nodes: [])
+    assert rebalancer.migrator(0) is None
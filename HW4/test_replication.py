@@ -0,0 +1,179 @@
+"""
+Per-peer queues of replicated writes(see replication.py)
+"""
+import threading
+from time import time, sleep
+from replication import ReplicationQueue
+
+
+def wait_until(condition, timeout=2):
+    deadline = time() + timeout
+    while not condition():
+        assert time() < deadline
+        sleep(0.001)
+
+
+class Peers:
+
+    def __init__(self):
+        self.batches = []
+        self.overflowed = []
+        self.dead = set()
+        self.failing = set()
+        self.refusing = set()
+        self.calls = 0
+        self.sending = threading.Event()
+        self.sending.set()
+
+    def send(self, node, batch):
+        self.sending.wait()
+        self.calls += 1
+        if node in self.failing:
+            raise IOError(node + ' did not answer')
+        if node in self.refusing:
+            return []
+        self.batches.append((node, batch))
+        return [key for key, entry in batch]
+
+    def sent(self, node=None):
+        return [pair for peer, batch in self.batches for pair in batch if node is None or peer == node]
+
+    def queue(self, batch_size=100, flush_interval=0.01, max_pending=1000, block_timeout=0.5):
+        return ReplicationQueue(self.send, lambda node, key, entry: self.overflowed.append((node, key, entry)),
+                                lambda node: node not in self.dead, batch_size, flush_interval, max_pending, block_timeout)
+
+
+def test_writes_reach_their_peer():
+    peers = Peers()
+    queue = peers.queue()
+    queue.push('n1', 'a', 1)
+    queue.push('n2', 'b', 2)
+    wait_until(lambda: len(peers.sent()) == 2)
+    assert peers.sent('n1') == [('a', 1)] and peers.sent('n2') == [('b', 2)]
+    assert queue.status()['pending'] == {'n1': 0, 'n2': 0}
+    queue.stop('n1')
+    queue.stop('n2')
+
+
+def test_queued_write_is_replaced_by_a_newer_one():
+    peers = Peers()
+    queue = peers.queue(flush_interval=60)
+    queue.push('n1', 'a', 1)
+    queue.push('n1', 'b', 2)
+    queue.push('n1', 'a', 3)
+    assert queue.status()['coalesced'] == 1
+    assert queue.status()['pending'] == {'n1': 2}
+    queue.stop('n1')
+
+
+def test_full_batch_is_sent_without_waiting_for_the_interval():
+    peers = Peers()
+    queue = peers.queue(batch_size=3, flush_interval=60)
+    for i in range(3):
+        queue.push('n1', 'key%d' % i, i)
+    wait_until(lambda: len(peers.sent()) == 3)
+    assert len(peers.batches) == 1
+    queue.stop('n1')
+
+
+def test_failed_batch_is_sent_again():
+    peers = Peers()
+    peers.failing.add('n1')
+    queue = peers.queue()
+    queue.push('n1', 'a', 1)
+    wait_until(lambda: queue.status()['failed_batches'] > 0)
+    peers.failing.clear()
+    wait_until(lambda: peers.sent('n1') == [('a', 1)], timeout=5)
+    queue.stop('n1')
+
+
+def test_peer_that_acknowledges_nothing_is_backed_off():
+    peers = Peers()
+    peers.refusing.add('n1')
+    queue = peers.queue(flush_interval=0.01)
+    queue.push('n1', 'a', 1)
+    sleep(0.5)
+    assert 1 < peers.calls < 20
+    assert queue.status()['pending'] == {'n1': 1}
+    peers.refusing.clear()
+    wait_until(lambda: peers.sent('n1') == [('a', 1)], timeout=5)
+    queue.stop('n1')
+
+
+def test_writes_of_a_dead_peer_overflow():
+    peers = Peers()
+    peers.dead.add('n1')
+    queue = peers.queue()
+    queue.push('n1', 'a', 1)
+    wait_until(lambda: peers.overflowed == [('n1', 'a', 1)])
+    assert peers.sent() == []
+    queue.stop('n1')
+
+
+def test_full_queue_overflows_without_blocking():
+    peers = Peers()
+    queue = peers.queue(flush_interval=60, max_pending=2)
+    queue.push('n1', 'a', 1)
+    queue.push('n1', 'b', 2)
+    queue.push('n1', 'c', 3, block=False)
+    assert peers.overflowed == [('n1', 'c', 3)]
+    queue.push('n1', 'a', 4, block=False)
+    assert peers.overflowed == [('n1', 'c', 3)]
+    queue.stop('n1')
+
+
+def test_writer_waits_for_room_in_a_full_queue():
+    peers = Peers()
+    peers.sending.clear()
+    queue = peers.queue(batch_size=2, max_pending=2, block_timeout=5)
+    queue.push('n1', 'a', 1)
+    queue.push('n1', 'b', 2)
+    writer = threading.Thread(target=queue.push, args=('n1', 'c', 3))
+    writer.start()
+    sleep(0.05)
+    assert writer.is_alive()
+    peers.sending.set()
+    writer.join(2)
+    assert not writer.is_alive()
+    wait_until(lambda: len(peers.sent()) == 3)
+    assert peers.overflowed == []
+    queue.stop('n1')
+
+
+def test_stop_drops_the_queue_and_ends_its_thread():
+    peers = Peers()
+    queue = peers.queue(flush_interval=60)
+    before = set(threading.enumerate())
+    queue.push('n1', 'a', 1)
+    flusher, = set(threading.enumerate()) - before
+    queue.stop('n1')
+    flusher.join(1)
+    assert not flusher.is_alive()
+    assert queue.status()['dropped'] == 1
+    assert queue.status()['pending'] == {}
+    assert peers.sent() == [] and peers.overflowed == []
+
+
+def test_stop_wakes_a_waiting_writer():
+    peers = Peers()
+    queue = peers.queue(flush_interval=60, max_pending=1, block_timeout=5)
+    queue.push('n1', 'a', 1)
+    writer = threading.Thread(target=queue.push, args=('n1', 'b', 2))
+    writer.start()
+    sleep(0.05)
+    queue.stop('n1')
+    writer.join(1)
+    assert not writer.is_alive()
+    assert queue.status()['dropped'] == 2
+
+
+def test_peer_back_in_the_view_gets_a_new_queue():
+    peers = Peers()
+    queue = peers.queue()
+    queue.push('n1', 'a', 1)
+    wait_until(lambda: len(peers.sent()) == 1)
+    queue.stop('n1')
+    queue.push('n1', 'b', 2)
+    wait_until(lambda: len(peers.sent()) == 2)
+    assert peers.sent('n1') == [('a', 1), ('b', 2)]
+    queue.stop('n1')
@@ -0,0 +1,82 @@
+"""
+Placement of keys on the consistent hash ring(see CONSISTENT HASH in kvs.py)
+"""
+from bisect import bisect_right
+import kvs
+
+
+KEYS = ['key%d' % i for i in range(2000)]
+
+
+def test_every_partition_gets_its_virtual_nodes():
+    positions, partition_ids = kvs.make_ring([0, 1, 2])
+    assert positions == sorted(positions)
+    assert len(positions) == 3 * kvs.VIRTUAL_NODES
+    assert all(partition_ids.count(partition_id) == kvs.VIRTUAL_NODES for partition_id in (0, 1, 2))
+
+
+def test_ring_does_not_depend_on_the_order_or_repeats_of_the_ids():
+    assert kvs.make_ring([2, 0, 1]) == kvs.make_ring([0, 1, 2, 1, 0])
+
+
+def test_key_belongs_to_the_first_point_clockwise():
+    ring = kvs.make_ring([0, 1, 2])
+    positions, partition_ids = ring
+    for key in KEYS[:100]:
+        i = bisect_right(positions, kvs.ring_position(key))
+        assert kvs.get_owner_partition(key, ring) == partition_ids[i % len(positions)]
+
+
+def test_key_after_the_last_point_wraps_around():
+    ring = kvs.make_ring([0, 1])
+    positions, partition_ids = ring
+    after_last = [key for key in KEYS if kvs.ring_position(key) > positions[-1]]
+    assert after_last
+    assert all(kvs.get_owner_partition(key, ring) == partition_ids[0] for key in after_last)
+
+
+def test_empty_ring_has_no_owner():
+    assert kvs.get_owner_partition('key', ([], [])) is None
+
+
+def test_keys_are_spread_over_the_partitions():
+    ring = kvs.make_ring([0, 1, 2, 3])
+    counts = [0] * 4
+    for key in KEYS:
+        counts[kvs.get_owner_partition(key, ring)] += 1
+    assert min(counts) > len(KEYS) / 4 / 2
+
+
+def test_a_new_partition_only_takes_keys():
+    before = kvs.make_ring([0, 1, 2])
+    after = kvs.make_ring([0, 1, 2, 3])
+    moved = [key for key in KEYS if kvs.get_owner_partition(key, before) != kvs.get_owner_partition(key, after)]
+    assert all(kvs.get_owner_partition(key, after) == 3 for key in moved)
+    assert len(KEYS) / 8 < len(moved) < len(KEYS) / 2
+
+
+def test_removing_a_partition_only_moves_its_keys():
+    before = kvs.make_ring([0, 1, 2])
+    after = kvs.make_ring([0, 2])
+    for key in KEYS:
+        if kvs.get_owner_partition(key, before) != 1:
+            assert kvs.get_owner_partition(key, after) == kvs.get_owner_partition(key, before)
+
+
+def test_previous_owner_of_the_moved_keys_is_kept_during_the_grace(node):
+    node.view['10.0.0.24:8080'] = 2
+    node.rebuild_ring()
+    old_ring = node.make_ring([0, 1])
+    for key in KEYS[:200]:
+        old_owner = node.get_owner_partition(key, old_ring)
+        if node.get_owner_partition(key) == 2:
+            assert node.previous_owners(key) == [old_owner]
+        else:
+            assert node.previous_owners(key) == []
+
+
+def test_previous_owners_are_forgotten_after_the_grace(node, monkeypatch):
+    monkeypatch.setattr(node, 'MIGRATION_GRACE', -1)
+    node.view['10.0.0.24:8080'] = 2
+    node.rebuild_ring()
+    assert all(node.previous_owners(key) == [] for key in KEYS[:200])
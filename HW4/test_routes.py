@@ -0,0 +1,442 @@
+"""
+Error paths of the client and private routes, served by the Flask test client. The other nodes of the view
+are faked(see Cluster): a node answers only the requests a test gives it an answer for
+"""
+import json
+from collections import OrderedDict
+from concurrent.futures import Future
+from time import time, sleep
+import pytest
+import requests
+from hints import HintStore
+
+
+class Response:
+
+    def __init__(self, node, path, status_code, fields):
+        self.url = 'http://' + node + path
+        self.status_code = status_code
+        self.text = json.dumps(fields)
+        self.content = self.text.encode('utf-8')
+        self.headers = {'Content-Type': 'application/json'}
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class Cluster:
+
+    def __init__(self):
+        #{(node, path): (status, fields) or function(**kwargs) returning them}
+        self.answers = {}
+        self.calls = []
+
+    def request(self, node, method, path, timeout=0.5, adaptive=True, **kwargs):
+        self.calls.append((node, method, path))
+        answer = self.answers.get((node, path))
+        if answer is None:
+            raise requests.exceptions.ConnectionError(node + ' is unreachable')
+        status, fields = answer(**kwargs) if callable(answer) else answer
+        return Response(node, path, status, fields)
+
+
+@pytest.fixture
+def client(node, monkeypatch):
+    monkeypatch.setattr(node, 'JOBS_STARTED', True)
+    monkeypatch.setattr(node, 'PARTITION_MEMBERS', [])
+    monkeypatch.setattr(node, 'LOCATION_CACHE', OrderedDict())
+    monkeypatch.setattr(node, 'STATS_CACHE', {'time': 0, 'stats': None})
+    node.cluster = Cluster()
+    monkeypatch.setattr(node.transport, 'request', node.cluster.request)
+    node.rebuild_ring()
+    return node.app.test_client()
+
+
+def key_of(node, partition_id):
+    return next(key for key in ('key%d' % i for i in range(100)) if node.get_owner_partition(key) == partition_id)
+
+
+def fields(res):
+    return json.loads(res.data.decode('utf-8'))
+
+
+def test_get_of_an_invalid_key(client):
+    res = client.get('/kvs', query_string={'key': 'not-valid', 'causal_payload': ''})
+    assert res.status_code == 404 and fields(res)['error'] == 'Key not valid'
+
+
+def test_put_without_a_value(client):
+    res = client.put('/kvs', data={'key': 'foo', 'causal_payload': ''})
+    assert res.status_code == 404 and fields(res)['error'] == 'No value provided'
+
+
+def test_put_of_an_invalid_key(client):
+    res = client.put('/kvs', data={'key': 'k' * 251, 'value': 'bar', 'causal_payload': ''})
+    assert res.status_code == 404 and fields(res)['error'] == 'Key not valid'
+
+
+def test_get_when_no_member_of_the_owner_answers(node, client):
+    res = client.get('/kvs', query_string={'key': key_of(node, 1), 'causal_payload': ''})
+    assert res.status_code == 404 and fields(res)['error'] == 'key value store is not available'
+    assert sorted(call[0] for call in node.cluster.calls) == ['10.0.0.22:8080', '10.0.0.23:8080']
+
+
+def test_put_when_no_member_of_the_owner_answers(node, client):
+    res = client.put('/kvs', data={'key': key_of(node, 1), 'value': 'bar', 'causal_payload': ''})
+    assert res.status_code == 404 and fields(res)['error'] == 'key value store is not available'
+    assert len(node.cluster.calls) == 2
+
+
+def test_get_of_a_key_no_member_has(node, client):
+    key = key_of(node, 0)
+    node.cluster.answers[('10.0.0.21:8080', '/kvs/get_key')] = (404, {'msg': 'error', 'error': 'key does not exist'})
+    res = client.get('/kvs', query_string={'key': key, 'causal_payload': ''})
+    assert res.status_code == 404 and fields(res)['error'] == 'key does not exist'
+
+
+def test_get_answers_with_the_first_member_that_has_the_key(node, client):
+    key = key_of(node, 1)
+    node.cluster.answers[('10.0.0.22:8080', '/kvs/get_key')] = (404, {'msg': 'error', 'error': 'key does not exist'})
+    node.cluster.answers[('10.0.0.23:8080', '/kvs/get_key')] = (200, {'msg': 'success', 'value': 'bar', 'partition_id': 1,
+                                                                        'causal_payload': '0.1', 'timestamp': '1.0'})
+    res = client.get('/kvs', query_string={'key': key, 'causal_payload': ''})
+    assert res.status_code == 200 and fields(res)['value'] == 'bar'
+
+
+def test_mget_reports_every_key_on_its_own(node, client):
+    res = client.put('/kvs/mget', data=json.dumps({'keys': ['not-valid', key_of(node, 0), key_of(node, 1)]}))
+    assert res.status_code == 200
+    results = fields(res)['results']
+    assert results['not-valid']['error'] == 'Key not valid'
+    assert results[key_of(node, 0)]['error'] == 'key does not exist'
+    assert results[key_of(node, 1)]['error'] == 'key value store is not available'
+
+
+def test_mput_reports_every_key_on_its_own(node, client):
+    entries = [{'key': 'not-valid', 'value': 'a'}, {'key': 'foo'}, {'key': key_of(node, 1), 'value': 'b'}]
+    results = fields(client.put('/kvs/mput', data=json.dumps({'entries': entries})))['results']
+    assert results['not-valid']['error'] == 'Key not valid'
+    assert results['foo']['error'] == 'No value provided'
+    assert results[key_of(node, 1)]['error'] == 'key value store is not available'
+
+
+def test_mput_to_an_owner_with_a_newer_view_we_can_not_fetch(node, client):
+    for member in node.get_members(1):
+        node.cluster.answers[(member, '/kvs/add_keys')] = (409, {'msg': 'error', 'error': 'stale view', 'epoch': 9})
+    key = key_of(node, 1)
+    results = fields(client.put('/kvs/mput', data=json.dumps({'entries': [{'key': key, 'value': 'b'}]})))['results']
+    assert results[key]['error'] == 'stale view'
+
+
+def test_mdelete_of_keys_nobody_has(node, client):
+    node.cluster.answers[('10.0.0.22:8080', '/kvs/remove_keys')] = (200, {'msg': 'success', 'deleted': []})
+    results = fields(client.delete('/kvs/mdelete', data=json.dumps({'keys': ['not-valid', key_of(node, 0), key_of(node, 1)]})))['results']
+    assert results['not-valid']['error'] == 'Key not valid'
+    assert results[key_of(node, 0)]['error'] == 'key does not exist'
+    assert results[key_of(node, 1)]['error'] == 'key does not exist'
+
+
+def test_add_keys_of_another_partition_is_refused(node, client):
+    res = client.put('/kvs/add_keys', data=json.dumps({'entries': [{'key': key_of(node, 1), 'value': 'b'}]}))
+    assert res.status_code == 409 and fields(res)['epoch'] == node.EPOCH
+
+
+def test_batch_keys_that_are_not_strings(node, client):
+    for route in ('/kvs/mget', '/kvs/mdelete'):
+        res = client.put(route, data=json.dumps({'keys': [5, None, ['a'], {'a': 1}]}))
+        assert res.status_code == 200
+        assert all(result['error'] == 'Key not valid' for result in fields(res)['results'].values())
+        assert len(fields(res)['results']) == 4
+    assert node.cluster.calls == []
+
+
+def test_mput_entries_that_are_not_objects_or_have_no_string_key(client):
+    entries = ['foo', 5, None, {'key': 5, 'value': 'a'}, {'value': 'b'}]
+    res = client.put('/kvs/mput', data=json.dumps({'entries': entries}))
+    assert res.status_code == 200
+    results = fields(res)['results']
+    assert sorted(results) == ['5', 'None', 'foo']
+    assert all(result['error'] == 'Key not valid' for result in results.values())
+
+
+def test_batch_body_without_a_list(client):
+    for route, body in (('/kvs/mget', {'keys': 'foo'}), ('/kvs/mdelete', ['foo']), ('/kvs/mput', {'entries': {'key': 'foo'}})):
+        res = client.put(route, data=json.dumps(body))
+        assert res.status_code == 400 and fields(res)['error'].endswith('must be a list')
+
+
+def test_receive_keys_merges_the_lines_it_gets(node, client):
+    body = node.entry_line('a', ['1', (1, 0), 1.0]) + b'\n' + node.entry_line('b', ['2', (0, 1), 2.0])
+    res = client.put('/kvs/receive_keys', data=body, headers={'Content-Type': 'application/x-ndjson'})
+    assert res.status_code == 200 and sorted(fields(res)['received']) == ['a', 'b']
+    assert node.DB['a'] == ['1', (1, 0), 1.0]
+
+
+def test_receive_keys_of_an_empty_transfer(client):
+    res = client.put('/kvs/receive_keys', data=b'', headers={'Content-Type': 'application/x-ndjson'})
+    assert res.status_code == 200 and fields(res)['received'] == []
+
+
+def test_receive_keys_refuses_a_malformed_line(node, monkeypatch, client):
+    monkeypatch.setattr(node, 'TRANSFER_BATCH', 1)
+    body = node.entry_line('a', ['1', (1, 0), 1.0]) + b'{"key": "b", "val\n'
+    res = client.put('/kvs/receive_keys', data=body, headers={'Content-Type': 'application/x-ndjson'})
+    assert res.status_code == 400 and fields(res)['received'] == ['a']
+    res = client.put('/kvs/receive_keys', data=b'{"key": "c"}\n', headers={'Content-Type': 'application/x-ndjson'})
+    assert res.status_code == 400 and 'c' not in node.DB
+
+
+def test_transfer_to_a_partition_that_does_not_answer(node, client):
+    node.DB['a'] = ['1', (1, 0), 1.0]
+    assert node.transfer_keys(node.get_members(1), ['a']) == []
+    node.cluster.answers[('10.0.0.23:8080', '/kvs/receive_keys')] = (200, {'msg': 'success', 'received': ['a']})
+    assert node.transfer_keys(node.get_members(1), ['a']) == ['a']
+
+
+@pytest.fixture
+def migration(node, monkeypatch):
+    monkeypatch.setattr(node, 'MIGRATION', dict(node.MIGRATION, state='idle', started=None, finished=None, total_keys=0, moved_keys=0,
+                                                 bytes=0, failed_batches=0, restart=False))
+    return node.MIGRATION
+
+
+def wait_until(condition, timeout=2):
+    deadline = time() + timeout
+    while not condition():
+        assert time() < deadline
+        sleep(0.001)
+
+
+def test_rebalance_status_before_any_migration(client, migration):
+    res = client.get('/kvs/rebalance_status')
+    assert res.status_code == 200
+    status = fields(res)
+    assert (status['state'], status['elapsed'], status['keys_per_second'], status['dual_read']) == ('idle', 0, 0, False)
+
+
+def test_share_key_on_a_member_that_does_not_migrate(node, monkeypatch, client, migration):
+    monkeypatch.setattr(node, 'IP_PORT', '10.0.0.21:8080')
+    node.DB[key_of(node, 1)] = ['1', (1, 0), 1.0]
+    assert client.put('/kvs/share_key').status_code == 200
+    wait_until(lambda: migration['state'] == 'idle')
+    assert migration['moved_keys'] == 0 and node.cluster.calls == []
+    assert key_of(node, 1) in node.DB
+
+
+def test_keys_stay_when_their_new_owner_does_not_answer(node, client, migration):
+    key = key_of(node, 1)
+    node.DB[key] = ['1', (1, 0), 1.0]
+    assert not node.move_keys(1, [key])
+    assert key in node.DB
+    assert all(path == '/kvs/receive_keys' for member, method, path in node.cluster.calls)
+
+
+def test_moved_keys_are_removed_from_every_member(node, client, migration):
+    key = key_of(node, 1)
+    node.DB[key] = ['1', (1, 0), 1.0]
+    node.cluster.answers[('10.0.0.22:8080', '/kvs/receive_keys')] = (200, {'msg': 'success', 'received': [key]})
+    node.cluster.answers[('10.0.0.21:8080', '/kvs/remove_keys')] = (200, {'msg': 'success', 'deleted': [key]})
+    assert node.move_keys(1, [key])
+    assert key not in node.DB and migration['moved_keys'] == 1
+    assert ('10.0.0.21:8080', 'PUT', '/kvs/remove_keys') in node.cluster.calls
+
+
+def found(value='bar'):
+    return (200, {'msg': 'success', 'value': value, 'partition_id': 1, 'causal_payload': '0.1', 'timestamp': '1.0'})
+
+
+def test_next_read_asks_the_node_that_answered_last_time(node, client):
+    key = key_of(node, 1)
+    node.cluster.answers[('10.0.0.23:8080', '/kvs/get_key')] = found()
+    client.get('/kvs', query_string={'key': key, 'causal_payload': ''})
+    assert node.cached_location(key) == '10.0.0.23:8080'
+    del node.cluster.calls[:]
+    res = client.get('/kvs', query_string={'key': key, 'causal_payload': ''})
+    assert res.status_code == 200 and node.cluster.calls == [('10.0.0.23:8080', 'GET', '/kvs/get_key')]
+
+
+def test_cached_node_that_does_not_answer_is_forgotten(node, client):
+    key = key_of(node, 1)
+    node.remember_location(key, '10.0.0.22:8080')
+    node.cluster.answers[('10.0.0.23:8080', '/kvs/get_key')] = found()
+    res = client.get('/kvs', query_string={'key': key, 'causal_payload': ''})
+    assert res.status_code == 200 and fields(res)['value'] == 'bar'
+    assert node.cached_location(key) == '10.0.0.23:8080'
+
+
+def test_cached_node_that_lost_the_key_is_forgotten(node, client):
+    key = key_of(node, 1)
+    node.remember_location(key, '10.0.0.22:8080')
+    node.cluster.answers[('10.0.0.22:8080', '/kvs/get_key')] = (404, {'msg': 'error', 'error': 'key does not exist'})
+    res = client.get('/kvs', query_string={'key': key, 'causal_payload': ''})
+    assert res.status_code == 404 and fields(res)['error'] == 'key does not exist'
+    assert node.cached_location(key) is None
+
+
+def test_locations_are_forgotten_when_the_view_changes(node, client):
+    node.remember_location('foo', '10.0.0.22:8080')
+    node.rebuild_ring()
+    assert node.cached_location('foo') is None
+
+
+def test_least_recently_used_location_is_dropped(node, monkeypatch, client):
+    monkeypatch.setattr(node, 'LOCATION_CACHE_SIZE', 2)
+    node.remember_location('a', '10.0.0.22:8080')
+    node.remember_location('b', '10.0.0.22:8080')
+    node.cached_location('a')
+    node.remember_location('c', '10.0.0.23:8080')
+    assert list(node.LOCATION_CACHE) == ['a', 'c']
+
+
+def test_write_quorum_that_the_replicas_do_not_reach(node, monkeypatch, client):
+    monkeypatch.setattr(node, 'HINTS', HintStore(100))
+    key = key_of(node, 0)
+    res = client.put('/kvs', data={'key': key, 'value': 'bar', 'causal_payload': '', 'w': '2'})
+    assert res.status_code == 404 and fields(res)['error'] == 'not enough replicas answered'
+    assert key in node.DB
+    wait_until(lambda: list(node.HINTS.hints.get('10.0.0.21:8080', [])) == [key])
+
+
+def test_read_quorum_that_the_replicas_do_not_reach(node, client):
+    res = client.get('/kvs', query_string={'key': key_of(node, 1), 'causal_payload': '', 'r': '2'})
+    assert res.status_code == 404 and fields(res)['error'] == 'key value store is not available'
+    assert sorted(call[0] for call in node.cluster.calls) == ['10.0.0.22:8080', '10.0.0.23:8080']
+
+
+def test_quorum_is_between_one_and_the_number_of_members(node):
+    assert node.quorum_size({'r': '5'}, 'r', 1, 0) == 2
+    assert node.quorum_size({'r': '0'}, 'r', 1, 0) == 1
+    assert node.quorum_size({'r': 'all'}, 'r', 2, 0) == 2
+    assert node.quorum_size({}, 'w', 1, 0) == 1
+
+
+def test_quorum_write_is_forwarded_with_its_quorum(node, client):
+    key = key_of(node, 1)
+    sent = []
+    def add_key(params=None, **kwargs):
+        sent.append(params)
+        return 404, {'msg': 'error', 'error': 'not enough replicas answered'}
+    for member in node.get_members(1):
+        node.cluster.answers[(member, '/kvs/add_key')] = add_key
+    res = client.put('/kvs', data={'key': key, 'value': 'bar', 'causal_payload': '', 'w': '5'})
+    assert res.status_code == 404 and fields(res)['error'] == 'not enough replicas answered'
+    assert len(sent) == 1 and sent[0]['w'] == 2
+
+
+def test_quorum_read_repairs_the_replica_with_an_older_value(node, client):
+    key = key_of(node, 1)
+    repaired = []
+    node.cluster.answers[('10.0.0.22:8080', '/kvs/get_key')] = found('old')
+    node.cluster.answers[('10.0.0.23:8080', '/kvs/get_key')] = (200, {'msg': 'success', 'value': 'new', 'partition_id': 1,
+                                                                        'causal_payload': '1.1', 'timestamp': '2.0'})
+    node.cluster.answers[('10.0.0.22:8080', '/kvs/receive_keys')] = lambda data=None, **kwargs: repaired.append(data) or (200, {'received': [key]})
+    res = client.get('/kvs', query_string={'key': key, 'causal_payload': '', 'r': '2'})
+    assert res.status_code == 200 and fields(res)['value'] == 'new'
+    wait_until(lambda: repaired)
+    assert json.loads(repaired[0].decode('utf-8'))['value'] == 'new'
+    assert ('10.0.0.23:8080', 'PUT', '/kvs/receive_keys') not in node.cluster.calls
+
+
+def test_quorum_read_repairs_current_node(node, client):
+    key = key_of(node, 0)
+    node.DB[key] = ['old', (1, 0), 1.0]
+    node.cluster.answers[('10.0.0.21:8080', '/kvs/get_key')] = (200, {'msg': 'success', 'value': 'new', 'partition_id': 0,
+                                                                        'causal_payload': '1.1', 'timestamp': '2.0'})
+    res = client.get('/kvs', query_string={'key': key, 'causal_payload': '', 'r': '2'})
+    assert res.status_code == 200 and fields(res)['value'] == 'new'
+    wait_until(lambda: node.DB[key][0] == 'new')
+
+
+class InlinePool:
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def test_read_returns_the_newest_answer_that_arrived_and_repairs_the_others(node, monkeypatch, client):
+    monkeypatch.setattr(node, 'FANOUT_POOL', InlinePool())
+    key = key_of(node, 1)
+    repaired = []
+    node.cluster.answers[('10.0.0.22:8080', '/kvs/get_key')] = found('old')
+    node.cluster.answers[('10.0.0.23:8080', '/kvs/get_key')] = (200, {'msg': 'success', 'value': 'new', 'partition_id': 1,
+                                                                        'causal_payload': '1.1', 'timestamp': '2.0'})
+    node.cluster.answers[('10.0.0.22:8080', '/kvs/receive_keys')] = lambda data=None, **kwargs: repaired.append(data) or (200, {'received': [key]})
+    res = client.get('/kvs', query_string={'key': key, 'causal_payload': ''})
+    assert res.status_code == 200 and fields(res)['value'] == 'new'
+    assert [json.loads(data.decode('utf-8'))['value'] for data in repaired] == ['new']
+    assert ('10.0.0.23:8080', 'PUT', '/kvs/receive_keys') not in node.cluster.calls
+
+
+def test_read_repairs_the_members_without_the_key(node, monkeypatch, client):
+    monkeypatch.setattr(node, 'FANOUT_POOL', InlinePool())
+    key = key_of(node, 0)
+    node.cluster.answers[('10.0.0.21:8080', '/kvs/get_key')] = (200, {'msg': 'success', 'value': 'bar', 'partition_id': 0,
+                                                                        'causal_payload': '0.1', 'timestamp': '1.0'})
+    res = client.get('/kvs', query_string={'key': key, 'causal_payload': ''})
+    assert res.status_code == 200 and fields(res)['value'] == 'bar'
+    assert node.DB[key] == ['bar', (0, 1), 1.0]
+
+
+def test_quorum_read_of_a_key_no_replica_has(node, client):
+    node.cluster.answers[('10.0.0.21:8080', '/kvs/get_key')] = (404, {'msg': 'error', 'error': 'key does not exist'})
+    res = client.get('/kvs', query_string={'key': key_of(node, 0), 'causal_payload': '', 'r': '2'})
+    assert res.status_code == 404 and fields(res)['error'] == 'key does not exist'
+
+
+def test_total_number_of_keys_when_a_partition_does_not_answer(node, client):
+    node.DB['a'] = ['1', (1, 0), 1.0]
+    res = client.get('/kvs/total_number_of_keys')
+    assert res.status_code == 404
+    assert (fields(res)['total'], fields(res)['unreachable_partitions']) == (1, [1])
+
+
+def test_total_number_of_keys_of_every_partition(node, client):
+    node.cluster.answers[('10.0.0.22:8080', '/kvs/partition_stats')] = (200, {'partition_id': 1, 'keys': 4, 'bytes': 10, 'divergent': []})
+    res = client.get('/kvs/total_number_of_keys')
+    assert res.status_code == 200 and fields(res)['total'] == 4
+
+
+def test_cluster_stats_list_the_replicas_that_do_not_answer(node, client):
+    stats = fields(client.get('/kvs/cluster_stats', query_string={'max_age': 'soon'}))
+    assert not stats['complete'] and stats['number_of_partitions'] == 2
+    partition, unreachable = stats['partitions']
+    assert partition['unreachable'] == ['10.0.0.21:8080']
+    assert unreachable == {'partition_id': 1, 'error': 'key value store is not available'}
+
+
+def test_cluster_stats_are_cached(node, client):
+    client.get('/kvs/cluster_stats')
+    calls = len(node.cluster.calls)
+    stats = fields(client.get('/kvs/cluster_stats'))
+    assert len(node.cluster.calls) == calls and stats['age'] >= 0
+    client.get('/kvs/cluster_stats', query_string={'max_age': '0'})
+    assert len(node.cluster.calls) > calls
+
+
+@pytest.fixture
+def blobs(node, monkeypatch):
+    monkeypatch.setattr(node, 'BLOB_THRESHOLD', 10)
+    monkeypatch.setattr(node, 'BLOB_STORE', None)
+    monkeypatch.setattr(node, 'STREAM_CHUNK', 7)
+    return node
+
+
+def test_value_of_the_blob_store_is_streamed(blobs, client):
+    blobs.set_entry('a', ['large "value" ' * 5, (1, 0), 1.0])
+    res = client.get('/kvs/get_key', query_string={'key': 'a', 'causal_payload': ''})
+    assert res.status_code == 200 and int(res.headers['Content-Length']) == len(res.data)
+    assert fields(res)['value'] == 'large "value" ' * 5
+
+
+def test_transfer_sends_the_value_of_the_blob_store_from_the_mapping(blobs):
+    blobs.set_entry('a', ['large "value" ' * 5, (1, 0), 1.0])
+    blobs.set_entry('b', ['small', (1, 0), 2.0])
+    parts = list(blobs.entry_lines(['a', 'b']))
+    assert any(isinstance(part, memoryview) for part in parts)
+    lines = b''.join(bytes(part) for part in parts).splitlines()
+    assert [json.loads(line.decode('utf-8'))['value'] for line in lines] == ['large "value" ' * 5, 'small']
@@ -0,0 +1,109 @@
+"""
+Recovery of the database from the write-ahead log and snapshots(see storage.py)
+"""
+import os
+import storage
+
+
+def open_disk(directory, **kwargs):
+    disk = storage.DiskStorage(str(directory), commit_interval=0, **kwargs)
+    return disk, disk.load()
+
+
+def snapshot(disk, db):
+    disk.snapshot(lambda: (dict(db), disk.start_segment()))
+
+
+def test_writes_are_replayed_after_a_restart(tmp_path):
+    disk, db = open_disk(tmp_path)
+    assert db == {}
+    disk.wait(disk.log_put('a', ['1', [1, 0], 1.0]))
+    disk.wait(disk.log_put('b', ['2', [1, 0], 2.0]))
+    disk.wait(disk.log_put('a', ['3', [2, 0], 3.0]))
+    disk.wait(disk.log_delete('b'))
+    disk.close()
+    disk, db = open_disk(tmp_path)
+    assert db == {'a': ['3', [2, 0], 3.0]}
+    disk.close()
+
+
+def test_snapshot_replaces_the_segments_it_covers(tmp_path):
+    disk, db = open_disk(tmp_path)
+    disk.log_put('a', ['1', [1], 1.0])
+    snapshot(disk, {'a': ['1', [1], 1.0]})
+    disk.wait(disk.log_put('b', ['2', [1], 2.0]))
+    disk.close()
+    assert os.path.exists(os.path.join(str(tmp_path), 'snapshot.json'))
+    assert disk.segments() == [1]
+    disk, db = open_disk(tmp_path)
+    assert db == {'a': ['1', [1], 1.0], 'b': ['2', [1], 2.0]}
+    disk.close()
+
+
+def test_record_cut_by_a_crash_is_skipped(tmp_path):
+    disk, db = open_disk(tmp_path)
+    disk.wait(disk.log_put('a', ['1', [1], 1.0]))
+    disk.close()
+    with open(os.path.join(str(tmp_path), 'wal-0.log'), 'a') as f:
+        f.write('["put","b",["2",[1],')
+    disk, db = open_disk(tmp_path)
+    assert db == {'a': ['1', [1], 1.0]}
+    disk.close()
+
+
+def test_restart_writes_to_a_new_segment(tmp_path):
+    disk, db = open_disk(tmp_path)
+    disk.wait(disk.log_put('a', ['1', [1], 1.0]))
+    disk.close()
+    disk, db = open_disk(tmp_path)
+    assert disk.segment == 1
+    disk.wait(disk.log_put('b', ['2', [1], 2.0]))
+    disk.close()
+    disk, db = open_disk(tmp_path)
+    assert db == {'a': ['1', [1], 1.0], 'b': ['2', [1], 2.0]}
+    disk.close()
+
+
+def test_wait_returns_once_the_record_is_synced(tmp_path):
+    disk, db = open_disk(tmp_path)
+    ticket = disk.log_put('a', ['1', [1], 1.0])
+    disk.wait(ticket)
+    assert disk.synced >= ticket
+    disk.close()
+
+
+def test_no_snapshot_while_the_log_has_not_grown(tmp_path):
+    disk, db = open_disk(tmp_path, snapshot_interval=0)
+    assert not disk.should_snapshot()
+    disk.log_put('a', ['1', [1], 1.0])
+    assert disk.should_snapshot()
+    snapshot(disk, {'a': ['1', [1], 1.0]})
+    assert not disk.should_snapshot()
+    disk.close()
+
+
+def test_replayed_log_is_snapshotted_after_a_restart(tmp_path):
+    disk, db = open_disk(tmp_path, snapshot_interval=0)
+    disk.wait(disk.log_put('a', ['1', [1], 1.0]))
+    disk.close()
+    disk, db = open_disk(tmp_path, snapshot_interval=0)
+    assert disk.should_snapshot()
+    snapshot(disk, db)
+    assert not disk.should_snapshot()
+    disk.close()
+
+
+def test_snapshot_when_the_log_is_large(tmp_path):
+    disk, db = open_disk(tmp_path, snapshot_bytes=100)
+    disk.log_put('a', ['1', [1], 1.0])
+    assert not disk.should_snapshot()
+    disk.log_put('b', ['x' * 100, [1], 1.0])
+    assert disk.should_snapshot()
+    disk.close()
+
+
+def test_memory_storage_when_no_directory_is_set():
+    memory = storage.open_storage('')
+    assert not memory.persistent
+    assert memory.load() == {}
+    assert not memory.should_snapshot()
@@ -0,0 +1,75 @@
+"""
+Spans of a request and of the requests it sends to other nodes(see tracing.py)
+"""
+import re
+from contextvars import copy_context
+from time import sleep
+import tracing
+
+
+def in_request(fn):
+    return copy_context().run(fn)
+
+
+def test_covered_counts_overlaps_once():
+    assert tracing.covered([]) == 0
+    assert tracing.covered([(0, 2), (1, 3)]) == 3
+    assert tracing.covered([(5, 6), (0, 1)]) == 2
+    assert tracing.covered([(0, 4), (1, 2)]) == 4
+
+
+def test_request_without_a_trace_starts_one():
+    tracer = tracing.Tracer(10)
+    span = in_request(lambda: tracer.start_request({}, 'GET /kvs'))
+    assert len(span.trace_id) == 32 and span.parent_id is None
+    assert span.headers == {'X-Trace-Id': span.trace_id, 'X-Span-Id': span.span_id}
+
+
+def test_request_joins_the_trace_of_its_sender():
+    tracer = tracing.Tracer(10)
+    span = in_request(lambda: tracer.start_request({'X-Trace-Id': 'trace', 'X-Span-Id': 'parent'}, 'PUT /kvs/add_key'))
+    assert span.trace_id == 'trace' and span.parent_id == 'parent'
+
+
+def test_call_outside_of_a_request_is_not_traced():
+    assert in_request(lambda: tracing.Tracer(10).start_call('10.0.0.2:8080', 'GET', '/kvs')) is None
+
+
+def test_calls_are_children_of_the_request_and_split_its_time():
+    tracer = tracing.Tracer(10)
+    tracer.node = '10.0.0.1:8080'
+    def handle():
+        request = tracer.start_request({}, 'GET /kvs')
+        call = tracer.start_call('10.0.0.2:8080', 'GET', '/kvs/get_key')
+        sleep(0.02)
+        tracer.finish_call(call, 200)
+        return request, call, tracer.finish_request(request, 200)
+    request, call, timing = in_request(handle)
+    assert call.trace_id == request.trace_id and call.parent_id == request.span_id
+    total, local, remote = [float(value) for value in re.findall(r'dur=([0-9.]+)', timing)]
+    assert remote >= 20 and abs(total - local - remote) < 0.01
+    client, server = tracer.spans(request.trace_id)
+    assert (client['kind'], client['peer'], client['status']) == ('client', '10.0.0.2:8080', 200)
+    assert (server['kind'], server['node']) == ('server', '10.0.0.1:8080')
+    assert abs(server['remote'] * 1000 - remote) < 0.001
+
+
+def test_only_the_last_spans_are_kept():
+    tracer = tracing.Tracer(3)
+    for i in range(5):
+        in_request(lambda: tracer.finish_request(tracer.start_request({'X-Trace-Id': 't%d' % i}, 'GET /kvs'), 200))
+    assert [span['trace_id'] for span in tracer.spans()] == ['t2', 't3', 't4']
+    assert [span['trace_id'] for span in tracer.spans(limit=1)] == ['t4']
+    assert tracer.spans('t0') == []
+
+
+def test_span_follows_the_request_to_the_pool_threads():
+    tracer = tracing.Tracer(10)
+    pool = tracing.ContextThreadPool(2)
+    def handle():
+        request = tracer.start_request({}, 'GET /kvs')
+        call = pool.submit(tracer.start_call, '10.0.0.2:8080', 'GET', '/kvs').result()
+        return request, call
+    request, call = in_request(handle)
+    pool.shutdown()
+    assert call.parent_id == request.span_id
@@ -0,0 +1,109 @@
+"""
+Adaptive timeouts and circuit breakers of the peers(see transport.py)
+"""
+import pytest
+import requests
+import transport
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(transport, 'time', clock)
+    monkeypatch.setattr(transport, 'FAILURE_THRESHOLD', 3)
+    monkeypatch.setattr(transport, 'OPEN_SECONDS', 2)
+    monkeypatch.setattr(transport, 'MIN_TIMEOUT', 0.2)
+    return clock
+
+
+def open_circuit(peer):
+    for i in range(transport.FAILURE_THRESHOLD):
+        assert peer.allow_request()
+        peer.record_failure()
+
+
+def test_timeout_is_the_maximum_until_a_round_trip_is_measured(clock):
+    peer = transport.Peer('10.0.0.21:8080')
+    assert peer.timeout(0.5) == 0.5
+    peer.record_success()
+    assert peer.timeout(0.5) == 0.5
+
+
+def test_timeout_follows_the_round_trip_time(clock):
+    peer = transport.Peer('10.0.0.21:8080')
+    peer.record_success(0.1)
+    assert (peer.srtt, peer.rttvar) == (0.1, 0.05)
+    assert peer.timeout(5) == pytest.approx(0.3)
+    for i in range(50):
+        peer.record_success(0.1)
+    assert peer.timeout(5) == pytest.approx(0.2, abs=0.01)
+    peer.record_success(2)
+    assert 0.3 < peer.timeout(5) < 5
+    assert peer.timeout(0.5) == 0.5
+
+
+def test_timeout_is_never_below_the_minimum(clock):
+    peer = transport.Peer('10.0.0.21:8080')
+    for i in range(50):
+        peer.record_success(0.001)
+    assert peer.timeout(5) == transport.MIN_TIMEOUT
+
+
+def test_circuit_opens_after_consecutive_failures(clock):
+    peer = transport.Peer('10.0.0.21:8080')
+    peer.record_failure()
+    peer.record_success(0.1)
+    assert peer.failures == 0
+    open_circuit(peer)
+    assert peer.is_open()
+    assert not peer.allow_request()
+
+
+def test_open_circuit_lets_one_trial_request_through(clock):
+    peer = transport.Peer('10.0.0.21:8080')
+    open_circuit(peer)
+    clock.now += transport.OPEN_SECONDS
+    assert peer.allow_request()
+    assert not peer.allow_request()
+    peer.record_success(0.1)
+    assert not peer.is_open()
+    assert peer.allow_request() and peer.allow_request()
+
+
+def test_failed_trial_request_opens_the_circuit_again(clock):
+    peer = transport.Peer('10.0.0.21:8080')
+    open_circuit(peer)
+    clock.now += transport.OPEN_SECONDS
+    assert peer.allow_request()
+    peer.record_failure()
+    assert peer.is_open()
+    clock.now += transport.OPEN_SECONDS - 0.1
+    assert not peer.allow_request()
+    clock.now += 0.1
+    assert peer.allow_request()
+
+
+def test_request_to_an_open_circuit_does_not_dial(clock, monkeypatch):
+    monkeypatch.setattr(transport, 'PEERS', {})
+    peer = transport.get_peer('10.0.0.21:8080')
+    dials = []
+    def refuse(method, url, **kwargs):
+        dials.append(url)
+        raise requests.exceptions.ConnectionError()
+    monkeypatch.setattr(peer.session, 'request', refuse)
+    for i in range(transport.FAILURE_THRESHOLD):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            transport.get('10.0.0.21:8080', '/kvs')
+    assert not transport.is_available('10.0.0.21:8080')
+    with pytest.raises(transport.CircuitOpenError):
+        transport.get('10.0.0.21:8080', '/kvs')
+    assert dials == ['http://10.0.0.21:8080/kvs'] * transport.FAILURE_THRESHOLD
@@ -0,0 +1,94 @@
+"""
+View changes with epochs(see VIEW EPOCHS in kvs.py)
+"""
+import pytest
+import requests
+
+
+@pytest.fixture
+def views(node, monkeypatch):
+    rebalances = []
+    monkeypatch.setattr(node, 'EPOCH', 1)
+    monkeypatch.setattr(node, 'start_rebalance', lambda: rebalances.append(node.EPOCH))
+    node.rebuild_ring()
+    node.rebalances = rebalances
+    return node
+
+
+def test_node_that_sorts_first_takes_the_first_clock_slot(views):
+    assert views.PARTITION_MEMBERS.index(views.IP_PORT) == 0
+    new_view = dict(views.view, **{'10.0.0.10:8080': 0})
+    assert views.install_view(2, new_view)
+    assert views.PARTITION_MEMBERS == ['10.0.0.10:8080', '10.0.0.20:8080', '10.0.0.21:8080']
+    assert views.PARTITION_MEMBERS.index(views.IP_PORT) == 1
+
+
+def test_older_view_is_not_installed(views):
+    assert not views.install_view(1, {views.IP_PORT: 0})
+    assert len(views.view) == 4
+
+
+def test_rebalance_starts_when_the_ring_changes(views):
+    views.install_view(2, dict(views.view, **{'10.0.0.24:8080': 2}))
+    views.install_view(3, dict(views.view, **{'10.0.0.25:8080': 2}))
+    assert views.rebalances == [2]
+
+
+def unreachable(*args, **kwargs):
+    raise requests.exceptions.ConnectionError()
+
+
+def diff_to(epoch, new_view):
+    return {'epoch': epoch, 'type': 'add', 'ip_port': '10.0.0.24:8080', 'partition_id': 2, 'view': new_view}
+
+
+def test_diff_with_our_epoch_and_view_is_acknowledged(views):
+    assert views.apply_diff(diff_to(1, dict(views.view)))
+    assert views.apply_diff(diff_to(0, {}))
+
+
+def test_diff_with_our_epoch_and_another_view_conflicts(views):
+    other = dict(views.view, **{'10.0.0.24:8080': 2})
+    assert not views.apply_diff(diff_to(1, other))
+    assert '10.0.0.24:8080' not in views.view
+
+
+def test_diff_carries_the_view_a_node_missed(views):
+    new_view = dict(views.view, **{'10.0.0.24:8080': 2, '10.0.0.25:8080': 2})
+    assert views.apply_diff(diff_to(3, new_view))
+    assert views.EPOCH == 3 and views.view == new_view
+
+
+def test_conflicting_diff_is_refused_with_409(views):
+    other = dict(views.view, **{'10.0.0.24:8080': 2})
+    res = views.app.test_client().put('/kvs/view_diff', data=views.json.dumps(diff_to(1, other)))
+    assert res.status_code == 409
+    assert views.json.loads(res.data.decode('utf-8'))['epoch'] == 1
+
+
+def test_coordinator_that_lost_a_conflict_changes_the_winning_view(views, monkeypatch):
+    #another coordinator added 10.0.0.25 with epoch 2 while we add 10.0.0.24
+    winner = dict(views.view, **{'10.0.0.25:8080': 2})
+    sent = []
+    def disseminate(nodes, diff, needed, conflicts=None):
+        sent.append(dict(diff))
+        if diff['epoch'] == 2:
+            conflicts.append('10.0.0.21:8080')
+            return False
+        return True
+    monkeypatch.setattr(views, 'disseminate', disseminate)
+    monkeypatch.setattr(views, 'adopt_view', lambda node: views.install_view(2, winner, force=True))
+    monkeypatch.setattr(views.transport, 'put', unreachable)
+    acked = views.propose_view_change(lambda: {'type': 'add', 'ip_port': '10.0.0.24:8080',
+                                               'partition_id': views.view.get('10.0.0.24:8080', len(views.view) // 2)})
+    assert acked
+    assert [diff['epoch'] for diff in sent] == [2, 3]
+    assert views.EPOCH == 3 and views.view == dict(winner, **{'10.0.0.24:8080': 2})
+    assert sent[1]['view'] == views.view
+
+
+def test_coordinator_gives_up_without_a_conflict(views, monkeypatch):
+    monkeypatch.setattr(views, 'disseminate', lambda nodes, diff, needed, conflicts=None: False)
+    monkeypatch.setattr(views.transport, 'put', unreachable)
+    assert not views.propose_view_change(lambda: {'type': 'remove', 'ip_port': '10.0.0.23:8080'})
+    assert views.EPOCH == 2 and '10.0.0.23:8080' not in views.view
@@ -0,0 +1,119 @@
+"""
+Tracing of requests across nodes. The node a client calls starts a trace, and every request it sends to
+another node carries the trace id and the id of its span in the X-Trace-Id and X-Span-Id headers, so the
+spans the other nodes record for it join the same trace. Every node keeps its last spans in a ring buffer.
+A request is split into local time and remote time, the time at least one request to another node was
+in flight, and both are returned to the caller in a Server-Timing header
+"""
+import os
+from collections import deque
+from contextvars import ContextVar, copy_context
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+
+def new_id():
+    return os.urandom(8).hex()
+
+
+class Span:
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'peer', 'start', 'calls', 'headers')
+
+    def __init__(self, trace_id, parent_id, name, peer=None):
+        self.trace_id = trace_id
+        self.span_id = new_id()
+        self.parent_id = parent_id
+        self.name = name
+        self.peer = peer
+        self.start = time()
+        #(start, end) of the requests this span sent to other nodes
+        self.calls = []
+        self.headers = {'X-Trace-Id': trace_id, 'X-Span-Id': self.span_id}
+
+    def record(self, node, kind, end, status, **fields):
+        span = {'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id, 'name': self.name, 'kind': kind,
+                'node': node, 'start': self.start, 'duration': end - self.start, 'status': status}
+        if self.peer is not None:
+            span['peer'] = self.peer
+        span.update(fields)
+        return span
+
+
+"""
+Total time covered by a list of (start, end) intervals, overlaps counted once
+"""
+def covered(intervals):
+    total = 0
+    last_end = None
+    for start, end in sorted(intervals):
+        if last_end is not None and start < last_end:
+            start = last_end
+        if end > start:
+            total += end - start
+            last_end = end
+    return total
+
+
+class Tracer:
+
+    def __init__(self, size):
+        self.node = None
+        self.spans_buffer = deque(maxlen=size)
+        self.current = ContextVar('span', default=None)
+
+    """
+    Start the span of a request we received, in the trace of the sender if it sent one
+    """
+    def start_request(self, headers, name):
+        trace_id = headers.get('X-Trace-Id')
+        span = Span(trace_id or os.urandom(16).hex(), headers.get('X-Span-Id') if trace_id else None, name)
+        self.current.set(span)
+        return span
+
+    """
+    Record the span of a request we answered and return the value of its Server-Timing header
+    """
+    def finish_request(self, span, status):
+        self.current.set(None)
+        end = time()
+        remote = covered(span.calls)
+        local = end - span.start - remote
+        self.spans_buffer.append(span.record(self.node, 'server', end, status, local=local, remote=remote))
+        return 'total;dur=%.3f, local;dur=%.3f, remote;dur=%.3f' % ((end - span.start) * 1000, local * 1000, remote * 1000)
+
+    """
+    Start the span of a request to another node, or return None if we are not handling a request
+    """
+    def start_call(self, node, method, path):
+        parent = self.current.get()
+        if parent is None:
+            return None
+        span = Span(parent.trace_id, parent.span_id, method + ' ' + path, node)
+        #the call is timed in the list of its parent(see finish_call)
+        span.calls = parent.calls
+        return span
+
+    def finish_call(self, span, status):
+        end = time()
+        span.calls.append((span.start, end))
+        self.spans_buffer.append(span.record(self.node, 'client', end, status))
+
+    """
+    Return the recorded spans of a trace, or the last limit spans
+    """
+    def spans(self, trace_id=None, limit=100):
+        spans = list(self.spans_buffer)
+        if trace_id is None:
+            return spans[-limit:]
+        return [span for span in spans if span['trace_id'] == trace_id]
+
+
+"""
+Thread pool running every task in the context of the thread that submitted it, so the span of a request
+follows it to the threads of its fan-out
+"""
+class ContextThreadPool(ThreadPoolExecutor):
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(copy_context().run, fn, *args, **kwargs)
@@ -0,0 +1,213 @@
+"""
+Transport for every request between nodes of the key-value store.
+Each peer gets its own pooled keep-alive requests.Session, a smoothed round trip time used to pick
+adaptive timeouts, and a circuit breaker that stops dialing a peer after repeated failures.
+"""
+import os
+import threading
+from time import time
+import requests
+from requests.adapters import HTTPAdapter
+
+
+"""
+Lower bound of an adaptive timeout in seconds, so a short burst of fast answers does not make
+the next slow one look like a failure
+"""
+MIN_TIMEOUT = float(os.getenv('PEER_MIN_TIMEOUT', 0.2))
+
+
+"""
+Number of consecutive failures after which the circuit of a peer opens
+"""
+FAILURE_THRESHOLD = int(os.getenv('PEER_FAILURE_THRESHOLD', 3))
+
+
+"""
+Number of seconds an open circuit rejects requests before a single trial request is let through
+"""
+OPEN_SECONDS = float(os.getenv('PEER_OPEN_SECONDS', 2))
+
+
+"""
+Maximum number of pooled connections kept open to a single peer
+"""
+POOL_SIZE = int(os.getenv('PEER_POOL_SIZE', 32))
+
+
+"""
+Headers sent with every request to a peer(kvs.py puts the epoch of its view here)
+"""
+HEADERS = {}
+
+
+"""
+Functions called as hook(node, response) with every response a peer sends back
+"""
+RESPONSE_HOOKS = []
+
+
+"""
+Tracer of the requests between nodes(see tracing.py), or None. The span it starts for a request gives
+the headers that carry the trace to the peer
+"""
+TRACER = None
+
+
+"""
+Functions called as hook(node, seconds, failed) after every request to a peer, with the time it took
+"""
+CALL_HOOKS = []
+
+
+"""
+Raised instead of dialing a peer whose circuit is open. It is a ConnectionError so callers
+handle it like a peer that refused the connection
+"""
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+"""
+Connection pool, round trip estimate and circuit breaker state of one peer
+Round trip time is estimated like TCP does(RFC 6298): smoothed rtt plus four times its variation
+"""
+class Peer:
+
+    def __init__(self, node):
+        self.node = node
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.srtt = None
+        self.rttvar = None
+        self.failures = 0
+        self.open_until = 0
+        self.lock = threading.Lock()
+
+    """
+    Return the timeout to use for a request, never more than max_timeout
+    """
+    def timeout(self, max_timeout):
+        if self.srtt is None:
+            return max_timeout
+        return min(max_timeout, max(MIN_TIMEOUT, self.srtt + 4*self.rttvar))
+
+    """
+    Return False if the circuit is open. Once OPEN_SECONDS have passed, one trial request is let through
+    and the circuit stays open for the others until that request finishes
+    """
+    def allow_request(self):
+        with self.lock:
+            if self.failures < FAILURE_THRESHOLD:
+                return True
+            now = time()
+            if now < self.open_until:
+                return False
+            self.open_until = now + OPEN_SECONDS
+            return True
+
+    def record_success(self, rtt=None):
+        with self.lock:
+            self.failures = 0
+            self.open_until = 0
+            if rtt is None:
+                return
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt/2
+            else:
+                self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt - rtt)
+                self.srtt = 0.875*self.srtt + 0.125*rtt
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= FAILURE_THRESHOLD:
+                self.open_until = time() + OPEN_SECONDS
+
+    def is_open(self):
+        return self.failures >= FAILURE_THRESHOLD and time() < self.open_until
+
+    def status(self):
+        return {'srtt': self.srtt, 'rttvar': self.rttvar, 'failures': self.failures, 'open': self.is_open()}
+
+
+"""
+A dictionary of all the peers we have talked to {ip_port: Peer}
+"""
+PEERS = {}
+PEERS_LOCK = threading.Lock()
+
+
+def get_peer(node):
+    peer = PEERS.get(node)
+    if peer is None:
+        with PEERS_LOCK:
+            peer = PEERS.setdefault(node, Peer(node))
+    return peer
+
+
+"""
+Send a request to a peer(e.g. request('10.0.0.21:8080', 'GET', '/kvs/get_key', params=values))
+timeout is the longest we are willing to wait. With adaptive=True the timeout is shrunk to what the
+observed round trip times of this peer allow; bulk transfers should pass adaptive=False.
+Raise CircuitOpenError without dialing if the peer keeps failing
+"""
+def request(node, method, path, timeout=0.5, adaptive=True, **kwargs):
+    peer = get_peer(node)
+    if not peer.allow_request():
+        raise CircuitOpenError('circuit open for ' + node)
+    span = TRACER.start_call(node, method, path) if TRACER is not None else None
+    if span is not None:
+        kwargs['headers'] = dict(HEADERS, **kwargs.get('headers', {}), **span.headers)
+    elif HEADERS:
+        kwargs['headers'] = dict(HEADERS, **kwargs.get('headers', {}))
+    start = time()
+    try:
+        res = peer.session.request(method, 'http://' + node + path, timeout=peer.timeout(timeout) if adaptive else timeout, **kwargs)
+    except requests.exceptions.RequestException:
+        peer.record_failure()
+        record_call(node, time() - start, True)
+        if span is not None:
+            TRACER.finish_call(span, 'error')
+        raise
+    peer.record_success(time() - start if adaptive else None)
+    record_call(node, time() - start, False)
+    if span is not None:
+        TRACER.finish_call(span, res.status_code)
+    notify(node, res)
+    return res
+
+
+def notify(node, res):
+    for hook in RESPONSE_HOOKS:
+        hook(node, res)
+
+
+def record_call(node, seconds, failed):
+    for hook in CALL_HOOKS:
+        hook(node, seconds, failed)
+
+
+def get(node, path, **kwargs):
+    return request(node, 'GET', path, **kwargs)
+
+
+def put(node, path, **kwargs):
+    return request(node, 'PUT', path, **kwargs)
+
+
+"""
+Return False if we should not dial the peer right now
+"""
+def is_available(node):
+    peer = PEERS.get(node)
+    return peer is None or not peer.is_open()
+
+
+"""
+Return the state of every peer for debugging
+"""
+def status():
+    return {node: peer.status() for node, peer in list(PEERS.items())}